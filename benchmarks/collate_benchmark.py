@@ -0,0 +1,79 @@
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from benchmarks.synthetic import random_chain
+from constants import MAX_TRAINING_SIZE, MIN_SIZE
+from strategies.contact_map_to_sequence import ContactMapToSequence
+from utils.padding_functions import padd_sequence
+from utils.structure_utils import get_contact_edge_index
+
+BATCH_SIZES = [32, 128, 512, 1024, 2048]
+NUM_REPEATS = 20
+
+
+def per_sample_featurize(sequence, edge_index, vocab_size):
+    # Features as they were built per sample before the vectorized collate
+    sequence_tensor, mask_tensor = padd_sequence(sequence, MAX_TRAINING_SIZE)
+    ground_truth = F.one_hot(sequence_tensor[len(sequence) - 1].to(torch.long), num_classes=vocab_size).float()
+    input_tensor = F.one_hot(sequence_tensor.to(torch.long), num_classes=vocab_size)
+    input_tensor[len(sequence) - 1] = 0
+    return (input_tensor.to(torch.float32), edge_index, mask_tensor), ground_truth
+
+
+def loop_collate(batch):
+    inputs_list, ground_truth_list = zip(*batch)
+    input_tensors, edge_indices, mask_tensors = zip(*inputs_list)
+
+    edge_index_list = []
+    total_nodes = 0
+    for edge_index, input_tensor in zip(edge_indices, input_tensors):
+        edge_index_list.append(edge_index + total_nodes)
+        total_nodes += input_tensor.size(0)
+
+    return ((torch.cat(input_tensors, dim=0), torch.cat(edge_index_list, dim=1), torch.stack(mask_tensors, dim=0)),
+            torch.stack(ground_truth_list, dim=0))
+
+
+def time_call(fn, num_repeats=NUM_REPEATS):
+    timings = []
+    for _ in range(num_repeats):
+        start_time = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start_time)
+    return float(np.median(timings))
+
+
+def run_benchmark(batch_sizes=BATCH_SIZES, seed=0):
+    rng = np.random.default_rng(seed)
+    strategy = ContactMapToSequence()
+    crops = []
+    for _ in range(max(batch_sizes)):
+        sequence, coords = random_chain(int(rng.integers(MIN_SIZE, MAX_TRAINING_SIZE + 1)), rng)
+        crops.append((sequence, torch.from_numpy(get_contact_edge_index(coords))))
+
+    results = []
+    for batch_size in batch_sizes:
+        legacy_samples = [per_sample_featurize(sequence, edge_index, strategy.vocab_size)
+                          for sequence, edge_index in crops[:batch_size]]
+        samples = [strategy.get_sample(sequence, edge_index) for sequence, edge_index in crops[:batch_size]]
+
+        def vectorized():
+            (tokens, _, _, ptr, _), _ = strategy.collate(samples)
+            strategy.featurize(tokens, ptr)
+
+        results.append({
+            "batch_size": batch_size,
+            "loop_collate_ms": 1000 * time_call(lambda: loop_collate(legacy_samples)),
+            "vectorized_collate_ms": 1000 * time_call(vectorized)
+        })
+        print(f"batch size {batch_size}: loop collate {results[-1]['loop_collate_ms']:.2f} ms, "
+              f"vectorized collate {results[-1]['vectorized_collate_ms']:.2f} ms")
+    return results
+
+
+if __name__ == '__main__':
+    torch.set_num_threads(1)
+    run_benchmark()
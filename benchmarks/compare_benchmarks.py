@@ -0,0 +1,54 @@
+import json
+import sys
+
+from benchmarks.strategies_benchmark import STAGES
+
+# Stages this much slower than the baseline are flagged, unless the difference is below MIN_DELTA_MS
+REGRESSION_THRESHOLD = 0.1
+MIN_DELTA_MS = 0.2
+
+
+def load_results(path):
+    with open(path) as f:
+        report = json.load(f)
+    return report, {(result["strategy"], result["batch_size"], result["crop_length"]): result
+                    for result in report["results"]}
+
+
+def compare_results(baseline_path, candidate_path, threshold=REGRESSION_THRESHOLD, min_delta_ms=MIN_DELTA_MS):
+    """Print the per-stage speed ratio of two strategies_benchmark results and return the regressions."""
+    baseline_report, baseline = load_results(baseline_path)
+    candidate_report, candidate = load_results(candidate_path)
+    print(f"baseline {baseline_report['commit']} ({baseline_report['date']}), "
+          f"candidate {candidate_report['commit']} ({candidate_report['date']})")
+    if (baseline_report["device"], baseline_report["num_threads"]) != \
+            (candidate_report["device"], candidate_report["num_threads"]):
+        print("Warning: the results come from different devices or thread counts")
+
+    regressions = []
+    for key, result in candidate.items():
+        if key not in baseline:
+            continue
+        baseline_ms = dict(baseline[key]["stages_ms"], total=baseline[key]["total_ms"])
+        candidate_ms = dict(result["stages_ms"], total=result["total_ms"])
+        line = []
+        for stage in STAGES + ["total"]:
+            ratio = candidate_ms[stage] / max(baseline_ms[stage], 1e-9)
+            flagged = ratio > 1 + threshold and candidate_ms[stage] - baseline_ms[stage] > min_delta_ms
+            if flagged:
+                regressions.append({"strategy": key[0], "batch_size": key[1], "crop_length": key[2], "stage": stage,
+                                    "baseline_ms": baseline_ms[stage], "candidate_ms": candidate_ms[stage]})
+            line.append(f"{stage} {ratio:.2f}x{' REGRESSION' if flagged else ''}")
+        print(f"{key[0]} batch {key[1]} crop {key[2]}: " + ", ".join(line))
+
+    print(f"{len(regressions)} regressions above {threshold:.0%}")
+    return regressions
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("usage: python -m benchmarks.compare_benchmarks baseline.json candidate.json [threshold]")
+        sys.exit(2)
+    found = compare_results(sys.argv[1], sys.argv[2], float(sys.argv[3]) if len(sys.argv) > 3 else
+                            REGRESSION_THRESHOLD)
+    sys.exit(1 if found else 0)
@@ -0,0 +1,82 @@
+import sys
+import time
+
+import numpy as np
+import torch
+
+from benchmarks.strategies_benchmark import fixed_crop
+from benchmarks.synthetic import random_rows
+from strategies.contact_map_to_sequence import ContactMapToSequence
+
+BATCH_SIZES = [8, 32, 128, 512]
+CROP_LENGTHS = [16, 32, 50, 100, 200]
+NUM_CHAINS = 512
+NUM_WARMUP = 2
+NUM_REPEATS = 5
+
+
+def time_step(strategy, inputs, ground_truth, backward, device):
+    start_time = time.perf_counter()
+    if backward:
+        strategy.compute_loss(strategy(inputs), ground_truth).backward()
+        strategy.zero_grad(set_to_none=True)
+    else:
+        with torch.no_grad():
+            strategy(inputs)
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return time.perf_counter() - start_time
+
+
+def compare_layers(strategy, inputs, ground_truth, backward, device, num_repeats=NUM_REPEATS):
+    """Median milliseconds of a step with the sparse and the dense GAT layers, and the largest output difference."""
+    timings = {"sparse": [], "dense": []}
+    outputs = {}
+    for repeat in range(NUM_WARMUP + num_repeats):
+        for name, dense_max_nodes in (("sparse", 0), ("dense", sys.maxsize)):
+            strategy.dense_max_nodes = dense_max_nodes
+            seconds = time_step(strategy, inputs, ground_truth, backward, device)
+            if repeat >= NUM_WARMUP:
+                timings[name].append(seconds)
+            if repeat == 0:
+                with torch.no_grad():
+                    outputs[name] = strategy(inputs)
+    result = {f"{name}_ms": 1000 * float(np.median(name_timings)) for name, name_timings in timings.items()}
+    result["speedup"] = result["sparse_ms"] / result["dense_ms"]
+    result["max_abs_diff"] = (outputs["sparse"] - outputs["dense"]).abs().max().item()
+    return result
+
+
+def run_benchmark(batch_sizes=BATCH_SIZES, crop_lengths=CROP_LENGTHS, device="cpu", backward=True, seed=0):
+    """Training step time of ContactMapToSequence with message passing and with dense attention in the GAT layers.
+
+    DENSE_GAT_MAX_NODES should stay below the crop length where dense attention stops being faster on the device,
+    or where its (batch, heads, nodes, nodes) scores no longer fit in memory.
+    """
+    torch.manual_seed(seed)
+    rng = np.random.default_rng(seed)
+    rows = random_rows(NUM_CHAINS, rng, min_length=max(crop_lengths))
+    strategy = ContactMapToSequence().to(device)
+    default_dense_max_nodes = strategy.dense_max_nodes
+    results = []
+    for crop_length in crop_lengths:
+        strategy.get_augmentation_indices = fixed_crop(crop_length, rng)
+        for batch_size in batch_sizes:
+            strategy.train()
+            samples = [strategy.load_inputs_and_ground_truth(rows[idx]) for idx in range(batch_size)]
+            inputs, ground_truth = strategy.collate(samples)
+            inputs, ground_truth = strategy.inputs_to_device(inputs, device), ground_truth.to(device)
+            # Attention dropout of GATConv is off, so train mode only enables the gradients
+            result = compare_layers(strategy, inputs, ground_truth, backward, device)
+            result.update({"crop_length": crop_length, "batch_size": batch_size})
+            results.append(result)
+            print(f"crop {crop_length} batch {batch_size}: sparse {result['sparse_ms']:.2f} ms, "
+                  f"dense {result['dense_ms']:.2f} ms, {result['speedup']:.2f}x, "
+                  f"max difference {result['max_abs_diff']:.2e}")
+    del strategy.get_augmentation_indices
+    strategy.dense_max_nodes = default_dense_max_nodes
+    return results
+
+
+if __name__ == '__main__':
+    run_benchmark(device="cuda:0" if torch.cuda.is_available() else "cpu")
@@ -0,0 +1,84 @@
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+from benchmarks.synthetic import random_rows
+from strategies.contact_map_to_sequence import ContactMapToSequence
+from strategies.sequence_to_distogram import SequenceToDistogram
+from utils.inference_export import check_parity, export_torchscript, get_example_inputs, quantize_dynamic_int8
+
+STRATEGIES = [
+    ("contact_map_to_sequence", ContactMapToSequence),
+    ("sequence_to_distogram", SequenceToDistogram),
+]
+THREAD_COUNTS = sorted({1, 2, 4, os.cpu_count() or 1})
+BATCH_SIZES = [1, 32]
+NUM_WARMUP = 3
+NUM_RUNS = 30
+NUM_PARITY_CHAINS = 64
+
+
+def measure_latency(model, inputs, num_threads, num_warmup=NUM_WARMUP, num_runs=NUM_RUNS):
+    torch.set_num_threads(num_threads)
+    timings = []
+    with torch.no_grad():
+        for run in range(num_warmup + num_runs):
+            start_time = time.perf_counter()
+            model(inputs)
+            if run >= num_warmup:
+                timings.append(time.perf_counter() - start_time)
+    timings = 1000 * np.array(timings)
+    return {"p50_ms": float(np.percentile(timings, 50)), "p99_ms": float(np.percentile(timings, 99))}
+
+
+def get_variants(strategy, example_inputs):
+    """fp32 and dynamic int8 models, each eager and as frozen TorchScript."""
+    quantized = quantize_dynamic_int8(strategy)
+    return {
+        "fp32": strategy,
+        "int8": quantized,
+        "fp32_torchscript": export_torchscript(strategy, example_inputs),
+        "int8_torchscript": export_torchscript(quantized, example_inputs),
+    }
+
+
+def run_benchmark(output_path=None, strategies=STRATEGIES, thread_counts=THREAD_COUNTS, batch_sizes=BATCH_SIZES,
+                  num_runs=NUM_RUNS, seed=0):
+    """CPU latency percentiles and throughput of fp32, int8 and TorchScript inference across thread counts."""
+    rows = random_rows(max(NUM_PARITY_CHAINS, max(batch_sizes)), np.random.default_rng(seed))
+    default_threads = torch.get_num_threads()
+    results = []
+    for name, strategy_class in strategies:
+        torch.manual_seed(seed)
+        strategy = strategy_class().eval()
+        parity_inputs = [get_example_inputs(strategy, rows[start:], 8) for start in range(0, NUM_PARITY_CHAINS, 8)]
+        variants = get_variants(strategy, parity_inputs[0])
+        for variant, model in variants.items():
+            parity = check_parity(strategy, model, parity_inputs)
+            print(f"{name} {variant}: parity {parity}")
+            for batch_size in batch_sizes:
+                inputs = get_example_inputs(strategy, rows, batch_size)
+                for num_threads in thread_counts:
+                    latency = measure_latency(model, inputs, num_threads, num_runs=num_runs)
+                    latency["samples_per_second"] = 1000 * batch_size / latency["p50_ms"]
+                    results.append({"strategy": name, "variant": variant, "batch_size": batch_size,
+                                    "num_threads": num_threads, "parity": parity, **latency})
+                    print(f"{name} {variant} batch {batch_size} threads {num_threads}: "
+                          f"p50 {latency['p50_ms']:.2f} ms, p99 {latency['p99_ms']:.2f} ms, "
+                          f"{latency['samples_per_second']:.1f} samples/sec")
+    torch.set_num_threads(default_threads)
+
+    if output_path:
+        with open(output_path, "w") as f:
+            json.dump({"torch": torch.__version__, "quantized_engine": torch.backends.quantized.engine,
+                       "results": results}, f, indent=2)
+        print(f"Results saved at {output_path}")
+    return results
+
+
+if __name__ == '__main__':
+    run_benchmark(sys.argv[1] if len(sys.argv) > 1 else "inference_benchmark.json")
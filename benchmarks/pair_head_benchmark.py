@@ -0,0 +1,79 @@
+import multiprocessing
+import resource
+import time
+
+import torch
+
+from strategies.sequence_to_distogram import SequenceToDistogram
+
+SEQUENCE_LENGTHS = [50, 200, 750]
+BLOCK_SIZE = 128
+NUM_REPEATS = 3
+MAX_CONCAT_BYTES = 8 * 1024 ** 3
+
+# (name, pair_mode, block_size, symmetric)
+PAIR_HEADS = [
+    ("concat", "concat", None, False),
+    ("factorized", "factorized", None, False),
+    ("factorized_blocks", "factorized", BLOCK_SIZE, False),
+    ("factorized_blocks_symmetric", "factorized", BLOCK_SIZE, True),
+]
+
+
+def run_pair_head(strategy, x, pair_mode, block_size, symmetric):
+    if pair_mode == "concat":
+        return strategy.concat_pair_head(x)
+    return strategy.pair_head(x, block_size=block_size, symmetric=symmetric)
+
+
+def measure(sequence_length, pair_mode, block_size, symmetric, device, queue):
+    torch.manual_seed(0)
+    strategy = SequenceToDistogram().to(device).eval()
+    x = torch.randn(1, sequence_length, strategy.hidden_size, device=device)
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with torch.no_grad():
+        run_pair_head(strategy, x, pair_mode, block_size, symmetric)
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+
+        start_time = time.perf_counter()
+        for _ in range(NUM_REPEATS):
+            run_pair_head(strategy, x, pair_mode, block_size, symmetric)
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        elapsed_time = (time.perf_counter() - start_time) / NUM_REPEATS
+
+    if device.startswith("cuda"):
+        peak_mb = torch.cuda.max_memory_allocated() / 1024 ** 2
+    else:
+        # Growth of the process peak RSS over the model and input allocation
+        peak_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_kb) / 1024
+    queue.put({"seconds_per_sample": elapsed_time, "peak_memory_mb": peak_mb})
+
+
+def run_benchmark(sequence_lengths=SEQUENCE_LENGTHS, device="cpu"):
+    # Every case runs in a fresh process so that its peak memory is not hidden by an earlier, larger case
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for sequence_length in sequence_lengths:
+        for name, pair_mode, block_size, symmetric in PAIR_HEADS:
+            concat_bytes = 4 * sequence_length ** 2 * (4 * SequenceToDistogram().hidden_size + 1)
+            if pair_mode == "concat" and 3 * concat_bytes > MAX_CONCAT_BYTES:
+                print(f"L={sequence_length} {name}: skipped, needs about {3 * concat_bytes / 1024 ** 3:.1f} GB")
+                continue
+            queue = context.Queue()
+            process = context.Process(target=measure,
+                                      args=(sequence_length, pair_mode, block_size, symmetric, device, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            result.update({"sequence_length": sequence_length, "pair_head": name})
+            results.append(result)
+            print(f"L={sequence_length} {name}: {result['seconds_per_sample'] * 1000:.1f} ms per sample, "
+                  f"peak memory {result['peak_memory_mb']:.0f} MB")
+    return results
+
+
+if __name__ == '__main__':
+    run_benchmark(device="cuda:0" if torch.cuda.is_available() else "cpu")
@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+
+import numpy as np
+
+from constants import MAIN_DIR
+from utils.extract_pdb_database import parser, extract_amino_acid_chains, get_structure_info
+from utils.pdb_scanner import scan_ca_chains
+
+TARGET_SPEEDUP = 10
+
+
+def parse_with_biopython(path, first_model_only=False):
+    structure = parser.get_structure(os.path.basename(path), path)
+    chain_ids, chain_sequences, chain_coords = extract_amino_acid_chains(structure, first_model_only)
+    return chain_ids, chain_sequences, chain_coords, get_structure_info(structure)
+
+
+def compare_outputs(expected, actual):
+    expected_ids, expected_sequences, expected_coords, expected_info = expected
+    actual_ids, actual_sequences, actual_coords, actual_info = actual
+    if expected_ids != actual_ids:
+        return "chain ids differ"
+    if expected_sequences != actual_sequences:
+        return "sequences differ"
+    for expected_chain, actual_chain in zip(expected_coords, actual_coords):
+        if not np.allclose(np.reshape(expected_chain, (-1, 3)), actual_chain, atol=1e-3):
+            return "coordinates differ"
+    if expected_info != actual_info:
+        return f"structure info differs: {expected_info} != {actual_info}"
+    return None
+
+
+def run_benchmark(pdb_dir, max_files=None, first_model_only=False):
+    paths = sorted(os.path.join(pdb_dir, fname) for fname in os.listdir(pdb_dir)
+                   if fname.endswith(('.ent', '.pdb')))[:max_files]
+    biopython_time, scanner_time = 0, 0
+    mismatches = {}
+    for path in paths:
+        start_time = time.perf_counter()
+        expected = parse_with_biopython(path, first_model_only)
+        biopython_time += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        actual = scan_ca_chains(path, first_model_only)
+        scanner_time += time.perf_counter() - start_time
+
+        mismatch = compare_outputs(expected, actual)
+        if mismatch:
+            mismatches[os.path.basename(path)] = mismatch
+
+    print(f"{len(paths)} files, {len(mismatches)} mismatches")
+    for fname, mismatch in mismatches.items():
+        print(f"{fname}: {mismatch}")
+    speedup = biopython_time / max(scanner_time, 1e-9)
+    print(f"Biopython: {biopython_time:.2f} seconds, scanner: {scanner_time:.2f} seconds, speedup: {speedup:.1f}x")
+    if speedup < TARGET_SPEEDUP:
+        print(f"Below the {TARGET_SPEEDUP}x target by {TARGET_SPEEDUP / speedup:.2f}x")
+    return mismatches
+
+
+if __name__ == '__main__':
+    run_benchmark(sys.argv[1] if len(sys.argv) > 1 else os.path.join(MAIN_DIR, "PDB", "pdb_files"))
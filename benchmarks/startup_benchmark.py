@@ -0,0 +1,66 @@
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+from benchmarks.strategies_benchmark import get_git_commit
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Cold starts of the entry points, each in a fresh interpreter
+COMMANDS = [
+    ("import_trainer", "import trainer"),
+    ("import_predict", "import predict"),
+    ("import_evaluator", "import evaluator"),
+    ("contact_map_to_sequence", "from strategies.registry import create_strategy; "
+                                "create_strategy('contact_map_to_sequence')"),
+    ("sequence_to_distogram", "from strategies.registry import create_strategy; "
+                              "create_strategy('sequence_to_distogram')"),
+    ("trainer_help", "import runpy, sys; sys.argv = ['trainer.py', '--help']; "
+                     "runpy.run_path('trainer.py', run_name='__main__')"),
+]
+HEAVY_MODULES = ["torch", "torch_geometric", "transformers", "scipy", "sklearn", "pandas", "matplotlib", "pyarrow",
+                 "Bio", "umap"]
+NUM_RUNS = 5
+
+
+def time_command(code, num_runs=NUM_RUNS):
+    """Wall time of running code in a new interpreter, and the heavy modules it left imported."""
+    report = f"import sys, json; print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    script = f"try:\n    {code}\nexcept SystemExit:\n    pass\n{report}"
+    timings = []
+    for _ in range(num_runs):
+        start_time = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", script], cwd=REPO_DIR, capture_output=True, text=True,
+                                check=True)
+        timings.append(time.perf_counter() - start_time)
+    return float(np.median(timings)), json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def run_benchmark(output_path=None, commands=COMMANDS, num_runs=NUM_RUNS):
+    """Median cold start time of the entry points, saved as JSON at output_path."""
+    results = []
+    for name, code in commands:
+        seconds, modules = time_command(code, num_runs)
+        results.append({"name": name, "seconds": seconds, "modules": modules})
+        print(f"{name}: {seconds:.2f} s, imports {', '.join(modules) or 'nothing heavy'}")
+
+    report = {
+        "commit": get_git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "num_runs": num_runs,
+        "results": results
+    }
+    if output_path:
+        with open(output_path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results saved at {output_path}")
+    return report
+
+
+if __name__ == '__main__':
+    run_benchmark(sys.argv[1] if len(sys.argv) > 1 else "startup_benchmark.json")
@@ -0,0 +1,142 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import torch
+
+from benchmarks.synthetic import random_rows
+from constants import MAX_TRAINING_SIZE, MAX_SIZE
+from strategies.contact_map_to_sequence import ContactMapToSequence
+from strategies.sequence_to_distogram import SequenceToDistogram
+
+STRATEGIES = [
+    ("contact_map_to_sequence", ContactMapToSequence),
+    ("sequence_to_distogram", SequenceToDistogram),
+]
+STAGES = ["load_inputs_and_ground_truth", "collate", "forward", "compute_loss", "backward"]
+BATCH_SIZES = [8, 32, 128]
+CROP_LENGTHS = [16, 32, MAX_TRAINING_SIZE]
+NUM_CHAINS = 512
+NUM_WARMUP = 1
+NUM_REPEATS = 5
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def fixed_crop(crop_length, rng):
+    # Replaces the random crop length of training with a fixed one, at a random start
+    def get_augmentation_indices(seq_len):
+        length = min(seq_len, crop_length)
+        start = int(rng.integers(0, seq_len - length + 1))
+        return start, start + length
+    return get_augmentation_indices
+
+
+def to_device(strategy, inputs, ground_truth, device):
+    return strategy.inputs_to_device(inputs, device), ground_truth.to(device)
+
+
+def time_stages(strategy, rows, batch_size, crop_length, device="cpu", num_repeats=NUM_REPEATS, seed=0):
+    """Median milliseconds of every stage of a training step on batches of random rows."""
+    rng = np.random.default_rng(seed)
+    strategy.get_augmentation_indices = fixed_crop(crop_length, rng)
+    strategy.train()
+    timings = {stage: [] for stage in STAGES}
+
+    def synchronize():
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+
+    for repeat in range(NUM_WARMUP + num_repeats):
+        batch_rows = [rows[idx] for idx in rng.integers(0, len(rows), size=batch_size)]
+        stage_times = []
+
+        start_time = time.perf_counter()
+        samples = [strategy.load_inputs_and_ground_truth(row) for row in batch_rows]
+        stage_times.append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        inputs, ground_truth = strategy.collate(samples)
+        stage_times.append(time.perf_counter() - start_time)
+        inputs, ground_truth = to_device(strategy, inputs, ground_truth, device)
+        synchronize()
+
+        start_time = time.perf_counter()
+        outputs = strategy(inputs)
+        synchronize()
+        stage_times.append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        loss = strategy.compute_loss(outputs, ground_truth)
+        synchronize()
+        stage_times.append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        loss.backward()
+        synchronize()
+        stage_times.append(time.perf_counter() - start_time)
+        strategy.zero_grad(set_to_none=True)
+
+        if repeat >= NUM_WARMUP:
+            for stage, seconds in zip(STAGES, stage_times):
+                timings[stage].append(seconds)
+    del strategy.get_augmentation_indices
+    return {stage: 1000 * float(np.median(stage_timings)) for stage, stage_timings in timings.items()}
+
+
+def run_benchmark(output_path=None, strategies=STRATEGIES, batch_sizes=BATCH_SIZES, crop_lengths=CROP_LENGTHS,
+                  device="cpu", num_repeats=NUM_REPEATS, seed=0):
+    """Time every stage of each strategy across batch sizes and crop lengths, saved as JSON at output_path.
+
+    Chains are synthetic, with realistic lengths and CA geometry, so the data path does the same work as on PDB
+    chains. Two result files are compared with benchmarks.compare_benchmarks.
+    """
+    rows = random_rows(NUM_CHAINS, np.random.default_rng(seed), max_length=MAX_SIZE)
+    results = []
+    for name, strategy_class in strategies:
+        torch.manual_seed(seed)
+        strategy = strategy_class().to(device)
+        for batch_size in batch_sizes:
+            for crop_length in crop_lengths:
+                stages_ms = time_stages(strategy, rows, batch_size, crop_length, device, num_repeats, seed)
+                total_ms = sum(stages_ms.values())
+                results.append({"strategy": name, "batch_size": batch_size, "crop_length": crop_length,
+                                "stages_ms": stages_ms, "total_ms": total_ms,
+                                "samples_per_second": 1000 * batch_size / total_ms})
+                print(f"{name} batch {batch_size} crop {crop_length}: "
+                      + ", ".join(f"{stage} {ms:.2f} ms" for stage, ms in stages_ms.items())
+                      + f", {results[-1]['samples_per_second']:.1f} samples/sec")
+
+    report = {
+        "commit": get_git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "device": device,
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "num_threads": torch.get_num_threads(),
+        "num_repeats": num_repeats,
+        "results": results
+    }
+    if output_path:
+        with open(output_path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results saved at {output_path}")
+    return report
+
+
+if __name__ == '__main__':
+    default_path = f"strategies_benchmark_{get_git_commit() or 'local'}.json"
+    run_benchmark(sys.argv[1] if len(sys.argv) > 1 else default_path,
+                  device="cuda:0" if torch.cuda.is_available() else "cpu")
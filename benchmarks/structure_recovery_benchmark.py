@@ -0,0 +1,76 @@
+import itertools
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import random_chain
+from utils.structure_utils import get_distogram, optimize_points_from_distograms, pairwise_distances, \
+    align_points, compute_rmsd
+
+NUM_CHAINS = 6
+CHAIN_LENGTH = 255
+# Standard deviation in angstroms of the symmetric noise added to the distograms, 0 recovering exact distograms
+NOISE_LEVELS = [0.0, 1.0]
+# Distances beyond which the distograms saturate, as those of binned predictions do, None keeping them all
+MAX_DISTANCES = [None, 20.0]
+N_INIT = 4
+MAX_ITER = 3000
+TOL = 1e-6
+
+
+def sklearn_mds(distogram, n_init, max_iter, tol, random_state):
+    from sklearn.manifold import MDS
+
+    try:
+        mds = MDS(n_components=3, metric="precomputed", init="random", n_init=n_init, max_iter=max_iter, eps=tol,
+                  random_state=random_state)
+    except TypeError:
+        # Versions before 1.8 take dissimilarity instead of metric and have no init argument
+        mds = MDS(n_components=3, dissimilarity="precomputed", n_init=n_init, max_iter=max_iter, eps=tol,
+                  random_state=random_state)
+    return mds.fit_transform(distogram)
+
+
+def score(points, distograms, chains):
+    # Raw stress against the distograms and RMSD to the chains, allowing the mirror image as the distograms do
+    stress = [np.sum((pairwise_distances(p) - d) ** 2) / 2 for p, d in zip(points, distograms)]
+    rmsd = [compute_rmsd(align_points(p, c, allow_reflection=True), c) for p, c in zip(points, chains)]
+    return float(np.mean(stress)), float(np.mean(rmsd))
+
+
+def run_benchmark(num_chains=NUM_CHAINS, chain_length=CHAIN_LENGTH, noise_levels=NOISE_LEVELS,
+                  max_distances=MAX_DISTANCES, n_init=N_INIT, max_iter=MAX_ITER, tol=TOL, seed=0):
+    """Time, stress and RMSD of optimize_points_from_distograms against sklearn's MDS at the same settings."""
+    rng = np.random.default_rng(seed)
+    chains = [random_chain(chain_length, rng)[1].astype("float64") for _ in range(num_chains)]
+    results = []
+    for max_distance, noise in itertools.product(max_distances, noise_levels):
+        distograms = []
+        for chain in chains:
+            noisy = get_distogram(chain) + rng.normal(scale=noise, size=(chain_length, chain_length))
+            noisy = np.abs(noisy + noisy.T) / 2
+            np.fill_diagonal(noisy, 0)
+            distograms.append(noisy if max_distance is None else np.minimum(noisy, max_distance))
+
+        start_time = time.perf_counter()
+        sklearn_points = [sklearn_mds(d, n_init, max_iter, tol, seed) for d in distograms]
+        sklearn_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        points = optimize_points_from_distograms(distograms, n_init=n_init, max_iter=max_iter, tol=tol,
+                                                 random_state=seed)
+        smacof_time = time.perf_counter() - start_time
+
+        sklearn_stress, sklearn_rmsd = score(sklearn_points, distograms, chains)
+        stress, rmsd = score(points, distograms, chains)
+        results.append({"max_distance": max_distance, "noise": noise, "sklearn_seconds": sklearn_time,
+                        "seconds": smacof_time, "speedup": sklearn_time / smacof_time, "sklearn_stress": sklearn_stress,
+                        "stress": stress, "sklearn_rmsd": sklearn_rmsd, "rmsd": rmsd})
+        print(f"max distance {max_distance}, noise {noise:g}: sklearn {sklearn_time:.2f} s, "
+              f"stress {sklearn_stress:.1f}, RMSD {sklearn_rmsd:.2f}; batched SMACOF {smacof_time:.2f} s, "
+              f"stress {stress:.1f}, RMSD {rmsd:.2f}; {results[-1]['speedup']:.1f}x")
+    return results
+
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -0,0 +1,94 @@
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+from constants import AMINO_ACIDS, MIN_SIZE, MAX_SIZE
+from utils.binary_shards import write_binary_shard
+
+
+# Virtual CA bond angle and dihedral, in degrees, of helices and strands, and the range of both in coils
+HELIX_GEOMETRY = (91.0, 50.0)
+STRAND_GEOMETRY = (120.0, -170.0)
+COIL_ANGLES = (85.0, 150.0)
+# (probability, min length, max length) of the secondary structure segments
+SEGMENTS = {"helix": (0.4, 8, 20), "strand": (0.25, 4, 10), "coil": (0.35, 2, 8)}
+# PDB chain lengths are roughly log-normal around a median of about 200 residues
+MEDIAN_LENGTH = 200
+LENGTH_SIGMA = 0.7
+CA_BOND_LENGTH = 3.8
+
+
+def sample_chain_lengths(num_chains, rng, min_length=MIN_SIZE, max_length=MAX_SIZE):
+    lengths = np.rint(rng.lognormal(np.log(MEDIAN_LENGTH), LENGTH_SIGMA, size=num_chains))
+    return np.clip(lengths, min_length, max_length).astype(int)
+
+
+def get_segment_geometry(length, rng):
+    """Bond angle and dihedral before every residue, from a random sequence of helix, strand and coil segments."""
+    names = list(SEGMENTS)
+    probabilities = [SEGMENTS[name][0] for name in names]
+    angles, dihedrals = [], []
+    while len(angles) < length:
+        name = names[rng.choice(len(names), p=probabilities)]
+        _, min_segment, max_segment = SEGMENTS[name]
+        segment = int(rng.integers(min_segment, max_segment + 1))
+        if name == "coil":
+            angles.extend(rng.uniform(*COIL_ANGLES, size=segment))
+            dihedrals.extend(rng.uniform(-180.0, 180.0, size=segment))
+        else:
+            angle, dihedral = HELIX_GEOMETRY if name == "helix" else STRAND_GEOMETRY
+            angles.extend(angle + rng.normal(0, 5, size=segment))
+            dihedrals.extend(dihedral + rng.normal(0, 10, size=segment))
+    return np.radians(angles[:length]), np.radians(dihedrals[:length])
+
+
+def random_ca_trace(length, rng):
+    # Residues placed one at a time from the previous three (NeRF) with a 3.8 Angstrom virtual bond, so that
+    # helices and strands get the CA distances and local contacts of real chains. Plain floats, as numpy calls on
+    # 3-vectors cost more than the arithmetic.
+    angles, dihedrals = get_segment_geometry(length, rng)
+    bond_x = (-CA_BOND_LENGTH * np.cos(angles)).tolist()
+    bond_y = (CA_BOND_LENGTH * np.sin(angles) * np.cos(dihedrals)).tolist()
+    bond_z = (CA_BOND_LENGTH * np.sin(angles) * np.sin(dihedrals)).tolist()
+    coords = [(0.0, 0.0, 0.0), (CA_BOND_LENGTH, 0.0, 0.0),
+              (CA_BOND_LENGTH + bond_x[2 % length], CA_BOND_LENGTH * math.sin(angles[2 % length]), 0.0)]
+    for idx in range(3, length):
+        (ax, ay, az), (bx, by, bz), (cx, cy, cz) = coords[-3:]
+        ux, uy, uz = cx - bx, cy - by, cz - bz
+        norm = math.sqrt(ux * ux + uy * uy + uz * uz)
+        ux, uy, uz = ux / norm, uy / norm, uz / norm
+        vx, vy, vz = bx - ax, by - ay, bz - az
+        nx, ny, nz = vy * uz - vz * uy, vz * ux - vx * uz, vx * uy - vy * ux
+        norm = math.sqrt(nx * nx + ny * ny + nz * nz)
+        nx, ny, nz = nx / norm, ny / norm, nz / norm
+        mx, my, mz = ny * uz - nz * uy, nz * ux - nx * uz, nx * uy - ny * ux
+        x, y, z = bond_x[idx], bond_y[idx], bond_z[idx]
+        coords.append((cx + x * ux + y * mx + z * nx, cy + x * uy + y * my + z * ny, cz + x * uz + y * mz + z * nz))
+    return np.array(coords[:length], dtype="float32").reshape(length, 3)
+
+
+def random_chain(length, rng):
+    return ''.join(rng.choice(list(AMINO_ACIDS), size=length)), random_ca_trace(length, rng)
+
+
+def random_rows(num_chains, rng, min_length=MIN_SIZE, max_length=MAX_SIZE, prefix=""):
+    """Rows of random chains as the PDB extraction writes them, with realistic lengths."""
+    rows = []
+    for chain_idx, length in enumerate(sample_chain_lengths(num_chains, rng, min_length, max_length)):
+        sequence, coords = random_chain(int(length), rng)
+        rows.append({"pdb_id": f"{prefix}{chain_idx:05d}", "chain_id": "A", "sequence": sequence, "coords": coords})
+    return rows
+
+
+def write_synthetic_shards(directory, num_shards=4, chains_per_shard=256, min_length=MIN_SIZE, max_length=MAX_SIZE,
+                           seed=0):
+    """Binary shards of random chains, laid out like the output of the PDB extraction."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    prefixes = []
+    for shard_idx in range(num_shards):
+        rows = random_rows(chains_per_shard, rng, min_length, max_length, prefix=f"{shard_idx:03d}")
+        prefixes.append(write_binary_shard(pd.DataFrame(rows), os.path.join(directory, f"pdb_df_{shard_idx}")))
+    return prefixes
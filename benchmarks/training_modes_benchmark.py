@@ -0,0 +1,42 @@
+import tempfile
+
+import torch
+
+from benchmarks.synthetic import write_synthetic_shards
+from strategies.contact_map_to_sequence import ContactMapToSequence
+from trainer import Trainer
+
+# (name, Trainer keyword arguments)
+TRAINING_MODES = [
+    ("fp32", {}),
+    ("bf16", {"precision": "bf16"}),
+    ("fp16", {"precision": "fp16"}),
+    ("accumulate_4", {"accumulation_steps": 4}),
+    ("compiled", {"compile_model": True}),
+]
+NUM_WARMUP_BATCHES = 3
+
+
+def run_benchmark(device="cpu", num_batches=20, batch_size=32, modes=TRAINING_MODES):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        write_synthetic_shards(directory, num_shards=2, chains_per_shard=(num_batches + NUM_WARMUP_BATCHES) * batch_size)
+        for name, kwargs in modes:
+            torch.manual_seed(0)
+            trainer = Trainer(directory, ContactMapToSequence(), batch_size=batch_size, test_size=0.5, device=device,
+                              log_interval=num_batches, **kwargs)
+            # The first batches include compilation and allocator warm up
+            trainer.train_epoch(0, max_batches=NUM_WARMUP_BATCHES)
+            stats = trainer.train_epoch(1, max_batches=num_batches)
+            stats["mode"] = name
+            results.append(stats)
+
+    baseline = results[0]["samples_per_second"]
+    for stats in results:
+        print(f"{stats['mode']}: {stats['samples_per_second']:.1f} samples/sec "
+              f"({stats['samples_per_second'] / baseline:.2f}x), loss {stats['loss']:.4f}")
+    return results
+
+
+if __name__ == '__main__':
+    run_benchmark(device="cuda:0" if torch.cuda.is_available() else "cpu")
@@ -8,7 +8,13 @@ AMINO_ACID_TO_INDEX = {aa: i + 1 for i, aa in enumerate(AMINO_ACIDS)}  # 1-index
 
 MIN_SIZE = 3
 MAX_TRAINING_SIZE = 50
+# Largest graph for which ContactMapToSequence runs its GAT layers as dense attention instead of message passing,
+# above it the (batch, heads, nodes, nodes) attention scores grow too large
+DENSE_GAT_MAX_NODES = 128
 MAX_SIZE = 750
 BATCH_SIZE = 32
+NUM_WORKERS = 4
+SHUFFLE_BUFFER_SIZE = 10000
+CLUSTER_IDENTITY = 0.9
 
 DECAY_RATE = 0.25
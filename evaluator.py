@@ -1,21 +1,33 @@
-import pandas as pd
+import argparse
+import os
+
 import torch
 
-from strategies.contact_map_to_sequence import ContactMapToSequence
-from strategies.sequence_to_distogram import SequenceToDistogram
+from constants import MAIN_DIR
+from predict import STRATEGIES, iter_input_rows, load_strategy
 
 if __name__ == '__main__':
-    strategy = ContactMapToSequence()
-
-    model_path = r"C:\Users\RoyIlani\Desktop\proteins\models\ContactMapToSequence\20241005\best_model.pth"
-    state_dict = torch.load(model_path)
-    strategy.load_state_dict(state_dict)
-    strategy.eval()
+    parser = argparse.ArgumentParser(description="Evaluate a trained strategy on a single chain.")
+    parser.add_argument("--strategy", choices=list(STRATEGIES), default="contact_map_to_sequence")
+    parser.add_argument("--model-path",
+                        default=os.path.join(MAIN_DIR, "models", "ContactMapToSequence", "20241005", "best_model.pth"))
+    parser.add_argument("--input", default=os.path.join(MAIN_DIR, "pdb_data_130000", "manifest.npz"),
+                        help="dataset manifest (.npz) or structure file holding the chain")
+    parser.add_argument("--pdb-id", default="5P2T")
+    parser.add_argument("--chain-id", default="A")
+    parser.add_argument("--verbose", action="store_true", help="print the prediction of every residue")
+    args = parser.parse_args()
 
-    data_path = r"C:\Users\RoyIlani\Desktop\proteins\pdb_data_130000\pdb_df_9.json"
-    pdb_df = pd.read_json(data_path, lines=True)
-    pdb_id = "5P2T"
-    chain_id = "A"
-    data = pdb_df.loc[(pdb_df['pdb_id'] == pdb_id) & (pdb_df['chain_id'] == chain_id)].iloc[0]
+    strategy = load_strategy(args.strategy, args.model_path, "cuda:0" if torch.cuda.is_available() else "cpu")
+    data = next((row for row in iter_input_rows([args.input])
+                 if str(row["pdb_id"]).upper() == args.pdb_id.upper() and row["chain_id"] == args.chain_id), None)
+    if data is None:
+        raise ValueError(f"Chain {args.pdb_id} {args.chain_id} not found in {args.input}")
 
-    strategy.evaluate(data)
+    results = strategy.evaluate(data)
+    if results is not None:
+        if args.verbose:
+            for position, real_value, predicted_value in zip(results["positions"], results["ground_truth"],
+                                                             results["predictions"]):
+                print(f"position {position}, real values: {real_value}, predicted values: {predicted_value}")
+        print(f"Recovery rate: {results['recovery_rate']:.4f}")
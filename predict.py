@@ -0,0 +1,259 @@
+import argparse
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Empty, Queue
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import torch
+
+from constants import BATCH_SIZE, MAX_SIZE, MIN_SIZE
+from strategies.registry import STRATEGIES, create_strategy
+from trainer import load_shard_rows
+from utils.dataset_manifest import DatasetManifest
+from utils.pdb_scanner import scan_ca_chains
+
+STRUCTURE_EXTENSIONS = ('.ent', '.pdb', '.cif', '.ent.gz', '.pdb.gz', '.cif.gz')
+PREDICTION_SCHEMAS = {
+    "contact_map_to_sequence": pa.schema([
+        ('pdb_id', pa.string()),
+        ('chain_id', pa.string()),
+        ('length', pa.int32()),
+        ('predicted_sequence', pa.string()),
+        ('recovery_rate', pa.float32()),
+        ('probabilities', pa.list_(pa.float32())),
+    ]),
+    "sequence_to_distogram": pa.schema([
+        ('pdb_id', pa.string()),
+        ('chain_id', pa.string()),
+        ('length', pa.int32()),
+        ('distogram', pa.list_(pa.float32())),
+    ]),
+}
+
+
+def load_strategy(name, model_path=None, device="cpu"):
+    strategy = create_strategy(name)
+    if model_path:
+        strategy.load_state_dict(torch.load(model_path, map_location=device))
+    return strategy.to(device).eval()
+
+
+def get_structure_pdb_id(path):
+    # pdb1abc.ent -> 1ABC, the layout of the PDB mirror and of download_pdb
+    name = os.path.basename(path).split('.')[0]
+    if name.startswith('pdb') and len(name) == 7:
+        name = name[3:]
+    return name.upper()
+
+
+def iter_manifest_rows(manifest_path, min_size=MIN_SIZE, max_size=MAX_SIZE):
+    manifest = DatasetManifest(manifest_path).load()
+    for path, rows in manifest.get_row_selections(manifest.shard_paths, manifest.get_mask(min_size, max_size)).items():
+        yield from load_shard_rows(path, rows)
+
+
+def iter_structure_rows(paths, first_model_only=True):
+    for path in paths:
+        chain_ids, sequences, coords, _ = scan_ca_chains(path, first_model_only)
+        for chain_id, sequence, chain_coords in zip(chain_ids, sequences, coords):
+            yield {"pdb_id": get_structure_pdb_id(path), "chain_id": chain_id, "sequence": sequence,
+                   "coords": np.asarray(chain_coords, dtype="float32").reshape(-1, 3)}
+
+
+def iter_input_rows(inputs, min_size=MIN_SIZE, max_size=MAX_SIZE):
+    """Chains of dataset manifests (.npz) and of structure files, given as files or directories of them."""
+    structure_paths = []
+    for path in inputs:
+        if path.endswith('.npz'):
+            yield from iter_manifest_rows(path, min_size, max_size)
+        elif os.path.isdir(path):
+            structure_paths.extend(os.path.join(path, fname) for fname in sorted(os.listdir(path))
+                                   if fname.endswith(STRUCTURE_EXTENSIONS))
+        else:
+            structure_paths.append(path)
+    for row in iter_structure_rows(structure_paths):
+        if min_size <= len(row["sequence"]) <= max_size:
+            yield row
+
+
+def predict_rows(strategy, rows, batch_size=BATCH_SIZE, include_probabilities=False):
+    """One prediction record per chain, laid out as in PREDICTION_SCHEMAS."""
+    if hasattr(strategy, "predict_chains"):
+        records = []
+        for data, result in zip(rows, strategy.predict_chains(rows, batch_size)):
+            # Positions before MIN_SIZE have no window to predict them from
+            predicted_sequence = "-" * min(MIN_SIZE, len(data["sequence"])) + "".join(result["predictions"])
+            records.append({"pdb_id": data.get("pdb_id"), "chain_id": data.get("chain_id"),
+                            "length": len(data["sequence"]), "predicted_sequence": predicted_sequence,
+                            "recovery_rate": result["recovery_rate"],
+                            "probabilities": result["probabilities"].ravel().tolist()
+                            if include_probabilities else None})
+        return records
+
+    distograms = strategy.predict_distograms([data["sequence"] for data in rows], batch_size=batch_size)
+    return [{"pdb_id": data.get("pdb_id"), "chain_id": data.get("chain_id"), "length": len(data["sequence"]),
+             "distogram": distogram.astype("float32").ravel().tolist()} for data, distogram in zip(rows, distograms)]
+
+
+def write_predictions(strategy_name, strategy, rows, output_path, batch_size=BATCH_SIZE, chunk_size=256,
+                      include_probabilities=False):
+    """Stream rows through the strategy chunk_size chains at a time, one Parquet row group per chunk."""
+    schema = PREDICTION_SCHEMAS[strategy_name]
+    rows = iter(rows)
+    num_chains = 0
+    start_time = time.perf_counter()
+    with pq.ParquetWriter(output_path, schema) as writer:
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            records = predict_rows(strategy, chunk, batch_size, include_probabilities)
+            writer.write_table(pa.Table.from_pylist(records, schema=schema))
+            num_chains += len(chunk)
+            print(f"Predicted {num_chains} chains, {num_chains / (time.perf_counter() - start_time):.1f} chains/sec")
+    print(f"Predictions saved at {output_path}")
+    return num_chains
+
+
+class MicroBatcher:
+    """Merges requests from concurrent threads into batches for one model.
+
+    A batch is closed when it holds max_batch_size requests or max_wait seconds after its first request arrived,
+    and runs on a single worker thread, so the model is only ever called from one thread.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=32, max_wait=0.01):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self.queue.put((item, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except Empty:
+                    break
+            items, futures = zip(*batch)
+            try:
+                results = self.predict_fn(list(items))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+
+def parse_request_row(payload, needs_coords):
+    sequence = payload.get("sequence")
+    if not isinstance(sequence, str) or not MIN_SIZE <= len(sequence) <= MAX_SIZE:
+        raise ValueError(f"sequence must be a string of {MIN_SIZE} to {MAX_SIZE} residues")
+    row = {"pdb_id": payload.get("pdb_id"), "chain_id": payload.get("chain_id"), "sequence": sequence}
+    if needs_coords:
+        coords = np.asarray(payload.get("coords", []), dtype="float32")
+        if coords.shape != (len(sequence), 3):
+            raise ValueError("coords must hold one [x, y, z] CA position per residue")
+        row["coords"] = coords
+    return row
+
+
+def make_request_handler(batcher, needs_coords, timeout=60):
+    class PredictionRequestHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self.send_json(200, {"status": "ok"})
+            else:
+                self.send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self.send_json(404, {"error": "not found"})
+                return
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                row = parse_request_row(payload, needs_coords)
+            except (ValueError, TypeError, AttributeError) as e:
+                self.send_json(400, {"error": str(e)})
+                return
+            try:
+                self.send_json(200, batcher.submit(row).result(timeout=timeout))
+            except Exception as e:
+                self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+        def log_message(self, format, *args):
+            pass
+
+    return PredictionRequestHandler
+
+
+def make_server(strategy, host="127.0.0.1", port=8000, batch_size=BATCH_SIZE, max_batch_size=32, max_wait=0.01):
+    """HTTP server that answers POST /predict with the prediction record of one chain, from a warm model."""
+    batcher = MicroBatcher(lambda rows: predict_rows(strategy, rows, batch_size, include_probabilities=True),
+                           max_batch_size, max_wait)
+    handler = make_request_handler(batcher, needs_coords=hasattr(strategy, "predict_chains"))
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch prediction and a local prediction server.")
+    parser.add_argument("--strategy", choices=list(STRATEGIES), default="contact_map_to_sequence")
+    parser.add_argument("--model-path", help="state dict saved by the Trainer")
+    parser.add_argument("--device", default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch-size", type=int, default=256, help="windows or crops per forward pass")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    batch_parser = subparsers.add_parser("batch", help="predict chains and write them to a Parquet file")
+    batch_parser.add_argument("inputs", nargs="+", help="dataset manifests (.npz), structure files or directories")
+    batch_parser.add_argument("--output", default="predictions.parquet")
+    batch_parser.add_argument("--chunk-size", type=int, default=256, help="chains per Parquet row group")
+    batch_parser.add_argument("--probabilities", action="store_true", help="also write per-residue probabilities")
+
+    serve_parser = subparsers.add_parser("serve", help="serve POST /predict requests over HTTP")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument("--max-batch-size", type=int, default=32, help="requests merged into one batch")
+    serve_parser.add_argument("--max-wait-ms", type=float, default=10, help="wait for more requests after the first")
+    args = parser.parse_args(argv)
+
+    strategy = load_strategy(args.strategy, args.model_path, args.device)
+    if args.command == "batch":
+        write_predictions(args.strategy, strategy, iter_input_rows(args.inputs), args.output, args.batch_size,
+                          args.chunk_size, args.probabilities)
+    else:
+        server = make_server(strategy, args.host, args.port, args.batch_size, args.max_batch_size,
+                             args.max_wait_ms / 1000)
+        print(f"Serving {args.strategy} on http://{args.host}:{args.port}/predict")
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -18,10 +18,21 @@ class Base(nn.Module):
 
     @staticmethod
     def collate(batch):
-        input_tensors, ground_truth_list = zip(*batch)
-        input_tensors = torch.stack(input_tensors, dim=0)
+        # Inputs are tuples of tensors, e.g. (tokens, mask), each of them stacked over the batch
+        inputs_list, ground_truth_list = zip(*batch)
+        inputs = tuple(torch.stack(tensors, dim=0) for tensors in zip(*inputs_list))
         ground_truth = torch.stack(ground_truth_list, dim=0)
-        return input_tensors, ground_truth
+        return inputs, ground_truth
+
+    @staticmethod
+    def inputs_to_device(inputs, device, non_blocking=False):
+        # Collated inputs may hold plain values next to the tensors, such as the graph size of ContactMapToSequence
+        return tuple(x.to(device, non_blocking=non_blocking) if isinstance(x, torch.Tensor) else x for x in inputs)
+
+    @staticmethod
+    def get_num_tokens(sample):
+        inputs, _ = sample
+        return inputs[0].size(0)
 
     def load_inputs_and_ground_truth(self, data):
         raise NotImplementedError("Each strategy must implement this method.")
@@ -1,24 +1,26 @@
-import copy
+import itertools
 
 import numpy as np
-import scipy as sp
 import torch
 import torch.nn.functional as F
-import transformers
 from torch import nn
-from torch_geometric.nn import GATConv, GCNConv
-from torch_geometric.utils import from_scipy_sparse_matrix
+from torch_geometric.nn import GATConv
 
-from constants import AMINO_ACIDS, MAX_TRAINING_SIZE, BATCH_SIZE
+from constants import AMINO_ACIDS, MAX_TRAINING_SIZE, BATCH_SIZE, MIN_SIZE, DENSE_GAT_MAX_NODES
 from strategies.base import Base
-from utils.padding_functions import padd_sequence, padd_contact_map
-from utils.structure_utils import get_distogram, get_contact_map
+from utils.dense_gat import dense_gat_conv, get_attention_bias, get_dense_adjacency, get_local_index, \
+    to_dense_nodes
+from utils.padding_functions import tokenize_sequence
+from utils.structure_utils import get_contact_edge_index
 
 
 class ContactMapToSequence(Base):
 
-    def __init__(self):
+    def __init__(self, contact_cache=None, dense_max_nodes=DENSE_GAT_MAX_NODES):
         super(ContactMapToSequence, self).__init__()
+        self.contact_cache = contact_cache
+        # Batches whose graphs have at most this many nodes run the GAT layers as dense masked attention
+        self.dense_max_nodes = dense_max_nodes
         self.vocab_size = len(AMINO_ACIDS) + 1
         self.hidden_size = 180
         self.num_layers = 6
@@ -37,67 +39,60 @@ class ContactMapToSequence(Base):
             start, end = max(0, end-MAX_TRAINING_SIZE), end
         else:
             start, end = 0, MAX_TRAINING_SIZE
-        sequence = sequence[start: end]
-        sequence_tensor, mask_tensor = padd_sequence(sequence, MAX_TRAINING_SIZE)
-
-        # Get ground truth
-        ground_truth = copy.deepcopy(sequence_tensor[len(sequence) - 1]).to(torch.long)
-        ground_truth = F.one_hot(ground_truth, num_classes=self.vocab_size).float()
-
-        # Get inputs
-        input_tensor = F.one_hot(sequence_tensor.to(torch.long), num_classes=self.vocab_size)
-        input_tensor[len(sequence) - 1] = 0
-        input_tensor = input_tensor.to(torch.float32)
-
-        contact_map = get_contact_map(data["coords"])
-        contact_map = contact_map[start: end, start: end]
-        contact_map = padd_contact_map(contact_map, MAX_TRAINING_SIZE)
-        contact_map = sp.sparse.csr_matrix(contact_map)
-        edge_index, _ = from_scipy_sparse_matrix(contact_map)
-
-        return (input_tensor, edge_index, mask_tensor), ground_truth
+        edge_index = torch.from_numpy(self.get_edge_index(data, start, end))
+        return self.get_sample(sequence[start: end], edge_index)
+
+    def get_edge_index(self, data, start=0, end=None):
+        edge_index = None
+        if self.contact_cache is not None:
+            edge_index = self.contact_cache.get_edge_index(data["pdb_id"], data["chain_id"], start, end,
+                                                           coords=data["coords"])
+        if edge_index is None:
+            edge_index = get_contact_edge_index(data["coords"], start=start, end=end)
+        return edge_index
+
+    def get_sample(self, sequence, edge_index):
+        tokens = tokenize_sequence(sequence)
+        return (tokens, edge_index), tokens[len(sequence) - 1]
 
     @staticmethod
     def collate(batch):
+        # Concatenate the graphs without padding, PyG style: a node -> graph batch vector and per-graph node pointers.
+        # The size of the largest graph is passed as a plain int, so forward picks its GAT layers without a host sync
         inputs_list, ground_truth_list = zip(*batch)
-        input_tensors, edge_indices, mask_tensors = zip(*inputs_list)
-
-        input_tensors = torch.cat(input_tensors, dim=0)
-
-        edge_index_list = []
-        batch_offsets = []
-        total_nodes = 0
-        batch_index_tensor = []
-
-        for batch_idx, (edge_index, input_tensor) in enumerate(zip(edge_indices, input_tensors)):
-            batch_offset = total_nodes
-            batch_offsets.append(batch_offset)
-
-            adjusted_edge_index = edge_index + batch_offset
-            edge_index_list.append(adjusted_edge_index)
+        token_tensors, edge_indices = zip(*inputs_list)
 
-            num_nodes = input_tensor.size(0)
-            batch_index_tensor.append(torch.full((num_nodes,), batch_idx, dtype=torch.long))
+        num_nodes = torch.tensor([tokens.size(0) for tokens in token_tensors])
+        ptr = torch.zeros(len(token_tensors) + 1, dtype=torch.long)
+        torch.cumsum(num_nodes, dim=0, out=ptr[1:])
+        batch_index = torch.repeat_interleave(torch.arange(len(token_tensors)), num_nodes)
 
-            total_nodes += num_nodes
+        # Shift the nodes of every graph by its offset in the batch with one repeat_interleave
+        num_edges = torch.tensor([edge_index.size(1) for edge_index in edge_indices])
+        edge_index = torch.cat(edge_indices, dim=1) + torch.repeat_interleave(ptr[:-1], num_edges)
 
-        edge_index = torch.cat(edge_index_list, dim=1)
-        mask_tensors = torch.stack(mask_tensors, dim=0)
         ground_truth = torch.stack(ground_truth_list, dim=0)
-        batch_index_tensor = torch.cat(batch_index_tensor)
+        return (torch.cat(token_tensors, dim=0), edge_index, batch_index, ptr, int(num_nodes.max())), ground_truth
 
-        return (input_tensors, edge_index, mask_tensors), ground_truth
+    def featurize(self, tokens, ptr):
+        # One-hot node features with the residue to predict hidden, built on whichever device the tokens are on
+        x = F.one_hot(tokens, num_classes=self.vocab_size).to(torch.float32)
+        x[ptr[1:] - 1] = 0
+        return x
 
     def forward(self, inputs):
-        x, edge_index, mask_tensor = inputs
+        tokens, edge_index, batch_index, ptr = inputs[:4]
+        x = self.featurize(tokens, ptr)
 
-        for layer_idx, graph_layer in enumerate(self.graph_layers):
-            x = graph_layer(x=x, edge_index=edge_index)
-
-        x = x.view((mask_tensor.size(0), MAX_TRAINING_SIZE, self.hidden_size * self.num_heads))
-
-        last_indices = mask_tensor.argmin(dim=1) - 1
-        x = x[torch.arange(x.size(0)), last_indices]
+        # Without the graph size, as in the tensor-only inputs of a TorchScript trace, the sparse layers are used
+        max_nodes = inputs[4] if len(inputs) > 4 else 0
+        if 0 < max_nodes <= self.dense_max_nodes:
+            x = self.dense_graph_layers(x, edge_index, batch_index, ptr, max_nodes)
+        else:
+            for layer_idx, graph_layer in enumerate(self.graph_layers):
+                x = graph_layer(x=x, edge_index=edge_index)
+            # The residue to predict is the last node of each graph
+            x = x[ptr[1:] - 1]
 
         x = self.linear1(x)
         x = F.relu(x)
@@ -106,23 +101,66 @@ class ContactMapToSequence(Base):
         probabilities = F.softmax(x, dim=-1)
         return probabilities
 
+    def dense_graph_layers(self, x, edge_index, batch_index, ptr, max_nodes):
+        # The GAT layers over padded (B, max_nodes) graphs, returning the features of the last node of each graph
+        num_graphs = ptr.size(0) - 1
+        local_index = get_local_index(batch_index, ptr)
+        x = to_dense_nodes(x, batch_index, local_index, num_graphs, max_nodes)
+        adj = get_dense_adjacency(edge_index, batch_index, local_index, num_graphs, max_nodes)
+        attention_bias = get_attention_bias(adj, x.dtype)
+        for graph_layer in self.graph_layers:
+            x = dense_gat_conv(graph_layer, x, attention_bias)
+        return x[torch.arange(x.size(0), device=x.device), ptr[1:] - ptr[:-1] - 1]
+
     def compute_loss(self, outputs, ground_truth):
         return F.cross_entropy(outputs, ground_truth)
 
-    def evaluate(self, data):
-        ground_truth_sequence = data["sequence"]
-
-        for idx in range(3):
-            print("real values: " + str(ground_truth_sequence[idx]) + ", predicted values: " + str(
-                ground_truth_sequence[idx]))
-
-        for idx in range(3, len(ground_truth_sequence) - 1):
-            (x, edge_index, mask_tensor), _ = self.load_inputs_and_ground_truth(
-                data, idx + 1)
-
-            mask_tensor = mask_tensor.unsqueeze(0)
-            output = self.forward((x, edge_index, mask_tensor))
-            predicted_values = AMINO_ACIDS[torch.argmax(output).item() - 1]
-
-            print("real values: " + str(ground_truth_sequence[idx]) + ", predicted values: " + str(
-                predicted_values))
+    def get_window_samples(self, data):
+        # The window of up to MAX_TRAINING_SIZE residues ending at every position from MIN_SIZE on
+        sequence = data["sequence"]
+        edge_index = self.get_edge_index(data)
+        rows, cols = edge_index
+        for position in range(MIN_SIZE, len(sequence)):
+            start, end = max(0, position + 1 - MAX_TRAINING_SIZE), position + 1
+            in_window = (rows >= start) & (rows < end) & (cols >= start) & (cols < end)
+            window_edge_index = torch.from_numpy(edge_index[:, in_window] - start)
+            yield self.get_sample(sequence[start: end], window_edge_index)
+
+    def predict_chains(self, rows, batch_size=BATCH_SIZE):
+        """Results of evaluate for every chain of rows, with the windows of all chains sharing the forward batches."""
+        samples = itertools.chain.from_iterable(self.get_window_samples(data) for data in rows)
+        device = next(self.parameters()).device
+
+        probabilities = []
+        with torch.no_grad():
+            while True:
+                batch = list(itertools.islice(samples, batch_size))
+                if not batch:
+                    break
+                inputs, _ = self.collate(batch)
+                outputs = self.forward(self.inputs_to_device(inputs, device))
+                probabilities.append(outputs.cpu().numpy())
+        probabilities = np.concatenate(probabilities) if probabilities else np.zeros((0, self.vocab_size), "float32")
+
+        results = []
+        offset = 0
+        for data in rows:
+            sequence = data["sequence"]
+            positions = np.arange(MIN_SIZE, len(sequence))
+            chain_probabilities = probabilities[offset: offset + len(positions)]
+            offset += len(positions)
+            predictions = np.array(list("X" + AMINO_ACIDS))[chain_probabilities.argmax(axis=-1)]
+            ground_truth = np.array(list(sequence))[positions]
+            results.append({
+                "positions": positions,
+                "ground_truth": ground_truth,
+                "predictions": predictions,
+                "probabilities": chain_probabilities,
+                "recovery_rate": float((predictions == ground_truth).mean()) if len(positions) else float("nan")
+            })
+        return results
+
+    def evaluate(self, data, batch_size=BATCH_SIZE):
+        # Predict every position from MIN_SIZE on, each from the window of up to MAX_TRAINING_SIZE residues ending
+        # at it, scoring the windows as batched graphs instead of one forward pass per residue
+        return self.predict_chains([data], batch_size)[0]
@@ -0,0 +1,20 @@
+import importlib
+
+# Strategies by name, as module and class. A strategy module is only imported when it is selected, so its
+# dependencies are only loaded by the processes that use it: transformers for SequenceToDistogram, torch_geometric
+# for ContactMapToSequence, which itself imports transformers, pandas and pyarrow and dominates its cold start.
+STRATEGIES = {
+    "contact_map_to_sequence": ("strategies.contact_map_to_sequence", "ContactMapToSequence"),
+    "sequence_to_distogram": ("strategies.sequence_to_distogram", "SequenceToDistogram"),
+}
+
+
+def get_strategy_class(name):
+    if name not in STRATEGIES:
+        raise ValueError(f"Unknown strategy {name}, expected one of: {', '.join(STRATEGIES)}")
+    module_name, class_name = STRATEGIES[name]
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def create_strategy(name, **kwargs):
+    return get_strategy_class(name)(**kwargs)
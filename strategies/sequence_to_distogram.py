@@ -4,20 +4,23 @@ import torch.nn as nn
 import torch.nn.functional as F
 import transformers
 
-from constants import AMINO_ACIDS, MAX_TRAINING_SIZE
+from constants import AMINO_ACIDS, MAX_TRAINING_SIZE, BATCH_SIZE
 from strategies.base import Base
 from utils.padding_functions import padd_sequence, padd_contact_map
 from utils.structure_utils import get_distogram, plot_contact_map, optimize_points_from_distogram, align_points, \
-    plot_protein_atoms
+    plot_protein_atoms, stitch_distogram_crops, compute_rmsd, recover_structures
 from utils.utils import normalize
 
 
 class SequenceToDistogram(Base):
 
-    def __init__(self):
+    def __init__(self, pair_mode="factorized", pair_block_size=None, symmetric_pairs=False):
         super(SequenceToDistogram, self).__init__()
 
         self.hidden_size = 64
+        self.pair_mode = pair_mode
+        self.pair_block_size = pair_block_size
+        self.symmetric_pairs = symmetric_pairs
 
         config = transformers.RobertaConfig(
             vocab_size=len(AMINO_ACIDS) + 1,
@@ -68,11 +71,30 @@ class SequenceToDistogram(Base):
         return index_diff
 
     def forward(self, input):
-        x, mask = input
+        # An optional third input holds the chain positions of the tokens, used for |i - j| by the factorized head
+        x, mask = input[:2]
+        residue_index = input[2] if len(input) > 2 else None
 
         # x is of shape (batch_size, max_tokens, 1)
         x = self.transformer(x, attention_mask=mask).last_hidden_state  # Shape: (batch_size, max_tokens, hidden_size)
 
+        if self.pair_mode == "concat":
+            out = self.concat_pair_head(x)
+        else:
+            out = self.pair_head(x, block_size=self.pair_block_size, symmetric=self.symmetric_pairs,
+                                 residue_index=residue_index)
+
+        # Zero the diagonal and normalize
+        batch_size, max_tokens, _ = out.size()
+        diagonal_mask = (torch.ones(max_tokens, max_tokens, device=out.device)
+                         - torch.eye(max_tokens, device=out.device))
+        out = out * diagonal_mask.unsqueeze(0)  # Shape: (batch_size, max_tokens, max_tokens)
+        max_values, _ = torch.max(out.view(batch_size, -1), dim=-1, keepdim=True)
+        out = out / max_values.view(batch_size, 1, 1)
+
+        return out, mask
+
+    def concat_pair_head(self, x):
         batch_size, max_tokens, hidden_size = x.size()
         x_i = x.unsqueeze(2)  # Shape: (batch_size, max_tokens, 1, hidden_size)
         x_i_expanded = x_i.expand(batch_size, max_tokens, max_tokens,
@@ -90,16 +112,46 @@ class SequenceToDistogram(Base):
                                  dim=-1)  # Shape: (batch_size, max_tokens, max_tokens, 4 * hidden_size)
         concatenated = concatenated.view(batch_size * max_tokens * max_tokens, -1)
         out = self.mlp(concatenated)  # Shape: (batch_size * max_tokens * max_tokens, 1)
+        return out.view(batch_size, max_tokens, max_tokens)
 
-        # Zero the diagonal and normalize
-        out = out.view(batch_size, max_tokens, max_tokens)
-        diagonal_mask = (torch.ones(max_tokens, max_tokens, device=out.device)
-                         - torch.eye(max_tokens, device=out.device))
-        out = out * diagonal_mask.unsqueeze(0)  # Shape: (batch_size, max_tokens, max_tokens)
-        max_values, _ = torch.max(out.view(batch_size, -1), dim=-1, keepdim=True)
-        out = out / max_values.view(batch_size, 1, 1)
-
-        return out, mask
+    def pair_head(self, x, block_size=None, symmetric=False, residue_index=None):
+        # Same MLP as concat_pair_head without materializing its (batch_size, L, L, 4 * hidden_size + 1) input:
+        # the first layer splits into per-residue projections, (W_i + W_diff) x_i + (W_j - W_diff) x_j, that are
+        # broadcast-added per pair, plus the x_i * x_j and |i - j| terms computed one (i, j) block at a time
+        batch_size, max_tokens, hidden_size = x.size()
+        first_layer, remaining_layers = self.mlp[0], self.mlp[1:]
+        w_i, w_j, w_diff, w_mul, w_index = torch.split(first_layer.weight, [hidden_size] * 4 + [1], dim=1)
+        proj_i = F.linear(x, w_i + w_diff, first_layer.bias)  # Shape: (batch_size, max_tokens, mlp_size)
+        proj_j = F.linear(x, w_j - w_diff)  # Shape: (batch_size, max_tokens, mlp_size)
+        if residue_index is None:
+            residue_index = torch.arange(max_tokens, device=x.device).expand(batch_size, max_tokens)
+        residue_index = residue_index.float()
+
+        block_size = block_size or max_tokens
+        out = x.new_empty(batch_size, max_tokens, max_tokens)
+        for i_start in range(0, max_tokens, block_size):
+            i_end = min(i_start + block_size, max_tokens)
+            # With symmetric=True only blocks on or above the diagonal are computed and mirrored below it
+            for j_start in range(i_start if symmetric else 0, max_tokens, block_size):
+                j_end = min(j_start + block_size, max_tokens)
+                x_i, x_j = x[:, i_start:i_end], x[:, j_start:j_end]
+                block_i, block_j = i_end - i_start, j_end - j_start
+
+                # Bilinear x_i * x_j term as one matmul: (batch_size, block_i * mlp_size, hidden) @ (hidden, block_j)
+                multiplication = torch.matmul((x_i.unsqueeze(2) * w_mul).flatten(1, 2), x_j.transpose(1, 2))
+                multiplication = multiplication.view(batch_size, block_i, -1, block_j).transpose(2, 3)
+                index_diff = (residue_index[:, i_start:i_end, None] - residue_index[:, None, j_start:j_end]).abs()
+
+                hidden = (proj_i[:, i_start:i_end, None] + proj_j[:, None, j_start:j_end] + multiplication
+                          + index_diff.unsqueeze(-1) * w_index.squeeze(-1))
+                block = remaining_layers(hidden).squeeze(-1)  # Shape: (batch_size, block_i, block_j)
+
+                if symmetric and i_start == j_start:
+                    block = torch.triu(block) + torch.triu(block, diagonal=1).transpose(1, 2)
+                out[:, i_start:i_end, j_start:j_end] = block
+                if symmetric and i_start != j_start:
+                    out[:, j_start:j_end, i_start:i_end] = block.transpose(1, 2)
+        return out
 
     def compute_loss(self, outputs, ground_truth):
         prediction, mask = outputs
@@ -122,24 +174,72 @@ class SequenceToDistogram(Base):
 
         return average_loss
 
+    @staticmethod
+    def get_crops(seq_len, window=MAX_TRAINING_SIZE):
+        # Contiguous windows with a half-window stride cover every pair closer than half a window. Pairs further
+        # apart are covered by crops made of two half windows, with their true distance along the chain given to
+        # the pair head through the residue index
+        if seq_len <= window:
+            return [np.arange(seq_len)]
+        half = window // 2
+        window_starts = list(range(0, seq_len - window, half)) + [seq_len - window]
+        crops = [np.arange(start, start + window) for start in window_starts]
+
+        segment_starts = list(range(0, seq_len - half, half)) + [seq_len - half]
+        for idx, first in enumerate(segment_starts):
+            for second in segment_starts[idx + 1:]:
+                if not any(start <= first and second + half <= start + window for start in window_starts):
+                    crops.append(np.concatenate([np.arange(first, first + half), np.arange(second, second + half)]))
+        return crops
+
+    def predict_distograms(self, sequences, batch_size=BATCH_SIZE, window=MAX_TRAINING_SIZE):
+        # Runs the crops of all chains through batched forward passes and stitches them back per chain
+        crops = [(chain_idx, crop) for chain_idx, sequence in enumerate(sequences)
+                 for crop in self.get_crops(len(sequence), window)]
+        device = next(self.parameters()).device
+        chain_crops = [[] for _ in sequences]
+        with torch.no_grad():
+            for batch_start in range(0, len(crops), batch_size):
+                x_tensors, mask_tensors, residue_indices = [], [], []
+                for chain_idx, crop in crops[batch_start: batch_start + batch_size]:
+                    x_tensor, mask_tensor = padd_sequence(''.join(sequences[chain_idx][idx] for idx in crop), window)
+                    residue_index = torch.zeros(window, dtype=torch.long)
+                    residue_index[:len(crop)] = torch.from_numpy(crop)
+                    x_tensors.append(x_tensor)
+                    mask_tensors.append(mask_tensor)
+                    residue_indices.append(residue_index)
+
+                inputs = (torch.stack(x_tensors), torch.stack(mask_tensors), torch.stack(residue_indices))
+                out, _ = self.forward(tuple(x.to(device) for x in inputs))
+                out = out.cpu().numpy()
+                for (chain_idx, crop), prediction in zip(crops[batch_start: batch_start + batch_size], out):
+                    chain_crops[chain_idx].append((crop, prediction[:len(crop), :len(crop)]))
+
+        return [stitch_distogram_crops(len(sequence), *zip(*sequence_crops))
+                for sequence, sequence_crops in zip(sequences, chain_crops)]
+
     def evaluate(self, data):
-        ground_truth_coords = np.array(data["coords"], dtype="float16")[:MAX_TRAINING_SIZE]
-        seq_len = len(data["sequence"])
-        (x_tensor, mask_tensor), ground_truth_distogram = self.load_inputs_and_ground_truth(
-            data, normalize_distogram=False)
-        ground_truth_distogram = ground_truth_distogram[: MAX_TRAINING_SIZE, :MAX_TRAINING_SIZE]
-
-        # Get model prediction
-        predicted_distogram = self.forward((x_tensor.unsqueeze(0), mask_tensor.unsqueeze(0)))[0]
-        predicted_distogram = predicted_distogram.squeeze().detach().numpy()
-        predicted_distogram = predicted_distogram[: seq_len, :seq_len]
-        predicted_distogram = (predicted_distogram + predicted_distogram.T) / 2
-        predicted_distogram *= ground_truth_distogram.max().numpy()
+        ground_truth_coords = np.array(data["coords"], dtype="float32")
+        ground_truth_distogram = get_distogram(ground_truth_coords)
+
+        # Get model prediction for the full chain, in the units of the ground truth
+        predicted_distogram = self.predict_distograms([data["sequence"]])[0]
+        predicted_distogram *= ground_truth_distogram.max() / predicted_distogram.max()
 
         # Plot the predicted distogram and the ground truth distogram
         plot_contact_map(predicted_distogram, ground_truth_distogram)
 
         # Plot the aligned predicted coordinates with the ground truth coordinates
         predicted_coords = optimize_points_from_distogram(predicted_distogram)
-        aligned_predicted_coords = align_points(predicted_coords, ground_truth_coords)
+        aligned_predicted_coords = align_points(predicted_coords, ground_truth_coords, allow_reflection=True)
+        print(f"RMSD: {compute_rmsd(aligned_predicted_coords, ground_truth_coords):.4f}")
         plot_protein_atoms(aligned_predicted_coords, ground_truth_coords)
+
+    def evaluate_structures(self, rows, batch_size=BATCH_SIZE, **kwargs):
+        # Structure recovery RMSD for a batch of chains, predicted distograms being rescaled to the ground truth
+        ground_truth_coords = [np.array(data["coords"], dtype="float32") for data in rows]
+        predicted_distograms = self.predict_distograms([data["sequence"] for data in rows], batch_size=batch_size)
+        for predicted_distogram, coords in zip(predicted_distograms, ground_truth_coords):
+            predicted_distogram *= get_distogram(coords).max() / predicted_distogram.max()
+        _, rmsds = recover_structures(predicted_distograms, ground_truth_coords, **kwargs)
+        return np.array(rmsds)
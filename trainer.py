@@ -1,42 +1,232 @@
+import argparse
+import itertools
+import math
 import os
+import random
 import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime
 
-import pandas as pd
 import torch
-from sklearn.model_selection import train_test_split
-from torch.utils.data import DataLoader, Dataset
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
 
-from constants import MIN_SIZE, MAIN_DIR, AMINO_ACIDS, MAX_SIZE, NUM_SAMPLES_IN_DATAFRAME, BATCH_SIZE
-from strategies.contact_map_to_sequence import ContactMapToSequence
-from strategies.sequence_to_distogram import SequenceToDistogram
+from constants import MIN_SIZE, MAIN_DIR, AMINO_ACIDS, MAX_SIZE, BATCH_SIZE, NUM_WORKERS, \
+    SHUFFLE_BUFFER_SIZE, CLUSTER_IDENTITY
+from strategies.registry import STRATEGIES, create_strategy
+from utils.binary_shards import BinaryShard, is_binary_shard, list_shards, read_json_shard
+from utils.contact_cache import ContactGraphCache
+from utils.checkpointing import AsyncCheckpointer, get_rng_states, latest_checkpoint, set_rng_states
+from utils.dataset_manifest import DatasetManifest
+from utils.instrumentation import NullInstrumentation
+from utils.distributed import all_gather_objects, all_reduce_min, all_reduce_sum, average_gradients, get_rank, \
+    get_world_size, init_distributed, is_distributed, is_main_process, main_process_first, cleanup_distributed
+from utils.sequence_clustering import cluster_manifest, sample_cluster_representatives, split_clusters
 
 
-class CustomDataset(Dataset):
-    def __init__(self, dataframe, strategy):
-        self.dataframe = dataframe
+def load_shard_rows(file_path, rows=None):
+    # rows are the chains selected through the dataset manifest, without them the shard is filtered here
+    if is_binary_shard(file_path):
+        shard = BinaryShard(file_path)
+        if rows is None:
+            lengths = shard.lengths
+            rows = ((lengths >= MIN_SIZE) & (lengths <= MAX_SIZE) & shard.valid_alphabet()).nonzero()[0]
+        return [shard[idx] for idx in rows]
+
+    dataframe = read_json_shard(file_path)
+    if rows is not None:
+        return dataframe.iloc[rows].to_dict('records')
+    dataframe = dataframe[dataframe['sequence'].apply(lambda seq: len(seq) >= MIN_SIZE)]
+    dataframe = dataframe[dataframe['sequence'].apply(lambda seq: len(seq) <= MAX_SIZE)]
+    dataframe = dataframe[dataframe['sequence'].apply(lambda seq: all(char in AMINO_ACIDS for char in seq))]
+    return dataframe.to_dict('records')
+
+
+def split_files(file_paths, test_size):
+    # The last files are held out, test_size being a fraction or a number of files as in sklearn's train_test_split
+    num_test = test_size if isinstance(test_size, int) else math.ceil(test_size * len(file_paths))
+    num_train = len(file_paths) - num_test
+    return file_paths[:num_train], file_paths[num_train:]
+
+
+class ShardStreamDataset(IterableDataset):
+    """Streams collated batches from a list of shards.
+
+    Shards are split across DataLoader workers, the next shard of each worker is parsed by a background thread while
+    the current one is consumed, and rows are mixed across shard boundaries through a bounded shuffle buffer.
+    """
+
+    def __init__(self, file_paths, strategy, batch_size, shuffle=False, shuffle_buffer_size=0, seed=42,
+                 max_tokens=None, row_selections=None, rank=0, world_size=1, record_stages=False,
+                 track_positions=False, start_positions=None):
+        self.file_paths = list(file_paths)
+        # With record_stages or track_positions every batch carries a third element, a dict with the seconds of its
+        # loading stages and its residues, or with the worker that produced it and the samples it has produced so far
+        self.record_stages = record_stages
+        self.track_positions = track_positions
+        # Samples already produced by each worker (by global worker id) in this epoch, skipped when resuming
+        self.start_positions = start_positions or {}
+        self.rank = rank
+        self.world_size = world_size
+        self.row_selections = row_selections
         self.strategy = strategy
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    @staticmethod
+    def get_worker_ids():
+        worker_info = get_worker_info()
+        return (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+
+    def get_global_worker_id(self, worker_id, num_workers):
+        return self.rank * num_workers + worker_id
 
-    def __len__(self):
-        return len(self.dataframe)
+    def get_worker_files(self, worker_id=None, num_workers=None):
+        if worker_id is None:
+            worker_id, num_workers = self.get_worker_ids()
 
-    def __getitem__(self, idx):
-        row = self.dataframe.iloc[idx]
-        inputs, ground_truth = self.strategy.load_inputs_and_ground_truth(row)
-        return inputs, ground_truth
+        # Every worker of every rank shuffles the full list with the same seed before taking its own slice
+        file_paths = list(self.file_paths)
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(file_paths)
+        global_worker_id = self.get_global_worker_id(worker_id, num_workers)
+        rng = random.Random(f"{self.seed}-{self.epoch}-{global_worker_id}")
+        return file_paths[global_worker_id::self.world_size * num_workers], rng
 
-    def collate_fn(self, batch):
-        return self.strategy.collate(batch)
+    def get_num_batches(self, num_workers=1):
+        """Exact number of batches of this rank in the current epoch, known for fixed-size batches of manifest rows."""
+        if self.row_selections is None or self.max_tokens:
+            return None
+        num_workers = max(num_workers, 1)
+        num_batches = 0
+        for worker_id in range(num_workers):
+            file_paths, _ = self.get_worker_files(worker_id, num_workers)
+            num_rows = sum(len(self.row_selections[path]) for path in file_paths)
+            num_batches += -(-num_rows // self.batch_size)
+        return num_batches
+
+    @staticmethod
+    def iter_prefetched_rows(file_paths, rng=None, row_selections=None, stage_times=None):
+        if not file_paths:
+            return
+
+        def load(path):
+            start_time = time.perf_counter()
+            rows = load_shard_rows(path, None if row_selections is None else row_selections[path])
+            return rows, time.perf_counter() - start_time
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(load, file_paths[0])
+            for next_path in file_paths[1:] + [None]:
+                rows, seconds = future.result()
+                # Parsing runs in the background, its time is charged to the batch that takes the first rows
+                if stage_times is not None:
+                    stage_times["parse"] += seconds
+                if next_path is not None:
+                    future = executor.submit(load, next_path)
+                if rng is not None:
+                    rng.shuffle(rows)
+                yield from rows
+
+    def skip_shards(self, file_paths, num_rows, rng):
+        # Shards fully consumed before a resume are not parsed again, shuffling a placeholder of the same length
+        # draws the same random numbers as shuffling their rows and keeps rng in step
+        while file_paths and num_rows >= len(self.row_selections[file_paths[0]]):
+            shard_rows = len(self.row_selections[file_paths[0]])
+            if self.shuffle:
+                rng.shuffle(list(range(shard_rows)))
+            num_rows -= shard_rows
+            file_paths = file_paths[1:]
+        return file_paths, num_rows
+
+    def iter_shuffled(self, rows, rng):
+        buffer = []
+        for row in rows:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(row)
+                continue
+            idx = rng.randrange(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = row
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        worker_id, num_workers = self.get_worker_ids()
+        file_paths, rng = self.get_worker_files(worker_id, num_workers)
+        global_worker_id = self.get_global_worker_id(worker_id, num_workers)
+        # Seconds of the loading stages since the last batch, sent along with every batch when recording
+        stage_times = {"parse": 0.0, "featurize": 0.0, "collate": 0.0} if self.record_stages else None
+        position = skip = self.start_positions.get(global_worker_id, 0)
+        buffered = self.shuffle and self.shuffle_buffer_size > 0
+        if skip and not buffered and self.row_selections is not None:
+            file_paths, skip = self.skip_shards(file_paths, skip, rng)
+        rows = self.iter_prefetched_rows(file_paths, rng if self.shuffle else None, self.row_selections, stage_times)
+        if buffered:
+            rows = self.iter_shuffled(rows, rng)
+        if skip:
+            # The same rows come out in the same order as before the interruption, the consumed ones are dropped
+            # before they are featurized
+            rows = itertools.islice(rows, skip, None)
+
+        # Batches hold batch_size samples, or as many samples as fit in max_tokens nodes when a budget is set
+        batch, batch_tokens = [], 0
+        for row in rows:
+            start_time = time.perf_counter()
+            sample = self.strategy.load_inputs_and_ground_truth(row)
+            num_tokens = self.strategy.get_num_tokens(sample)
+            if stage_times is not None:
+                stage_times["featurize"] += time.perf_counter() - start_time
+            if batch and self.max_tokens and batch_tokens + num_tokens > self.max_tokens:
+                position += len(batch)
+                yield self.collate(batch, batch_tokens, stage_times, global_worker_id, position)
+                batch, batch_tokens = [], 0
+            batch.append(sample)
+            batch_tokens += num_tokens
+            if not self.max_tokens and len(batch) == self.batch_size:
+                position += len(batch)
+                yield self.collate(batch, batch_tokens, stage_times, global_worker_id, position)
+                batch, batch_tokens = [], 0
+        if batch:
+            position += len(batch)
+            yield self.collate(batch, batch_tokens, stage_times, global_worker_id, position)
+
+    def collate(self, batch, num_tokens, stage_times, worker_id, position):
+        if stage_times is None and not self.track_positions:
+            return self.strategy.collate(batch)
+        info = {"worker": worker_id, "position": position}
+        if stage_times is None:
+            return self.strategy.collate(batch) + (info,)
+        start_time = time.perf_counter()
+        inputs, ground_truth = self.strategy.collate(batch)
+        stage_times["collate"] += time.perf_counter() - start_time
+        info.update(stage_times, residues=num_tokens)
+        stage_times.update(parse=0.0, featurize=0.0, collate=0.0)
+        return inputs, ground_truth, info
+
+PRECISIONS = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
 
 
 class Trainer:
-    def __init__(self, directory, strategy, batch_size=32, test_size=0.2, device="cuda:0", pretrained_model_path=""):
+    def __init__(self, directory, strategy, batch_size=32, test_size=0.2, device="cuda:0", pretrained_model_path="",
+                 num_workers=0, prefetch_factor=2, shuffle_buffer_size=0, pin_memory=None, max_tokens=None,
+                 manifest_path=None, cluster_identity=None, one_per_cluster=True, precision="fp32",
+                 accumulation_steps=1, compile_model=False, log_interval=100, instrumentation=None,
+                 checkpoint_dir=None, checkpoint_interval=None, keep_checkpoints=3, resume=True):
         self.directory = directory
         self.strategy = strategy.to(device)
         self.pretrained_model_path = pretrained_model_path
         if os.path.exists(self.pretrained_model_path):
-            model = torch.load(pretrained_model_path)
+            model = torch.load(pretrained_model_path, map_location=device)
             self.strategy.load_state_dict(model)
         else:
             warnings.warn("Pretrained model path does not exist. Skipping")
@@ -45,102 +235,312 @@ class Trainer:
         self.batch_size = batch_size
         self.test_size = test_size
         self.device = device
-        self.optimizer = torch.optim.Adam(strategy.parameters(), lr=0.001)
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.max_tokens = max_tokens
+        self.pin_memory = device.startswith("cuda") if pin_memory is None else pin_memory
+        self.optimizer = torch.optim.Adam(strategy.parameters(), lr=0.001, fused=device.startswith("cuda"))
         self.best_test_loss = float('inf')
 
-        # Collect all file paths from the directory
-        self.file_paths = [os.path.join(directory, fname) for fname in os.listdir(directory) if fname.endswith('.json')]
-        self.train_files, self.test_files = train_test_split(self.file_paths, test_size=test_size, random_state=42,
-                                                             shuffle=False)
-        self.train_size = len(self.train_files) * NUM_SAMPLES_IN_DATAFRAME
-        self.test_size = len(self.test_files) * NUM_SAMPLES_IN_DATAFRAME
-        print(f"number of samples in the train set are: {self.train_size}")
-        print(f"number of samples in the test set are: {self.test_size}")
-        print(f'Number of trainable parameters: '
-              f'{sum(p.numel() for p in self.strategy.parameters() if p.requires_grad)}')
-
-    def get_dataloader(self, file_path, mode):
-        dataframe = pd.read_json(file_path, lines=True)
-        dataframe = dataframe[dataframe['sequence'].apply(lambda seq: len(seq) >= MIN_SIZE)]
-        dataframe = dataframe[dataframe['sequence'].apply(lambda seq: len(seq) <= MAX_SIZE)]
-        dataframe = dataframe[dataframe['sequence'].apply(lambda seq: all(char in AMINO_ACIDS for char in seq))]
-        dataset = CustomDataset(dataframe, self.strategy)
-        return DataLoader(dataset, batch_size=self.batch_size,
-                          shuffle=(mode == "train"), collate_fn=dataset.collate_fn)
+        # Autocast to bf16 or fp16, the latter with loss scaling, and optimizer steps every accumulation_steps batches
+        if precision not in PRECISIONS:
+            raise ValueError(f"precision must be one of {list(PRECISIONS)}, got {precision}")
+        self.precision = precision
+        self.device_type = torch.device(device).type
+        self.scaler = torch.amp.GradScaler(self.device_type, enabled=(precision == "fp16"))
+        self.accumulation_steps = accumulation_steps
+        self.log_interval = log_interval
+        # Training state checkpoints are written every checkpoint_interval batches and after every epoch, by a
+        # background thread of rank 0, and the latest one in checkpoint_dir is resumed from
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_interval = checkpoint_interval if checkpoint_dir else None
+        self.checkpointer = AsyncCheckpointer(checkpoint_dir, keep_last=keep_checkpoints) if is_main_process() else None
+        self.start_epoch = 0
+        self.resume_state = None
+        # Per-stage timings of the training batches, e.g. a TrainingInstrumentation, nothing is recorded by default
+        self.instrumentation = instrumentation or NullInstrumentation()
+        # Under torch.distributed every rank trains a DistributedDataParallel replica that all-reduces gradients,
+        # and evaluates the plain strategy so that uneven test shards need no collective calls
+        self.rank, self.world_size = get_rank(), get_world_size()
+        self.distributed = is_distributed()
+        if checkpoint_dir and resume and latest_checkpoint(checkpoint_dir):
+            self.load_checkpoint(latest_checkpoint(checkpoint_dir))
+        model = self.strategy
+        if self.distributed:
+            model = DistributedDataParallel(self.strategy, device_ids=[device] if self.device_type == "cuda" else None)
+        self.ddp_model = model if self.distributed else None
+        # Batches of ragged graphs change shape every step, so the compiled forward is traced with dynamic shapes
+        self.model = torch.compile(model, dynamic=True) if compile_model else model
+        self.eval_model = self.model if not self.distributed else \
+            (torch.compile(self.strategy, dynamic=True) if compile_model else self.strategy)
 
-    def train(self, epochs=100):
-        for epoch in range(epochs):
-            batch_count = 0
-            total_train_loss = 0
-            total_train_samples = 0
-            start_time = time.time()
-            self.strategy.train()
-
-            for train_file in self.train_files:
-                train_loader = self.get_dataloader(train_file, mode="train")
-
-                for inputs, ground_truth in train_loader:
-                    self.optimizer.zero_grad()
-                    outputs = self.strategy((x.to(self.device) for x in inputs))
-                    loss = self.strategy.compute_loss(outputs, ground_truth.to(self.device))
-                    loss.backward()
-                    self.optimizer.step()
-
-                    total_train_loss += loss.item()
-                    total_train_samples += len(ground_truth)
-                    batch_count += 1
-
-                    # Print every 100 batches
-                    if batch_count % 100 == 0:
-                        avg_train_loss = total_train_loss / total_train_samples
-                        elapsed_time = time.time() - start_time
-                        print(f'Epoch {epoch + 1}, Batch {batch_count} of {self.train_size // self.batch_size}, '
-                              f'Training Loss: {avg_train_loss:.4f}, '
-                              f'Time taken: {elapsed_time:.4f} seconds.')
-                        total_train_loss = 0
-                        total_train_samples = 0
-                        start_time = time.time()
+        # Collect all file paths from the directory, preferring the memory-mapped binary shards
+        self.file_paths = list_shards(directory)
+        # Size and alphabet filters are applied once over the per-chain manifest instead of in every epoch
+        with main_process_first():
+            self.manifest = DatasetManifest(manifest_path or os.path.join(directory, "manifest.npz"))
+            self.manifest.build(self.file_paths)
+            if cluster_identity is not None:
+                cluster_manifest(self.manifest, identity=cluster_identity)
+        mask = self.manifest.get_mask(MIN_SIZE, MAX_SIZE)
+        self.one_per_cluster = one_per_cluster and cluster_identity is not None
+        if cluster_identity is None:
+            self.train_files, self.test_files = split_files(self.file_paths, test_size)
+            self.train_mask, self.test_mask = mask, mask
+        else:
+            # Near-duplicate chains share a cluster, and whole clusters go to either side of the split
+            clusters = self.manifest["cluster"]
+            is_test = split_clusters(clusters, test_size=test_size, seed=42)
+            self.train_mask, self.test_mask = mask & ~is_test, mask & is_test
+            self.train_files = self.get_files_with_rows(self.train_mask)
+            self.test_files = self.get_files_with_rows(self.test_mask)
+        self.train_size = self.get_num_samples(self.train_files, "train")
+        self.test_size = self.get_num_samples(self.test_files, "test")
+        if is_main_process():
+            print(f"number of samples in the train set are: {self.train_size}")
+            print(f"number of samples in the test set are: {self.test_size}")
+            print(f'Number of trainable parameters: '
+                  f'{sum(p.numel() for p in self.strategy.parameters() if p.requires_grad)}')
+            if self.distributed:
+                print(f"Training on {self.world_size} processes")
 
-            # Evaluate on test data
-            self.strategy.eval()
-            total_test_loss = 0
-            total_test_samples = 0
-            with torch.no_grad():
+    def get_mask(self, mode, epoch=0):
+        if mode != "train":
+            return self.test_mask
+        if self.one_per_cluster:
+            # A different random member of every cluster in each epoch
+            return sample_cluster_representatives(self.manifest["cluster"], self.train_mask, seed=epoch)
+        return self.train_mask
+
+    def get_files_with_rows(self, mask):
+        # Shards without a selected chain are left out, so the loaders of the split never open them
+        return [path for path, rows in self.manifest.get_row_selections(self.file_paths, mask).items() if len(rows)]
+
+    def get_num_samples(self, file_paths, mode):
+        return sum(len(rows) for rows in self.manifest.get_row_selections(file_paths, self.get_mask(mode)).values())
+
+    def get_dataloader(self, file_paths, mode, epoch=0, start_positions=None):
+        row_selections = self.manifest.get_row_selections(file_paths, self.get_mask(mode, epoch))
+        dataset = ShardStreamDataset(file_paths, self.strategy, self.batch_size, shuffle=(mode == "train"),
+                                     shuffle_buffer_size=self.shuffle_buffer_size, max_tokens=self.max_tokens,
+                                     row_selections=row_selections, rank=self.rank, world_size=self.world_size,
+                                     record_stages=(mode == "train" and self.instrumentation.enabled),
+                                     track_positions=(mode == "train" and self.checkpoint_interval is not None),
+                                     start_positions=start_positions)
+        dataset.set_epoch(epoch)
+        return DataLoader(dataset, batch_size=None, num_workers=self.num_workers, pin_memory=self.pin_memory,
+                          prefetch_factor=self.prefetch_factor if self.num_workers > 0 else None)
+
+    def to_device(self, inputs, ground_truth):
+        inputs = self.strategy.inputs_to_device(inputs, self.device, non_blocking=self.pin_memory)
+        return inputs, ground_truth.to(self.device, non_blocking=self.pin_memory)
+
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=PRECISIONS[self.precision], enabled=(self.precision != "fp32"))
+
+    def train_epoch(self, epoch, max_batches=None):
+        batch_count = 0
+        epoch_samples = 0
+        data_wait_time = 0
+        # The running loss stays on the device and is only synchronized when it is printed
+        total_train_loss = torch.zeros((), device=self.device)
+        epoch_loss = torch.zeros((), device=self.device)
+        total_train_samples = 0
+        epoch_start_time = time.time()
+        start_time = time.time()
+        self.strategy.train()
+        self.optimizer.zero_grad(set_to_none=True)
+        instrumentation = self.instrumentation
+
+        # Samples produced so far by every DataLoader worker, the shard position that a checkpoint resumes from
+        positions = {}
+        if self.resume_state is not None and self.resume_state["epoch"] == epoch:
+            batch_count, positions = self.resume_state["batch"], dict(self.resume_state["positions"])
+            if is_main_process():
+                print(f"Resuming epoch {epoch + 1} after batch {batch_count}")
+        self.resume_state = None
+        train_loader = self.get_dataloader(self.train_files, mode="train", epoch=epoch, start_positions=positions)
+        num_batches = train_loader.dataset.get_num_batches(self.num_workers)
+        # Mid-epoch checkpoints gather the positions of all ranks, so they are only taken at batches every rank
+        # reaches. That is unknown for token budget batches, which are then only checkpointed at the end of the epoch.
+        checkpoint_limit = float("inf")
+        if self.distributed and self.checkpoint_interval:
+            checkpoint_limit = int(all_reduce_min(torch.tensor(num_batches or 0, device=self.device)).item())
+        if num_batches is None:
+            num_batches = -(-self.train_size // self.batch_size)
+        # Ranks that run out of batches first shadow the gradient all-reduces of the others until every rank is done
+        with self.ddp_model.join() if self.distributed else nullcontext():
+            wait_start_time = time.perf_counter()
+            # Instrumented and position tracking batches carry a dict of batch information as a third element
+            for inputs, ground_truth, *batch_info in train_loader:
+                wait_time = time.perf_counter() - wait_start_time
+                data_wait_time += wait_time
+                if self.checkpoint_interval:
+                    positions[batch_info[0]["worker"]] = batch_info[0]["position"]
+                instrumentation.start_batch(epoch, batch_count, wait_time, *batch_info)
+                with instrumentation.stage("to_device"):
+                    inputs, ground_truth = self.to_device(inputs, ground_truth)
+
+                # Gradients are only all-reduced by the batch that completes an accumulation window
+                is_window_end = (batch_count + 1) % self.accumulation_steps == 0
+                with self.ddp_model.no_sync() if self.distributed and not is_window_end else nullcontext():
+                    with instrumentation.stage("forward"), self.autocast():
+                        outputs = self.model(inputs)
+                        loss = self.strategy.compute_loss(outputs, ground_truth)
+                    with instrumentation.stage("backward"):
+                        self.scaler.scale(loss / self.accumulation_steps).backward()
+
+                total_train_loss += loss.detach()
+                epoch_loss += loss.detach()
+                total_train_samples += len(ground_truth)
+                epoch_samples += len(ground_truth)
+                batch_count += 1
+                if batch_count % self.accumulation_steps == 0:
+                    with instrumentation.stage("optimizer"):
+                        self.optimizer_step()
+                instrumentation.end_batch(len(ground_truth))
+                if (self.checkpoint_interval and batch_count % self.checkpoint_interval == 0
+                        and batch_count % self.accumulation_steps == 0 and batch_count <= checkpoint_limit):
+                    self.save_checkpoint(epoch, batch_count, positions)
+
+                if batch_count % self.log_interval == 0 and is_main_process():
+                    avg_train_loss = total_train_loss.item() / total_train_samples
+                    elapsed_time = time.time() - start_time
+                    print(f'Epoch {epoch + 1}, Batch {batch_count} of {num_batches}, '
+                          f'Training Loss: {avg_train_loss:.4f}, '
+                          f'Time taken: {elapsed_time:.4f} seconds, '
+                          f'{total_train_samples / elapsed_time:.1f} samples/sec.')
+                    total_train_loss.zero_()
+                    total_train_samples = 0
+                    start_time = time.time()
+                if max_batches is not None and batch_count >= max_batches:
+                    break
+                wait_start_time = time.perf_counter()
 
-                for test_file in self.test_files:
-                    test_loader = self.get_dataloader(test_file, mode="test")
+        # Gradients of a last, incomplete accumulation window are applied as well. They were never all-reduced, so
+        # when any rank has such a window every rank averages its gradients and steps, keeping the replicas equal.
+        is_incomplete = batch_count % self.accumulation_steps != 0
+        if self.distributed and self.accumulation_steps > 1:
+            is_incomplete = all_reduce_sum(torch.tensor(float(is_incomplete), device=self.device)).item() > 0
+            if is_incomplete:
+                average_gradients(self.strategy.parameters())
+        if is_incomplete:
+            self.optimizer_step()
 
-                    for inputs, ground_truth in test_loader:
-                        outputs = self.strategy((x.to(self.device) for x in inputs))
-                        loss = self.strategy.compute_loss(outputs, ground_truth.to(self.device))
-                        total_test_loss += loss.item()
-                        total_test_samples += len(ground_truth)
+        epoch_time = time.time() - epoch_start_time
+        epoch_samples = int(all_reduce_sum(torch.tensor(float(epoch_samples), device=self.device)).item())
+        if is_main_process():
+            print(f'Epoch {epoch + 1}, Data wait time: {data_wait_time:.2f} of {epoch_time:.2f} seconds, '
+                  f'{epoch_samples / epoch_time:.1f} samples/sec.')
+        stats = {"batches": batch_count, "samples": epoch_samples, "seconds": epoch_time,
+                 "samples_per_second": epoch_samples / epoch_time, "loss": epoch_loss.item() / max(batch_count, 1)}
+        instrumentation.end_epoch(epoch, stats)
+        return stats
 
-            average_test_loss = total_test_loss / total_test_samples
-            print(f'Epoch {epoch + 1}, Test Loss: {average_test_loss:.4f}')
+    def optimizer_step(self):
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self.optimizer.zero_grad(set_to_none=True)
 
-            # Save the model if the test loss is the best seen so far
+    def test_epoch(self):
+        self.strategy.eval()
+        # Loss sum and sample count, summed over the test shards of all ranks
+        totals = torch.zeros(2, device=self.device)
+        with torch.no_grad():
+            test_loader = self.get_dataloader(self.test_files, mode="test")
+            for inputs, ground_truth in test_loader:
+                inputs, ground_truth = self.to_device(inputs, ground_truth)
+                with self.autocast():
+                    outputs = self.eval_model(inputs)
+                    loss = self.strategy.compute_loss(outputs, ground_truth)
+                totals[0] += loss.detach().float()
+                totals[1] += len(ground_truth)
+        total_test_loss, total_test_samples = all_reduce_sum(totals).tolist()
+        return total_test_loss / total_test_samples
+
+    def get_checkpoint_state(self, epoch, batch, positions):
+        return {"model": self.strategy.state_dict(), "optimizer": self.optimizer.state_dict(),
+                "scaler": self.scaler.state_dict(), "epoch": epoch, "batch": batch, "positions": positions,
+                "num_workers": max(self.num_workers, 1), "world_size": self.world_size,
+                "best_test_loss": self.best_test_loss, "rng": get_rng_states()}
+
+    def save_checkpoint(self, epoch, batch=0, positions=None):
+        """Checkpoint the full training state, to continue with batch + 1 of epoch when batch > 0."""
+        # Every rank knows the positions of its own workers only
+        positions = {worker: position for rank_positions in all_gather_objects(positions or {})
+                     for worker, position in rank_positions.items()}
+        if is_main_process() and self.checkpoint_dir:
+            self.checkpointer.save(self.get_checkpoint_state(epoch, batch, positions), epoch, batch)
+
+    def load_checkpoint(self, path):
+        checkpoint = torch.load(path, map_location="cpu", weights_only=False)
+        self.strategy.load_state_dict(checkpoint["model"])
+        self.optimizer.load_state_dict(checkpoint["optimizer"])
+        if checkpoint["scaler"]:
+            self.scaler.load_state_dict(checkpoint["scaler"])
+        self.best_test_loss = checkpoint["best_test_loss"]
+        set_rng_states(checkpoint["rng"])
+        self.start_epoch = checkpoint["epoch"]
+        if checkpoint["batch"]:
+            # Worker positions are only meaningful for the same split of the shards over workers and ranks
+            if (checkpoint["num_workers"], checkpoint["world_size"]) == (max(self.num_workers, 1), self.world_size):
+                self.resume_state = {key: checkpoint[key] for key in ("epoch", "batch", "positions")}
+            else:
+                warnings.warn(f"Checkpoint taken with {checkpoint['num_workers']} workers on {checkpoint['world_size']} "
+                              f"processes, restarting epoch {self.start_epoch + 1}")
+        if is_main_process():
+            print(f"Resumed from {path}")
+
+    def train(self, epochs=100):
+        for epoch in range(self.start_epoch, epochs):
+            self.train_epoch(epoch)
+
+            # Evaluate on test data
+            average_test_loss = self.test_epoch()
+            if is_main_process():
+                print(f'Epoch {epoch + 1}, Test Loss: {average_test_loss:.4f}')
+
+            # Save the model if the test loss is the best seen so far, the replicas are identical so rank 0 saves it
             if average_test_loss < self.best_test_loss:
                 self.best_test_loss = average_test_loss
-                self.save_model()
+                if is_main_process():
+                    self.save_model()
+            if self.checkpoint_dir:
+                self.save_checkpoint(epoch + 1)
+        if self.checkpointer is not None:
+            self.checkpointer.wait()
 
     def save_model(self):
-        if self.pretrained_model_path:
-            directory = os.path.dirname(self.pretrained_model_path)
-            model_path = os.path.join(directory, 'pretrained.pth')
-        else:
-            directory = os.path.join(MAIN_DIR, "models", self.strategy.__class__.__name__,
-                                     datetime.now().strftime("%Y%m%d"))
-            if not os.path.exists(directory):
-                os.makedirs(directory)
-            model_path = os.path.join(directory, 'best_model.pth')
+        # A run started from pretrained weights saves next to the others instead of overwriting them
+        directory = os.path.join(MAIN_DIR, "models", self.strategy.__class__.__name__,
+                                 datetime.now().strftime("%Y%m%d"))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        model_path = os.path.join(directory, 'best_model.pth')
 
-        torch.save(self.strategy.state_dict(), model_path)
+        self.checkpointer.save_file(self.strategy.state_dict(), model_path)
         print(f'Model saved at {model_path}')
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train a strategy on the PDB shards.")
+    parser.add_argument("--strategy", choices=list(STRATEGIES), default="contact_map_to_sequence")
+    args = parser.parse_args()
+
+    # Started through torchrun (e.g. torchrun --nproc_per_node=4 trainer.py) every process trains one replica
+    device = init_distributed() if "WORLD_SIZE" in os.environ else "cuda:0"
     data_path = os.path.join(MAIN_DIR, "pdb_data_130000")
-    strategy = ContactMapToSequence()
-    trainer = Trainer(data_path, strategy, batch_size=BATCH_SIZE, test_size=0.15)
+    strategy_kwargs = {}
+    if args.strategy == "contact_map_to_sequence":
+        with main_process_first():
+            strategy_kwargs["contact_cache"] = ContactGraphCache(os.path.join(MAIN_DIR, "contact_cache")).build(
+                list_shards(data_path))
+    strategy = create_strategy(args.strategy, **strategy_kwargs)
+    trainer = Trainer(data_path, strategy, batch_size=BATCH_SIZE, test_size=0.15, device=device,
+                      num_workers=NUM_WORKERS, shuffle_buffer_size=SHUFFLE_BUFFER_SIZE,
+                      cluster_identity=CLUSTER_IDENTITY,
+                      checkpoint_dir=os.path.join(MAIN_DIR, "checkpoints", strategy.__class__.__name__),
+                      checkpoint_interval=1000)
     trainer.train(epochs=10000)
+    cleanup_distributed()
@@ -0,0 +1,171 @@
+import os
+
+import numpy as np
+
+from constants import AMINO_ACIDS, AMINO_ACID_TO_INDEX, MAIN_DIR
+
+COORDS_SUFFIX = ".coords.bin"
+TOKENS_SUFFIX = ".tokens.bin"
+OFFSETS_SUFFIX = ".offsets.npy"
+IDS_SUFFIX = ".ids.npy"
+
+# Byte -> token lookup, 0 marks residues outside AMINO_ACIDS
+TOKEN_LOOKUP = np.zeros(256, dtype=np.uint8)
+for amino_acid, index in AMINO_ACID_TO_INDEX.items():
+    TOKEN_LOOKUP[ord(amino_acid)] = index
+TOKEN_TO_LETTER = np.frombuffer(("X" + AMINO_ACIDS).encode("ascii"), dtype=np.uint8)
+
+
+def encode_tokens(sequence):
+    return TOKEN_LOOKUP[np.frombuffer(sequence.encode("ascii", errors="replace"), dtype=np.uint8)]
+
+
+def decode_tokens(tokens):
+    return TOKEN_TO_LETTER[tokens].tobytes().decode("ascii")
+
+
+def write_binary_shard(dataframe, prefix):
+    sequences = [str(sequence) for sequence in dataframe["sequence"]]
+    lengths = np.fromiter((len(sequence) for sequence in sequences), dtype=np.int64, count=len(sequences))
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    tokens = [encode_tokens(sequence) for sequence in sequences]
+    coords = [np.asarray(chain_coords, dtype=np.float32).reshape(-1, 3) for chain_coords in dataframe["coords"]]
+    for chain_tokens, chain_coords in zip(tokens, coords):
+        if len(chain_tokens) != len(chain_coords):
+            raise ValueError(f"Sequence and coordinates lengths differ in shard {prefix}")
+
+    np.concatenate(tokens or [np.zeros(0, dtype=np.uint8)]).tofile(prefix + TOKENS_SUFFIX)
+    np.concatenate(coords or [np.zeros((0, 3), dtype=np.float32)]).tofile(prefix + COORDS_SUFFIX)
+    np.save(prefix + OFFSETS_SUFFIX, offsets)
+    ids = np.array([[str(pdb_id), str(chain_id)] for pdb_id, chain_id in zip(dataframe["pdb_id"], dataframe["chain_id"])],
+                   dtype=str).reshape(-1, 2)
+    np.save(prefix + IDS_SUFFIX, ids)
+    return prefix
+
+
+class BinaryShard:
+    """Memory-mapped chains of one shard: flat float32 CA coordinates, uint8 tokens and per-chain offsets."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.offsets = np.load(prefix + OFFSETS_SUFFIX)
+        self.ids = np.load(prefix + IDS_SUFFIX)
+        self._tokens = None
+        self._coords = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getstate__(self):
+        # Memory maps are reopened lazily instead of being pickled into DataLoader workers
+        state = self.__dict__.copy()
+        state["_tokens"] = None
+        state["_coords"] = None
+        return state
+
+    def _open(self):
+        num_residues = int(self.offsets[-1])
+        if num_residues == 0:
+            self._tokens = np.zeros(0, dtype=np.uint8)
+            self._coords = np.zeros((0, 3), dtype=np.float32)
+            return
+        self._tokens = np.memmap(self.prefix + TOKENS_SUFFIX, dtype=np.uint8, mode="r", shape=(num_residues,))
+        self._coords = np.memmap(self.prefix + COORDS_SUFFIX, dtype=np.float32, mode="r", shape=(num_residues, 3))
+
+    @property
+    def tokens(self):
+        if self._tokens is None:
+            self._open()
+        return self._tokens
+
+    @property
+    def coords(self):
+        if self._coords is None:
+            self._open()
+        return self._coords
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def valid_alphabet(self):
+        # Number of residues outside AMINO_ACIDS in each chain, through a prefix sum over the flat token array
+        invalid = np.zeros(len(self.tokens) + 1, dtype=np.int64)
+        np.cumsum(self.tokens == 0, out=invalid[1:])
+        return (invalid[self.offsets[1:]] - invalid[self.offsets[:-1]]) == 0
+
+    def __getitem__(self, idx):
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        tokens = self.tokens[start:end]
+        pdb_id, chain_id = self.ids[idx]
+        return {
+            "pdb_id": str(pdb_id),
+            "chain_id": str(chain_id),
+            "sequence": decode_tokens(tokens),
+            "tokens": tokens,
+            "coords": self.coords[start:end]
+        }
+
+
+def get_shard_prefix(json_path, output_dir=None):
+    directory, filename = os.path.split(json_path)
+    return os.path.join(output_dir or directory, os.path.splitext(filename)[0])
+
+
+def is_binary_shard(path):
+    return os.path.exists(path + OFFSETS_SUFFIX)
+
+
+def list_binary_shards(directory):
+    return [os.path.join(directory, fname[:-len(OFFSETS_SUFFIX)]) for fname in sorted(os.listdir(directory))
+            if fname.endswith(OFFSETS_SUFFIX)]
+
+
+def list_shards(directory):
+    # Binary shards take precedence over the JSON-lines shards they were converted from
+    return list_binary_shards(directory) or \
+        [os.path.join(directory, fname) for fname in os.listdir(directory) if fname.endswith('.json')]
+
+
+def read_json_shard(path):
+    # pandas is only needed for the JSON-lines shards, so it is not imported by processes reading binary shards
+    import pandas as pd
+    return pd.read_json(path, lines=True, dtype={"pdb_id": str, "chain_id": str})
+
+
+def iter_shard_chains(path):
+    if is_binary_shard(path):
+        shard = BinaryShard(path)
+        for idx in range(len(shard)):
+            yield shard[idx]
+    else:
+        dataframe = read_json_shard(path)
+        yield from dataframe.to_dict('records')
+
+
+def get_shard_source_files(path):
+    if is_binary_shard(path):
+        return [path + OFFSETS_SUFFIX, path + COORDS_SUFFIX]
+    return [path]
+
+
+def convert_json_shard(json_path, output_dir=None):
+    dataframe = read_json_shard(json_path)
+    return write_binary_shard(dataframe, get_shard_prefix(json_path, output_dir))
+
+
+def convert_json_directory(directory, output_dir=None):
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    prefixes = []
+    for fname in sorted(os.listdir(directory)):
+        if fname.endswith('.json'):
+            prefixes.append(convert_json_shard(os.path.join(directory, fname), output_dir))
+            print(f"Converted {fname}")
+    return prefixes
+
+
+if __name__ == '__main__':
+    convert_json_directory(os.path.join(MAIN_DIR, "pdb_data_130000"))
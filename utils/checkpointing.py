@@ -0,0 +1,95 @@
+import glob
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+CHECKPOINT_PATTERN = "checkpoint-e{epoch:05d}-b{batch:08d}.pth"
+
+
+def snapshot_to_cpu(obj):
+    """Copy of a (nested) state dict with every tensor copied to the CPU, safe to write while training goes on."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: snapshot_to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(value) for value in obj)
+    return obj
+
+
+def get_rng_states():
+    states = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        states["cuda"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    random.setstate(states["python"])
+    np.random.set_state(states["numpy"])
+    torch.set_rng_state(states["torch"])
+    if "cuda" in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+
+def list_checkpoints(directory):
+    # Zero padded epoch and batch numbers, so the names sort in training order
+    return sorted(glob.glob(os.path.join(directory, "checkpoint-e*-b*.pth")))
+
+
+def latest_checkpoint(directory):
+    checkpoints = list_checkpoints(directory)
+    return checkpoints[-1] if checkpoints else None
+
+
+def save_atomic(obj, path):
+    # Written next to the target and renamed over it, a killed job never leaves a truncated file under the real name
+    temp_path = path + ".tmp"
+    torch.save(obj, temp_path)
+    os.replace(temp_path, path)
+
+
+class AsyncCheckpointer:
+    """Writes training checkpoints from a background thread, keeping the last keep_last of them in directory.
+
+    The state is snapshotted to the CPU on the calling thread, so training resumes as soon as the copy is done while
+    serialization and disk writes overlap with the next batches. Writes happen one at a time in submission order, an
+    error of a background write is raised by the next save or by wait.
+    """
+
+    def __init__(self, directory=None, keep_last=3):
+        # Without a directory only save_file is available, e.g. for the best model weights
+        self.directory = directory
+        self.keep_last = keep_last
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def save(self, state, epoch, batch):
+        return self.save_file(state, os.path.join(self.directory, CHECKPOINT_PATTERN.format(epoch=epoch, batch=batch)),
+                              prune=True)
+
+    def save_file(self, state, path, prune=False):
+        snapshot = snapshot_to_cpu(state)
+        self.wait()
+        self.pending = self.executor.submit(self._write, snapshot, path, prune)
+        return path
+
+    def _write(self, snapshot, path, prune):
+        save_atomic(snapshot, path)
+        if prune and self.keep_last:
+            for old_path in list_checkpoints(self.directory)[:-self.keep_last]:
+                os.remove(old_path)
+
+    def wait(self):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
@@ -0,0 +1,164 @@
+import hashlib
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+from constants import MAIN_DIR
+from utils.binary_shards import iter_shard_chains, get_shard_source_files, list_shards
+from utils.structure_utils import get_contact_edge_index
+
+INDPTR_SUFFIX = ".indptr.npy"
+INDICES_SUFFIX = ".indices.npy"
+ROW_OFFSETS_SUFFIX = ".row_offsets.npy"
+EDGE_OFFSETS_SUFFIX = ".edge_offsets.npy"
+CHECKSUMS_SUFFIX = ".checksums.npy"
+IDS_SUFFIX = ".ids.npy"
+
+
+def get_shard_checksum(path, chunk_size=1 << 24):
+    checksum = hashlib.sha1()
+    for source_file in get_shard_source_files(path):
+        with open(source_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def get_coords_checksum(coords):
+    # Tells apart chains sharing (pdb_id, chain_id), such as the models of an NMR entry, and chains edited since
+    coords = np.ascontiguousarray(coords, dtype=np.float32)
+    return int.from_bytes(hashlib.blake2b(coords.tobytes(), digest_size=8).digest(), "little", signed=True)
+
+
+def build_shard_contacts(path, prefix, threshold=8.0):
+    # Per chain CSR of the full contact graph: chain-local indptr rows stored back to back in one array,
+    # column indices in another, with row_offsets/edge_offsets locating each chain inside them
+    indptr, indices, ids, checksums = [], [], [], []
+    row_offsets, edge_offsets = [0], [0]
+    for row in iter_shard_chains(path):
+        num_residues = len(row["sequence"])
+        if num_residues > 0:
+            rows, cols = get_contact_edge_index(row["coords"], threshold=threshold)
+        else:
+            rows, cols = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        chain_indptr = np.zeros(num_residues + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=num_residues), out=chain_indptr[1:])
+
+        indptr.append(chain_indptr)
+        indices.append(cols.astype(np.int32))
+        ids.append([str(row["pdb_id"]), str(row["chain_id"])])
+        checksums.append(get_coords_checksum(row["coords"]))
+        row_offsets.append(row_offsets[-1] + num_residues + 1)
+        edge_offsets.append(edge_offsets[-1] + len(cols))
+
+    # The ids file is written last and marks the entry as complete
+    np.save(prefix + INDPTR_SUFFIX, np.concatenate(indptr or [np.zeros(0, dtype=np.int64)]))
+    np.save(prefix + INDICES_SUFFIX, np.concatenate(indices or [np.zeros(0, dtype=np.int32)]))
+    np.save(prefix + ROW_OFFSETS_SUFFIX, np.array(row_offsets, dtype=np.int64))
+    np.save(prefix + EDGE_OFFSETS_SUFFIX, np.array(edge_offsets, dtype=np.int64))
+    np.save(prefix + CHECKSUMS_SUFFIX, np.array(checksums, dtype=np.int64))
+    np.save(prefix + IDS_SUFFIX, np.array(ids, dtype=str).reshape(-1, 2))
+    return prefix
+
+
+def _build_shard_contacts(args):
+    return build_shard_contacts(*args)
+
+
+class ContactGraphCache:
+    """On-disk contact edge lists of whole chains, looked up by (pdb_id, chain_id) and cropped on demand.
+
+    Each source shard gets one cache entry named after its checksum and the contact threshold, so editing a shard
+    or changing the threshold builds a new entry instead of serving stale edges. Given the coordinates of the chain,
+    a lookup also checks their checksum, which picks the right chain among repeated keys and misses on any other.
+    """
+
+    def __init__(self, cache_dir, threshold=8.0):
+        self.cache_dir = cache_dir
+        self.threshold = threshold
+        self.prefixes = []
+        self.checksums = []
+        self.index = {}
+        # Every location of the keys found more than once, most chains having a single one in index
+        self.repeated = {}
+        self._arrays = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = {}
+        return state
+
+    def get_entry_prefix(self, path):
+        name = os.path.basename(path.rstrip(os.sep))
+        return os.path.join(self.cache_dir, f"{name}.{get_shard_checksum(path)[:16]}.t{self.threshold:g}")
+
+    def build(self, shard_paths, num_workers=1):
+        prefixes = [self.get_entry_prefix(path) for path in shard_paths]
+        missing = [(path, prefix, self.threshold) for path, prefix in zip(shard_paths, prefixes)
+                   if not all(os.path.exists(prefix + suffix) for suffix in (CHECKSUMS_SUFFIX, IDS_SUFFIX))]
+        if missing:
+            print(f"Building contact cache for {len(missing)} of {len(shard_paths)} shards")
+            if num_workers > 1:
+                with Pool(num_workers) as pool:
+                    pool.map(_build_shard_contacts, missing)
+            else:
+                for args in missing:
+                    _build_shard_contacts(args)
+
+        for prefix in prefixes:
+            self.add_entry(prefix)
+        return self
+
+    def add_entry(self, prefix):
+        entry = len(self.prefixes)
+        self.prefixes.append(prefix)
+        self.checksums.append(np.load(prefix + CHECKSUMS_SUFFIX))
+        for chain_idx, (pdb_id, chain_id) in enumerate(np.load(prefix + IDS_SUFFIX)):
+            key = (str(pdb_id), str(chain_id))
+            if key in self.index:
+                self.repeated.setdefault(key, [self.index[key]]).append((entry, chain_idx))
+            else:
+                self.index[key] = (entry, chain_idx)
+
+    def find_chain(self, pdb_id, chain_id, coords=None):
+        key = (str(pdb_id), str(chain_id))
+        location = self.index.get(key)
+        if location is None or coords is None:
+            # Without coordinates only keys of a single chain can be resolved
+            return None if key in self.repeated else location
+        checksum = get_coords_checksum(coords)
+        for entry, chain_idx in self.repeated.get(key, [location]):
+            if self.checksums[entry][chain_idx] == checksum:
+                return entry, chain_idx
+        return None
+
+    def _get_arrays(self, entry):
+        if entry not in self._arrays:
+            prefix = self.prefixes[entry]
+            self._arrays[entry] = tuple(np.load(prefix + suffix, mmap_mode='r') for suffix in
+                                        (INDPTR_SUFFIX, INDICES_SUFFIX, ROW_OFFSETS_SUFFIX, EDGE_OFFSETS_SUFFIX))
+        return self._arrays[entry]
+
+    def get_edge_index(self, pdb_id, chain_id, start=0, end=None, coords=None):
+        location = self.find_chain(pdb_id, chain_id, coords)
+        if location is None:
+            return None
+        entry, chain_idx = location
+        indptr, indices, row_offsets, edge_offsets = self._get_arrays(entry)
+        chain_indptr = indptr[row_offsets[chain_idx]: row_offsets[chain_idx + 1]]
+        num_residues = len(chain_indptr) - 1
+        end = num_residues if end is None else min(end, num_residues)
+
+        # Rows of the crop are a contiguous slice of the CSR, only the columns need filtering
+        first_edge = edge_offsets[chain_idx]
+        cols = np.asarray(indices[first_edge + chain_indptr[start]: first_edge + chain_indptr[end]], dtype=np.int64)
+        rows = np.repeat(np.arange(start, end), np.diff(chain_indptr[start: end + 1]))
+        keep = (cols >= start) & (cols < end)
+        return np.stack([rows[keep] - start, cols[keep] - start])
+
+
+if __name__ == '__main__':
+    ContactGraphCache(os.path.join(MAIN_DIR, "contact_cache")).build(
+        list_shards(os.path.join(MAIN_DIR, "pdb_data_130000")), num_workers=os.cpu_count())
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from constants import AMINO_ACIDS, MAIN_DIR, MIN_SIZE, MAX_SIZE
+from utils.binary_shards import BinaryShard, decode_tokens, get_shard_source_files, is_binary_shard, list_shards, \
+    read_json_shard, TOKENS_SUFFIX
+
+# Per-chain columns, one entry per chain of every shard in listing order
+MANIFEST_COLUMNS = ["shard", "row", "length", "valid_alphabet", "sequence_hash", "pdb_id", "chain_id"]
+
+
+def get_sequence_hash(sequence):
+    return int.from_bytes(hashlib.blake2b(sequence.encode("ascii", errors="replace"), digest_size=8).digest(), "little")
+
+
+def get_shard_fingerprint(path):
+    # Size and modification time of the shard files, cheap enough to check on every start
+    files = get_shard_source_files(path) + ([path + TOKENS_SUFFIX] if is_binary_shard(path) else [])
+    return ";".join(f"{os.path.getsize(f)}:{os.stat(f).st_mtime_ns}" for f in files)
+
+
+def get_shard_sequences(path):
+    if is_binary_shard(path):
+        shard = BinaryShard(path)
+        offsets = shard.offsets
+        return [decode_tokens(shard.tokens[offsets[idx]:offsets[idx + 1]]) for idx in range(len(shard))]
+    return [str(sequence) for sequence in read_json_shard(path)["sequence"]]
+
+
+def scan_shard(path):
+    if is_binary_shard(path):
+        shard = BinaryShard(path)
+        sequences = get_shard_sequences(path)
+        lengths = shard.lengths
+        valid_alphabet = shard.valid_alphabet()
+        ids = shard.ids
+    else:
+        dataframe = read_json_shard(path)
+        sequences = [str(sequence) for sequence in dataframe["sequence"]]
+        lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+        valid_alphabet = np.array([all(char in AMINO_ACIDS for char in sequence) for sequence in sequences],
+                                  dtype=bool)
+        ids = np.array([[str(pdb_id), str(chain_id)] for pdb_id, chain_id in
+                        zip(dataframe["pdb_id"], dataframe["chain_id"])], dtype=str).reshape(-1, 2)
+    return {
+        "row": np.arange(len(sequences), dtype=np.int64),
+        "length": np.asarray(lengths, dtype=np.int64),
+        "valid_alphabet": np.asarray(valid_alphabet, dtype=bool),
+        "sequence_hash": np.fromiter((get_sequence_hash(sequence) for sequence in sequences), dtype=np.uint64,
+                                     count=len(sequences)),
+        "pdb_id": ids[:, 0],
+        "chain_id": ids[:, 1]
+    }
+
+
+class DatasetManifest:
+    """Per-chain metadata of every shard in a directory: shard, row, length, alphabet validity and sequence hash.
+
+    Built once and stored next to the shards. On later starts only shards whose files changed are scanned again,
+    and size or alphabet filtering becomes a mask over the manifest instead of a pass over the shard contents.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.shard_paths = []
+        self.fingerprints = []
+        self.columns = {}
+        # Parameters of the extra columns computed over the whole manifest, such as sequence clusters. Extra columns
+        # are dropped when the shards change.
+        self.attributes = {}
+
+    def __len__(self):
+        return len(self.columns.get("row", ()))
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def load(self):
+        with np.load(self.path) as data:
+            self.shard_paths = [str(path) for path in data["shard_paths"]]
+            self.fingerprints = [str(fingerprint) for fingerprint in data["fingerprints"]]
+            self.attributes = json.loads(str(data["attributes"])) if "attributes" in data.files else {}
+            self.columns = {column: data[column] for column in data.files
+                            if column not in ("shard_paths", "fingerprints", "attributes")}
+        return self
+
+    def save(self):
+        temp_path = self.path + ".tmp.npz"
+        np.savez(temp_path, shard_paths=np.array(self.shard_paths, dtype=str),
+                 fingerprints=np.array(self.fingerprints, dtype=str), attributes=np.array(json.dumps(self.attributes)),
+                 **self.columns)
+        os.replace(temp_path, self.path)
+
+    def set_column(self, column, values, **attributes):
+        self.columns[column] = np.asarray(values)
+        self.attributes[column] = attributes
+        self.save()
+
+    def get_shard_columns(self, shard_idx):
+        rows = self.columns["shard"] == shard_idx
+        return {column: values[rows] for column, values in self.columns.items() if column != "shard"}
+
+    def build(self, shard_paths):
+        shard_paths = list(shard_paths)
+        fingerprints = [get_shard_fingerprint(path) for path in shard_paths]
+        if os.path.exists(self.path):
+            self.load()
+            if self.shard_paths == shard_paths and self.fingerprints == fingerprints:
+                return self
+        known = {(path, fingerprint): idx for idx, (path, fingerprint) in
+                 enumerate(zip(self.shard_paths, self.fingerprints))}
+
+        shard_columns = []
+        for shard_idx, (path, fingerprint) in enumerate(zip(shard_paths, fingerprints)):
+            if (path, fingerprint) in known:
+                columns = self.get_shard_columns(known[(path, fingerprint)])
+            else:
+                print(f"Scanning {path}")
+                columns = scan_shard(path)
+            columns["shard"] = np.full(len(columns["row"]), shard_idx, dtype=np.int32)
+            shard_columns.append(columns)
+
+        self.shard_paths, self.fingerprints, self.attributes = shard_paths, fingerprints, {}
+        if shard_columns:
+            self.columns = {column: np.concatenate([columns[column] for columns in shard_columns])
+                            for column in MANIFEST_COLUMNS}
+        else:
+            self.columns = {column: np.zeros(0) for column in MANIFEST_COLUMNS}
+        self.save()
+        print(f"Manifest of {len(self)} chains in {len(shard_paths)} shards saved at {self.path}")
+        return self
+
+    def get_mask(self, min_size=MIN_SIZE, max_size=MAX_SIZE):
+        lengths = self.columns["length"]
+        return (lengths >= min_size) & (lengths <= max_size) & self.columns["valid_alphabet"]
+
+    def get_row_selections(self, shard_paths, mask):
+        """Selected row indices of each given shard, in row order."""
+        shard_indices = {path: idx for idx, path in enumerate(self.shard_paths)}
+        selected = np.flatnonzero(mask)
+        # The manifest is ordered by shard, so every shard's rows are one contiguous run of the selection
+        shards = self.columns["shard"][selected]
+        selections = {}
+        for path in shard_paths:
+            shard_idx = shard_indices[path]
+            start, end = np.searchsorted(shards, [shard_idx, shard_idx + 1])
+            selections[path] = self.columns["row"][selected[start:end]]
+        return selections
+
+
+if __name__ == '__main__':
+    data_path = os.path.join(MAIN_DIR, "pdb_data_130000")
+    manifest = DatasetManifest(os.path.join(data_path, "manifest.npz")).build(list_shards(data_path))
+    print(f"{manifest.get_mask().sum()} of {len(manifest)} chains pass the size and alphabet filters")
@@ -0,0 +1,60 @@
+import torch
+import torch.nn.functional as F
+
+
+def get_local_index(batch_index, ptr):
+    # Position of every node within its graph
+    return torch.arange(batch_index.size(0), device=batch_index.device) - ptr[batch_index]
+
+
+def to_dense_nodes(x, batch_index, local_index, num_graphs, max_nodes):
+    """(B, max_nodes, F) node features of a PyG style batch, zero padded."""
+    dense = x.new_zeros(num_graphs * max_nodes, x.size(-1))
+    dense[batch_index * max_nodes + local_index] = x
+    return dense.view(num_graphs, max_nodes, x.size(-1))
+
+
+def get_dense_adjacency(edge_index, batch_index, local_index, num_graphs, max_nodes):
+    """(B, L, L) boolean adjacency of a PyG style batch, adj[b, i, j] being set for an edge from node j to node i.
+
+    Every node, including the padding of graphs shorter than max_nodes, gets a self loop as in GATConv, so that
+    every attention row has at least one entry.
+    """
+    sources, targets = edge_index
+    adj = torch.zeros(num_graphs, max_nodes, max_nodes, dtype=torch.bool, device=edge_index.device)
+    adj[batch_index[targets], local_index[targets], local_index[sources]] = True
+    diagonal = torch.arange(max_nodes, device=edge_index.device)
+    adj[:, diagonal, diagonal] = True
+    return adj
+
+
+def get_attention_bias(adj, dtype=torch.float32):
+    # Additive mask shared by all layers: 0 on edges, -inf elsewhere
+    return torch.zeros(adj.shape, dtype=dtype, device=adj.device).masked_fill(~adj, float("-inf")).unsqueeze(1)
+
+
+def dense_gat_conv(layer, x, attention_bias):
+    """GATConv forward as batched dense attention, with the parameters of the given GATConv layer.
+
+    x is (B, L, F) and attention_bias (B, 1, L, L) from get_attention_bias. Matches the scatter-based GATConv on
+    graphs without duplicate edges, and is faster when graphs are small enough for the (B, H, L, L) scores to be
+    cheaper than indexing over the edges.
+    """
+    num_graphs, num_nodes, _ = x.shape
+    heads, channels = layer.heads, layer.out_channels
+    # Older PyG versions name the shared projection lin_src
+    lin = layer.lin if getattr(layer, "lin", None) is not None else layer.lin_src
+    h = lin(x).view(num_graphs, num_nodes, heads, channels).transpose(1, 2)
+
+    alpha_src = (h * layer.att_src.view(1, heads, 1, channels)).sum(dim=-1)
+    alpha_dst = (h * layer.att_dst.view(1, heads, 1, channels)).sum(dim=-1)
+    alpha = F.leaky_relu(alpha_dst.unsqueeze(-1) + alpha_src.unsqueeze(-2), layer.negative_slope) + attention_bias
+    alpha = F.dropout(alpha.softmax(dim=-1), p=layer.dropout, training=layer.training)
+
+    out = torch.matmul(alpha, h).transpose(1, 2)
+    out = out.reshape(num_graphs, num_nodes, heads * channels) if layer.concat else out.mean(dim=2)
+    if getattr(layer, "res", None) is not None:
+        out = out + layer.res(x)
+    if layer.bias is not None:
+        out = out + layer.bias
+    return out
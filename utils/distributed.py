@@ -0,0 +1,121 @@
+import os
+import socket
+from contextlib import contextmanager
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(backend=None):
+    """Join the process group described by the torchrun environment (RANK, WORLD_SIZE, MASTER_ADDR, ...).
+
+    NCCL is used when every process has a GPU and gloo otherwise, so the same entry point trains on CPU-only machines.
+    Returns the device of this process.
+    """
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if backend is None:
+        backend = "nccl" if torch.cuda.is_available() else "gloo"
+    dist.init_process_group(backend=backend)
+    if backend == "nccl":
+        torch.cuda.set_device(local_rank)
+        return f"cuda:{local_rank}"
+    return "cpu"
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+@contextmanager
+def main_process_first():
+    # Rank 0 builds shared files such as the dataset manifest, the other ranks then load them
+    if not is_main_process():
+        barrier()
+    yield
+    if is_main_process():
+        barrier()
+
+
+def all_reduce_sum(tensor):
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def all_reduce_min(tensor):
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.MIN)
+    return tensor
+
+
+def average_gradients(parameters):
+    """All-reduce the gradients of parameters to their mean over the ranks, as DistributedDataParallel does.
+
+    Every rank must call it. A parameter without a gradient on some ranks counts as zero there, and keeps no gradient
+    when it has none on any rank.
+    """
+    parameters = [p for p in parameters if p.requires_grad]
+    if not is_distributed() or not parameters:
+        return
+    has_grad = all_reduce_sum(torch.tensor([float(p.grad is not None) for p in parameters],
+                                           device=parameters[0].device))
+    for parameter, count in zip(parameters, has_grad.tolist()):
+        if count:
+            if parameter.grad is None:
+                parameter.grad = torch.zeros_like(parameter)
+            all_reduce_sum(parameter.grad).div_(get_world_size())
+
+
+def all_gather_objects(obj):
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _run_local_process(local_rank, fn, world_size, backend, port, args):
+    os.environ.update({"RANK": str(local_rank), "LOCAL_RANK": str(local_rank), "WORLD_SIZE": str(world_size),
+                       "MASTER_ADDR": "127.0.0.1", "MASTER_PORT": str(port)})
+    device = init_distributed(backend)
+    try:
+        fn(device, *args)
+    finally:
+        cleanup_distributed()
+
+
+def launch_local(fn, world_size, *args, backend=None):
+    """Run fn(device, *args) in world_size local processes joined in one process group.
+
+    A single-machine stand-in for torchrun, mainly to exercise distributed training with gloo on one Linux box.
+    """
+    mp.spawn(_run_local_process, args=(fn, world_size, backend, get_free_port(), args), nprocs=world_size, join=True)
@@ -1,65 +1,66 @@
 import itertools
 import json
 import os
+import queue
+import re
+import shutil
+import threading
+import time
+from multiprocessing import Pool
+
 import pandas as pd
-import requests
 from Bio import PDB
 import numpy as np
 from Bio.SeqUtils import seq1
-from lxml import etree
 
 from constants import AMINO_ACIDS, MAIN_DIR, NUM_SAMPLES_IN_DATAFRAME
+from utils.binary_shards import OFFSETS_SUFFIX, write_binary_shard
+from utils.pdb_scanner import scan_ca_chains
+from utils.uniprot_pdb_resolver import UNIPROT_BASE_URL, fetch_pdb_ids_concurrent, iter_uniprot_pdb_references
 
 pdb_list = PDB.PDBList()
 parser = PDB.PDBParser()
 
 
-def get_pdb_ids_from_uniprot_xml(xml_file, json_path='pdn_ids.json'):
-    if os.path.exists(json_path):
-        with open(json_path, 'r') as f:
-            data = json.load(f)
+def get_pdb_ids_from_uniprot_xml(xml_file, cache_path='pdb_ids.jsonl', remote=False, num_workers=16,
+                                 base_url=UNIPROT_BASE_URL):
+    # The XML entries already carry their PDB cross-references, remote lookups are only needed for stale files
+    if remote:
+        accessions = [accession for accession, _ in iter_uniprot_pdb_references(xml_file)]
+        data = fetch_pdb_ids_concurrent(accessions, cache_path, num_workers=num_workers, base_url=base_url)
     else:
-        data = {}
-
-    accessions = data.keys()
-    context = etree.iterparse(xml_file, events=('end',), tag='{http://uniprot.org/uniprot}entry')
-
-    counter = 0
-    for event, elem in context:
-        accession = elem.findtext('{http://uniprot.org/uniprot}accession')
-        print("processing protein: " + accession)
-        if accession in accessions:
-            continue
-
-        data[accession] = fetch_pdb_ids(accession)
-
-        # Write to JSON every 100 iterations
-        if (counter + 1) % 100 == 0:
-            with open(json_path, 'w') as f:
-                json.dump(data, f)
-        counter += 1
+        data = dict(iter_uniprot_pdb_references(xml_file))
+    return list(set(itertools.chain(*data.values())))  # Remove duplicates
 
-    # Write any remaining data to JSON
-    with open(json_path, 'w') as f:
-        json.dump(data, f)
 
-    return list(set(itertools.chain(*data.values())))  # Remove duplicates
+def process_pdb_id(pdb_id, pdb_dir, offline=False, fast=True, first_model_only=False):
+    pdb_file = os.path.join(pdb_dir, f'pdb{pdb_id.lower()}.ent')
+    if not os.path.exists(pdb_file):
+        if offline:
+            raise FileNotFoundError(f"{pdb_file} is missing and downloads are disabled")
+        pdb_file = download_pdb(pdb_id, pdb_dir)
+    if fast:
+        chain_ids, chain_sequences, chain_coords, structure_info = scan_ca_chains(pdb_file, first_model_only)
+    else:
+        structure = parser.get_structure(pdb_id, pdb_file)
+        structure_info = get_structure_info(structure)
+        chain_ids, chain_sequences, chain_coords = extract_amino_acid_chains(structure, first_model_only)
 
+    return [{
+        'pdb_id': pdb_id,
+        'chain_id': chain_id,
+        'sequence': sequence,
+        "coords": coords,
+        "structure_info": structure_info
+    } for chain_id, sequence, coords in zip(chain_ids, chain_sequences, chain_coords)]
 
-def fetch_pdb_ids(uniprot_id):
-    url = f"https://www.uniprot.org/uniprot/{uniprot_id}.xml"
-    response = requests.get(url)
-    if response.status_code != 200:
-        print(f"Failed to retrieve data for {uniprot_id}")
-        return None
 
-    # Parse XML to find PDB IDs
-    tree = etree.fromstring(response.content)
-    pdb_ids = []
-    for db_reference in tree.findall(".//{http://uniprot.org/uniprot}dbReference[@type='PDB']"):
-        pdb_id = db_reference.get('id')
-        pdb_ids.append(pdb_id)
-    return pdb_ids
+def _process_pdb_id(args):
+    pdb_id, pdb_dir, offline, fast, first_model_only = args
+    try:
+        return pdb_id, process_pdb_id(pdb_id, pdb_dir, offline, fast, first_model_only), None
+    except Exception as err:
+        return pdb_id, None, f"{type(err).__name__}: {err}"
 
 
 def get_pdb_data(pdb_ids, output_path, dataframe_dir_name="pdb_data", num_samples_in_df=NUM_SAMPLES_IN_DATAFRAME):
@@ -71,19 +72,7 @@ def get_pdb_data(pdb_ids, output_path, dataframe_dir_name="pdb_data", num_sample
 
     for pdb_id in pdb_ids:
         try:
-            pdb_file = download_pdb(pdb_id, os.path.join(output_path, 'pdb_files'))
-            structure = parser.get_structure(pdb_id, pdb_file)
-            structure_info = get_structure_info(structure)
-            chain_ids, chain_sequences, chain_coords = extract_amino_acid_chains(structure)
-
-            for chain_id, sequence, coords in zip(chain_ids, chain_sequences, chain_coords):
-                data.append({
-                    'pdb_id': pdb_id,
-                    'chain_id': chain_id,
-                    'sequence': sequence,
-                    "coords": coords,
-                    "structure_info": structure_info
-                })
+            data.extend(process_pdb_id(pdb_id, os.path.join(output_path, 'pdb_files')))
 
             if len(data) >= num_samples_in_df:
                 df = pd.DataFrame(data)
@@ -100,9 +89,184 @@ def get_pdb_data(pdb_ids, output_path, dataframe_dir_name="pdb_data", num_sample
         save_dataframe(df, dataframe_output_dir, file_index)
 
 
+def read_manifest_entries(manifest_path):
+    if not os.path.exists(manifest_path):
+        return []
+    with open(manifest_path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_manifest(manifest_path):
+    # Latest status of every PDB ID recorded by previous runs
+    return {entry["pdb_id"]: entry for entry in read_manifest_entries(manifest_path) if entry.get("pdb_id") is not None}
+
+
+def get_shard_files(dataframe_output_dir):
+    # File index of every JSON-lines or binary shard file in the directory
+    shard_files = {}
+    for fname in os.listdir(dataframe_output_dir):
+        match = re.fullmatch(r"pdb_df_(\d+)\..+", fname)
+        if match:
+            shard_files[fname] = int(match.group(1))
+    return shard_files
+
+
+def get_next_file_index(dataframe_output_dir):
+    return max(get_shard_files(dataframe_output_dir).values(), default=-1) + 1
+
+
+def prepare_shard_directory(dataframe_output_dir, manifest_path):
+    """Remove the shard files that the manifest does not reference, left behind by a run stopped mid-write.
+
+    Their PDB IDs are not marked done, so a rerun parses them into a new shard and keeping the files would
+    duplicate their chains. Shards written before the directory had a manifest are recorded in it as existing.
+    """
+    shutil.rmtree(os.path.join(dataframe_output_dir, ".tmp"), ignore_errors=True)
+    shard_files = get_shard_files(dataframe_output_dir)
+    if not os.path.exists(manifest_path):
+        with open(manifest_path, 'a') as f:
+            for file_index in sorted(set(shard_files.values())):
+                f.write(json.dumps({"pdb_id": None, "status": "existing", "shard": file_index}) + "\n")
+        return
+
+    referenced = {entry.get("shard") for entry in read_manifest_entries(manifest_path)
+                  if entry["status"] in ("done", "existing")}
+    for fname, file_index in shard_files.items():
+        if file_index not in referenced:
+            print(f"Removing {fname}, its shard is missing from the manifest")
+            os.remove(os.path.join(dataframe_output_dir, fname))
+
+
+class ShardWriter(threading.Thread):
+    """Consumes (pdb_id, rows, error) results from a queue and writes full shards.
+
+    PDB IDs are marked done in the manifest only after the shard holding their chains is written, failures are
+    recorded with their error right away.
+    """
+
+    def __init__(self, results_queue, dataframe_output_dir, manifest_path, num_samples_in_df=NUM_SAMPLES_IN_DATAFRAME):
+        super(ShardWriter, self).__init__(daemon=True)
+        self.results_queue = results_queue
+        self.dataframe_output_dir = dataframe_output_dir
+        self.manifest_path = manifest_path
+        self.num_samples_in_df = num_samples_in_df
+        self.file_index = get_next_file_index(dataframe_output_dir)
+        self.num_chains = 0
+        self.num_failed = 0
+        self.data = []
+        self.pending = []
+        self.error = None
+
+    def write_manifest(self, entries):
+        with open(self.manifest_path, 'a') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def flush(self):
+        if self.data:
+            save_dataframe(pd.DataFrame(self.data), self.dataframe_output_dir, self.file_index)
+        self.write_manifest([{"pdb_id": pdb_id, "status": "done", "num_chains": num_chains,
+                              "shard": self.file_index if self.data else None}
+                             for pdb_id, num_chains in self.pending])
+        if self.data:
+            self.file_index += 1
+        self.data, self.pending = [], []
+
+    def put(self, result, timeout=1.0):
+        # Waits for room in the queue while the writer is alive, raising its error instead of blocking forever
+        while True:
+            self.check()
+            try:
+                self.results_queue.put(result, timeout=timeout)
+                return
+            except queue.Full:
+                pass
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError("Shard writer failed, the PDB IDs of unwritten shards stay pending") from self.error
+
+    def run(self):
+        try:
+            self.consume()
+        except Exception as err:
+            self.error = err
+
+    def consume(self):
+        while True:
+            result = self.results_queue.get()
+            if result is None:
+                break
+            pdb_id, rows, error = result
+            if error is not None:
+                self.num_failed += 1
+                self.write_manifest([{"pdb_id": pdb_id, "status": "failed", "error": error}])
+                continue
+
+            self.data.extend(rows)
+            self.pending.append((pdb_id, len(rows)))
+            self.num_chains += len(rows)
+            if len(self.data) >= self.num_samples_in_df:
+                self.flush()
+        if self.pending:
+            self.flush()
+
+
+def get_pdb_data_parallel(pdb_ids, output_path, dataframe_dir_name="pdb_data",
+                          num_samples_in_df=NUM_SAMPLES_IN_DATAFRAME, num_workers=None, pdb_dir=None, offline=False,
+                          fast=True, first_model_only=False, log_interval=1000):
+    """Process-pool version of get_pdb_data that can be stopped and rerun.
+
+    Structures are parsed in worker processes and their chains streamed through a queue to a writer thread. Progress
+    is kept in manifest.jsonl next to the shards, so a rerun skips IDs that are already done and retries the failed
+    ones. With offline=True only .ent files already in pdb_dir are used. fast=True extracts the chains with
+    scan_ca_chains instead of a Biopython structure, first_model_only drops the extra models of NMR entries.
+    """
+    dataframe_output_dir = os.path.join(output_path, dataframe_dir_name)
+    os.makedirs(dataframe_output_dir, exist_ok=True)
+    pdb_dir = pdb_dir or os.path.join(output_path, 'pdb_files')
+    manifest_path = os.path.join(dataframe_output_dir, "manifest.jsonl")
+
+    prepare_shard_directory(dataframe_output_dir, manifest_path)
+    statuses = load_manifest(manifest_path)
+    pdb_ids = [pdb_id for pdb_id in dict.fromkeys(pdb_ids) if statuses.get(pdb_id, {}).get("status") != "done"]
+    print(f"Processing {len(pdb_ids)} PDB IDs, {len(statuses)} already in the manifest")
+
+    results_queue = queue.Queue(maxsize=4 * (num_workers or os.cpu_count()))
+    writer = ShardWriter(results_queue, dataframe_output_dir, manifest_path, num_samples_in_df)
+    writer.start()
+
+    start_time = time.time()
+    with Pool(num_workers) as pool:
+        tasks = ((pdb_id, pdb_dir, offline, fast, first_model_only) for pdb_id in pdb_ids)
+        for count, result in enumerate(pool.imap_unordered(_process_pdb_id, tasks, chunksize=8), start=1):
+            writer.put(result)
+            if count % log_interval == 0:
+                elapsed_time = time.time() - start_time
+                print(f"Processed {count} of {len(pdb_ids)} PDB IDs, {writer.num_chains} chains, "
+                      f"{writer.num_failed} failed, {writer.num_chains / elapsed_time:.1f} chains/sec")
+
+    writer.put(None)
+    writer.join()
+    writer.check()
+    print(f"Done: {writer.num_chains} chains, {writer.num_failed} failed PDB IDs, "
+          f"{time.time() - start_time:.1f} seconds")
+
+
 def save_dataframe(df, output_path, file_index):
-    df.to_csv(os.path.join(output_path, f"pdb_df_{file_index}.csv"), index=False)
-    df.to_json(os.path.join(output_path, f"pdb_df_{file_index}.json"), orient='records', lines=True)
+    # Written under a temporary directory and moved into place, the offsets file and the JSON-lines shard last since
+    # they are what list_shards looks for, so a stopped run never leaves a partial shard under its final name
+    temp_dir = os.path.join(output_path, ".tmp")
+    os.makedirs(temp_dir, exist_ok=True)
+    name = f"pdb_df_{file_index}"
+    df.to_json(os.path.join(temp_dir, name + ".json"), orient='records', lines=True)
+    write_binary_shard(df, os.path.join(temp_dir, name))
+    fnames = sorted(fname for fname in os.listdir(temp_dir) if fname.startswith(name + "."))
+    fnames.sort(key=lambda fname: (fname.endswith(OFFSETS_SUFFIX), fname.endswith(".json")))
+    for fname in fnames:
+        os.replace(os.path.join(temp_dir, fname), os.path.join(output_path, fname))
 
 
 def download_pdb(pdb_id, pdb_dir='pdb_files'):
@@ -114,11 +278,11 @@ def download_pdb(pdb_id, pdb_dir='pdb_files'):
     return pdb_file_path
 
 
-def extract_amino_acid_chains(structure):
+def extract_amino_acid_chains(structure, first_model_only=False):
     chain_ids = []
     chain_sequences = []
     chain_coords = []
-    for model in structure:
+    for model in (list(structure)[:1] if first_model_only else structure):
         for chain in model:
             sequence = []
             coords = []
@@ -144,6 +308,7 @@ def get_structure_info(structure):
     }
 
 
-pdb_ids = get_pdb_ids_from_uniprot_xml(os.path.join(MAIN_DIR, r"UniProt\uniprot_sprot.xml\uniprot_sprot.xml"),
-                                       os.path.join(MAIN_DIR, "PDB", "UniProt2PBD.json"))
-get_pdb_data(pdb_ids, output_path=os.path.join(MAIN_DIR, "PDB"))
+if __name__ == '__main__':
+    pdb_ids = get_pdb_ids_from_uniprot_xml(os.path.join(MAIN_DIR, r"UniProt\uniprot_sprot.xml\uniprot_sprot.xml"),
+                                           os.path.join(MAIN_DIR, "PDB", "UniProt2PBD.jsonl"))
+    get_pdb_data_parallel(pdb_ids, output_path=os.path.join(MAIN_DIR, "PDB"))
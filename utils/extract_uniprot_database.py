@@ -1,48 +1,199 @@
+import os
+from multiprocessing import Pool
+
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from lxml import etree
 
+NS = '{http://uniprot.org/uniprot}'
+ROOT_START = b'<uniprot xmlns="http://uniprot.org/uniprot" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+ROOT_END = b'</uniprot>'
+UNIPROT_SCHEMA = pa.schema([
+    ('accession', pa.string()),
+    ('sequence', pa.string()),
+    ('protein_names', pa.list_(pa.string())),
+    ('organism', pa.string()),
+    ('function', pa.string()),
+    ('subcellular_location', pa.string()),
+    ('tissue_specificity', pa.string()),
+    ('domain_structure', pa.list_(pa.string())),
+    ('ptms', pa.list_(pa.string())),
+    ('interactions', pa.list_(pa.string())),
+    ('sequence_annotations', pa.list_(pa.struct([('description', pa.string()), ('evidence', pa.string())]))),
+])
+UNIPROT_FIELDS = UNIPROT_SCHEMA.names
+# Fields read from the direct children of an entry, the others need a walk over all its descendants
+ENTRY_CHILD_FIELDS = {'accession', 'sequence'}
+COMMENT_FIELDS = {'function': 'function', 'tissue specificity': 'tissue_specificity'}
+FIELD_TAGS = {
+    'protein_names': 'fullName', 'organism': 'name', 'function': 'text', 'tissue_specificity': 'text',
+    'subcellular_location': 'location', 'domain_structure': 'feature', 'ptms': 'feature',
+    'sequence_annotations': 'feature', 'interactions': 'geneName'
+}
+
+
+def parse_entry(elem, fields=UNIPROT_FIELDS):
+    row = {field: None for field in fields}
+    for field in ('protein_names', 'domain_structure', 'ptms', 'interactions', 'sequence_annotations'):
+        if field in row:
+            row[field] = []
+
+    for child in elem:
+        if child.tag == NS + 'accession' and 'accession' in row and row['accession'] is None:
+            row['accession'] = child.text
+        elif child.tag == NS + 'sequence' and 'sequence' in row and row['sequence'] is None:
+            row['sequence'] = child.text
+    if ENTRY_CHILD_FIELDS.issuperset(fields):
+        return row
+
+    # Single pass over the descendants with the tags of the selected fields, matching on the tag and its parent
+    # instead of one findall per field
+    tags = {NS + FIELD_TAGS[field] for field in fields if field in FIELD_TAGS}
+    for node in elem.iter(*tags):
+        tag = node.tag[len(NS):]
+        if tag == 'fullName':
+            if 'protein_names' in row:
+                row['protein_names'].append(node.text)
+        elif tag == 'name':
+            parent = node.getparent()
+            if parent.tag == NS + 'organism' and 'organism' in row and row['organism'] is None:
+                row['organism'] = node.text or ''
+        elif tag == 'text':
+            field = COMMENT_FIELDS.get(node.getparent().get('type'))
+            if field in row and row[field] is None and node.getparent().tag == NS + 'comment':
+                row[field] = node.text or ''
+        elif tag == 'location':
+            parent = node.getparent()
+            if (parent.tag == NS + 'subcellularLocation' and parent.getparent().tag == NS + 'comment'
+                    and parent.getparent().get('type') == 'subcellular location'
+                    and 'subcellular_location' in row and row['subcellular_location'] is None):
+                row['subcellular_location'] = node.text or ''
+        elif tag == 'feature':
+            description = node.get('description')
+            feature_type = node.get('type')
+            if feature_type == 'domain' and 'domain_structure' in row:
+                row['domain_structure'].append(description)
+            elif feature_type == 'modified residue' and 'ptms' in row:
+                row['ptms'].append(description)
+            if 'sequence_annotations' in row:
+                row['sequence_annotations'].append((description, node.get('evidence')))
+        elif tag == 'geneName':
+            if node.getparent().tag == NS + 'interactant' and 'interactions' in row:
+                row['interactions'].append(node.text)
+    return row
+
 
-def parse_uniprot_xml(xml_file):
-    data = []
-    context = etree.iterparse(xml_file, events=('end',), tag='{http://uniprot.org/uniprot}entry')
+def iter_uniprot_entries(xml_file, fields=UNIPROT_FIELDS):
+    """Yield one dict per UniProt entry with the selected fields, in constant memory."""
+    context = etree.iterparse(xml_file, events=('end',), tag=NS + 'entry')
     for event, elem in context:
-        accession = elem.findtext('{http://uniprot.org/uniprot}accession')
-        sequence = elem.findtext('{http://uniprot.org/uniprot}sequence')
-        protein_names = [name.text for name in elem.findall('.//{http://uniprot.org/uniprot}fullName')]
-        organism = elem.findtext('.//{http://uniprot.org/uniprot}organism/{http://uniprot.org/uniprot}name')
-        function = elem.findtext('.//{http://uniprot.org/uniprot}comment[@type="function"]/{http://uniprot.org/uniprot}text')
-        subcellular_location = elem.findtext('.//{http://uniprot.org/uniprot}comment[@type="subcellular location"]/{http://uniprot.org/uniprot}subcellularLocation/{http://uniprot.org/uniprot}location')
-        tissue_specificity = elem.findtext('.//{http://uniprot.org/uniprot}comment[@type="tissue specificity"]/{http://uniprot.org/uniprot}text')
-        domain_structure = [domain.get('description') for domain in
-                            elem.findall('.//{http://uniprot.org/uniprot}feature[@type="domain"]')]
-        ptms = [ptm.get('description') for ptm in
-                elem.findall('.//{http://uniprot.org/uniprot}feature[@type="modified residue"]')]
-        interactions = [interaction.text for interaction in
-                        elem.findall('.//{http://uniprot.org/uniprot}interactant/{http://uniprot.org/uniprot}geneName')]
-        sequence_annotations = [(annot.get('description'), annot.get('evidence')) for annot in
-                                elem.findall('.//{http://uniprot.org/uniprot}feature')]
-
-        data.append({
-            'accession': accession,
-            'sequence': sequence,
-            'protein_names': protein_names,
-            'organism': organism,
-            'function': function,
-            'subcellular_location': subcellular_location,
-            'tissue_specificity': tissue_specificity,
-            'domain_structure': domain_structure,
-            'ptms': ptms,
-            'interactions': interactions,
-            'sequence_annotations': sequence_annotations,
-        })
+        yield parse_entry(elem, fields)
         elem.clear()
         while elem.getprevious() is not None:
             del elem.getparent()[0]
 
-    return pd.DataFrame(data)
+
+def parse_uniprot_xml(xml_file, fields=UNIPROT_FIELDS):
+    return pd.DataFrame(list(iter_uniprot_entries(xml_file, fields)), columns=fields)
+
+
+def write_row_groups(rows, output_path, fields=UNIPROT_FIELDS, row_group_size=10000):
+    schema = pa.schema([UNIPROT_SCHEMA.field(field) for field in fields])
+    num_rows = 0
+    with pq.ParquetWriter(output_path, schema) as writer:
+        columns = {field: [] for field in fields}
+        for row in rows:
+            for field in fields:
+                columns[field].append(row[field])
+            num_rows += 1
+            if num_rows % row_group_size == 0:
+                writer.write_table(pa.table(columns, schema=schema))
+                columns = {field: [] for field in fields}
+        if len(columns[fields[0]]):
+            writer.write_table(pa.table(columns, schema=schema))
+    return num_rows
+
+
+def export_uniprot_parquet(xml_file, output_path, fields=UNIPROT_FIELDS, row_group_size=10000):
+    return write_row_groups(iter_uniprot_entries(xml_file, fields), output_path, fields, row_group_size)
+
+
+class ByteRangeReader:
+    """File-like view of the entries between two byte offsets, wrapped in a uniprot root element."""
+
+    def __init__(self, xml_file, start, end, chunk_size=1 << 20):
+        self.f = open(xml_file, 'rb')
+        self.f.seek(start)
+        self.remaining = end - start
+        self.chunk_size = chunk_size
+        self.pending = ROOT_START
+        self.done = False
+
+    def read(self, size=-1):
+        size = self.chunk_size if size is None or size < 0 else size
+        while len(self.pending) < size and not self.done:
+            chunk = self.f.read(min(self.chunk_size, self.remaining))
+            self.remaining -= len(chunk)
+            if not chunk or self.remaining <= 0:
+                chunk += ROOT_END
+                self.done = True
+                self.f.close()
+            self.pending += chunk
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+def find_entry_start(f, position, end, chunk_size=1 << 20):
+    # First '<entry' tag at or after position, so that splits never cut an entry in two
+    f.seek(position)
+    while position < end:
+        chunk = f.read(chunk_size + 6)
+        offset = 0
+        while True:
+            offset = chunk.find(b'<entry', offset)
+            if offset < 0 or offset >= chunk_size:
+                break
+            if chunk[offset + 6:offset + 7] in (b' ', b'>'):
+                return position + offset
+            offset += 1
+        position += chunk_size
+        f.seek(position)
+    return end
+
+
+def get_split_offsets(xml_file, num_splits):
+    """Byte ranges of about equal size that start at an entry and together cover every entry of the file."""
+    size = os.path.getsize(xml_file)
+    with open(xml_file, 'rb') as f:
+        f.seek(max(size - (1 << 16), 0))
+        tail = f.read()
+        entries_end = size - len(tail) + tail.rfind(ROOT_END)
+        starts = [find_entry_start(f, size * idx // num_splits, entries_end) for idx in range(num_splits)]
+    boundaries = sorted(set(starts)) + [entries_end]
+    return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if start < end]
+
+
+def _export_split(args):
+    xml_file, start, end, output_path, fields, row_group_size = args
+    return output_path, export_uniprot_parquet(ByteRangeReader(xml_file, start, end), output_path, fields,
+                                               row_group_size)
+
+
+def export_uniprot_parquet_parallel(xml_file, output_dir, fields=UNIPROT_FIELDS, num_workers=None,
+                                    row_group_size=10000):
+    """Parse byte-range splits of the XML in parallel, one Parquet part file per split under output_dir."""
+    num_workers = num_workers or os.cpu_count()
+    os.makedirs(output_dir, exist_ok=True)
+    splits = get_split_offsets(xml_file, 4 * num_workers)
+    tasks = [(xml_file, start, end, os.path.join(output_dir, f"part-{idx:05d}.parquet"), fields, row_group_size)
+             for idx, (start, end) in enumerate(splits)]
+    with Pool(num_workers) as pool:
+        results = pool.map(_export_split, tasks, chunksize=1)
+    print(f"Exported {sum(num_rows for _, num_rows in results)} entries to {len(results)} files in {output_dir}")
+    return [output_path for output_path, _ in results]
 
 
 if __name__ == '__main__':
     xml_file_path = r'D:\python project\data\uniprot_sprot.xml\uniprot_sprot.xml'
-    protein_df = parse_uniprot_xml(xml_file_path)
-    protein_df.to_csv("uniprot_df.csv")
+    export_uniprot_parquet_parallel(xml_file_path, "uniprot_parquet")
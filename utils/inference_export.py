@@ -0,0 +1,147 @@
+import copy
+import json
+import os
+
+import torch
+from torch import nn
+from torch.ao.quantization import default_dynamic_qconfig, quantize_dynamic
+from torch_geometric.nn.dense.linear import Linear as GeometricLinear
+
+from strategies.sequence_to_distogram import SequenceToDistogram
+
+
+def replace_geometric_linears(model):
+    """Swap the PyG Linear layers, e.g. the projections of GATConv, for equivalent nn.Linear layers in place.
+
+    Dynamic quantization only recognizes nn.Linear, and the GAT projections hold most of the ContactMapToSequence
+    weights.
+    """
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, GeometricLinear):
+                linear = nn.Linear(child.in_channels, child.out_channels, bias=child.bias is not None)
+                linear.weight.data.copy_(child.weight.data)
+                if child.bias is not None:
+                    linear.bias.data.copy_(child.bias.data)
+                setattr(module, name, linear)
+    return model
+
+
+def get_unquantized_modules(strategy):
+    # The factorized pair head splits the weight of the first MLP layer itself, so it has to stay a float Linear
+    if isinstance(strategy, SequenceToDistogram) and strategy.pair_mode != "concat":
+        return {"mlp.0"}
+    return set()
+
+
+def quantize_dynamic_int8(strategy):
+    """Copy of the strategy in eval mode with int8 weights and dynamically quantized activations in its Linear layers.
+
+    Covers the RoBERTa encoder and MLP head of SequenceToDistogram and the GAT projections and output head of
+    ContactMapToSequence. Only worth it on CPU.
+    """
+    model = replace_geometric_linears(copy.deepcopy(strategy).cpu().eval())
+    skipped = get_unquantized_modules(strategy)
+    qconfig_spec = {name: default_dynamic_qconfig for name, module in model.named_modules()
+                    if isinstance(module, nn.Linear) and name not in skipped}
+    return quantize_dynamic(model, qconfig_spec, dtype=torch.qint8)
+
+
+def get_example_inputs(strategy, rows, batch_size=1):
+    """Collated inputs of the first batch_size rows, cropped as in evaluation.
+
+    Only the tensors are kept, since a TorchScript trace takes no plain values, so ContactMapToSequence runs its
+    sparse GAT layers that do not depend on the graph sizes.
+    """
+    was_training = strategy.training
+    strategy.eval()
+    inputs, _ = strategy.collate([strategy.load_inputs_and_ground_truth(row) for row in rows[:batch_size]])
+    strategy.train(was_training)
+    return tuple(x for x in inputs if isinstance(x, torch.Tensor))
+
+
+def export_torchscript(model, example_inputs, path=None):
+    """Trace the forward of a model in eval mode and freeze it, saving it at path when given.
+
+    The traced graph keeps the batch and graph sizes symbolic, so one export serves every batch size.
+    """
+    model.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(model, (example_inputs,), check_trace=False)
+    traced = torch.jit.freeze(traced)
+    if path:
+        torch.jit.save(traced, path)
+    return traced
+
+
+def get_prediction(outputs):
+    # SequenceToDistogram returns (distograms, mask)
+    return outputs[0] if isinstance(outputs, (tuple, list)) else outputs
+
+
+def check_parity(reference, candidate, inputs_list, atol=0.02, min_agreement=0.95):
+    """Compare the outputs of a candidate model with the fp32 reference over batches of inputs.
+
+    Reports the maximum and mean absolute difference of the outputs, and for per-residue class probabilities the
+    fraction of positions where both models predict the same residue.
+    """
+    differences, agreements = [], []
+    with torch.no_grad():
+        for inputs in inputs_list:
+            expected = get_prediction(reference(inputs)).float()
+            actual = get_prediction(candidate(inputs)).float()
+            differences.append((expected - actual).abs().flatten())
+            if expected.dim() == 2:
+                agreements.append((expected.argmax(dim=-1) == actual.argmax(dim=-1)).float())
+    differences = torch.cat(differences)
+    result = {"max_abs_diff": differences.max().item(), "mean_abs_diff": differences.mean().item()}
+    passed = result["mean_abs_diff"] <= atol
+    if agreements:
+        result["top1_agreement"] = torch.cat(agreements).mean().item()
+        passed = passed and result["top1_agreement"] >= min_agreement
+    result["passed"] = bool(passed)
+    return result
+
+
+def export_strategy(strategy, rows, output_dir, batch_size=8, quantize=True):
+    """Export the fp32 and, with quantize, the int8 forward of a strategy as TorchScript under output_dir.
+
+    Parity against the fp32 eager model is checked on the given rows and saved next to the models as parity.json.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    strategy = copy.deepcopy(strategy).cpu().eval()
+    inputs_list = [get_example_inputs(strategy, rows[start:], batch_size)
+                   for start in range(0, len(rows), batch_size)]
+    name = strategy.__class__.__name__
+    models = {"fp32": strategy}
+    if quantize:
+        models["int8"] = quantize_dynamic_int8(strategy)
+
+    report = {}
+    for precision, model in models.items():
+        path = os.path.join(output_dir, f"{name}_{precision}.pt")
+        traced = export_torchscript(model, inputs_list[0], path)
+        report[precision] = check_parity(strategy, traced, inputs_list)
+        report[precision]["path"] = path
+        print(f"{name} {precision}: saved at {path}, parity {report[precision]}")
+    with open(os.path.join(output_dir, "parity.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def load_exported(path, num_threads=None):
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    return torch.jit.load(path, map_location="cpu")
+
+
+if __name__ == '__main__':
+    from constants import MAIN_DIR
+    from strategies.contact_map_to_sequence import ContactMapToSequence
+    from utils.binary_shards import BinaryShard, list_shards
+
+    strategy = ContactMapToSequence()
+    model_path = os.path.join(MAIN_DIR, "models", "ContactMapToSequence", "20241005", "best_model.pth")
+    strategy.load_state_dict(torch.load(model_path, map_location="cpu"))
+    shard = BinaryShard(list_shards(os.path.join(MAIN_DIR, "pdb_data_130000"))[0])
+    export_strategy(strategy, [shard[idx] for idx in range(min(256, len(shard)))], os.path.join(MAIN_DIR, "exported"))
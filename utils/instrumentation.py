@@ -0,0 +1,170 @@
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+from utils.distributed import get_rank, get_world_size, is_main_process
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is then not reported
+    resource = None
+
+# Stages timed inside the DataLoader workers and sent along with every batch
+LOADER_STAGES = ["parse", "featurize", "collate"]
+
+
+def get_peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class NullInstrumentation:
+    """Instrumentation that records nothing, the default of the Trainer."""
+    enabled = False
+    _null_context = nullcontext()
+
+    def start_batch(self, epoch, batch_idx, data_wait=0.0, loader_stats=None):
+        pass
+
+    def stage(self, name):
+        return self._null_context
+
+    def end_batch(self, num_samples):
+        pass
+
+    def end_epoch(self, epoch, stats):
+        pass
+
+    def close(self):
+        pass
+
+
+class TrainingInstrumentation:
+    """Per-batch stage timings, throughput and memory of a training run, written as JSONL.
+
+    Every batch becomes one record with the seconds spent in each stage, from shard parsing, sample featurization
+    (contact maps) and collate in the DataLoader workers to data wait, host to device transfer, forward, backward and
+    the optimizer step in the training loop, together with samples and residues per second, the peak RSS of the
+    process and the peak device memory of the batch. An epoch record sums the stages over the epoch.
+
+    The worker stages run in parallel with the training loop, so they only add up to the batch time with
+    num_workers=0. On CUDA the device is synchronized around every stage unless synchronize is False, which times the
+    stages correctly but removes the overlap of host and device work. A torch.profiler trace of the batches in
+    profile_batches, a (first, last) range of batch indices of the first epoch, is saved as a Chrome trace.
+    """
+    enabled = True
+
+    def __init__(self, output_path, device="cpu", profile_batches=None, profile_path=None, synchronize=True):
+        # Every rank of a distributed run writes its own file
+        if get_world_size() > 1:
+            root, ext = os.path.splitext(output_path)
+            output_path = f"{root}.rank{get_rank()}{ext}"
+        directory = os.path.dirname(output_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.output_path = output_path
+        self.file = open(output_path, "a")
+        self.device = torch.device(device)
+        self.synchronize = synchronize and self.device.type == "cuda"
+        self.profile_batches = profile_batches
+        self.profile_path = profile_path or os.path.splitext(output_path)[0] + ".trace.json"
+        self.profiler = None
+        self.profiled = False
+
+        self.epoch = 0
+        self.batch_idx = 0
+        self.stage_times = {}
+        self.num_residues = 0
+        self.batch_start_time = None
+        self.epoch_stage_times = defaultdict(float)
+        self.epoch_samples = 0
+        self.epoch_residues = 0
+
+    def sync(self):
+        if self.synchronize:
+            torch.cuda.synchronize(self.device)
+
+    def start_batch(self, epoch, batch_idx, data_wait=0.0, loader_stats=None):
+        self.epoch, self.batch_idx = epoch, batch_idx
+        # The batch time runs from the moment the previous batch ended, so it includes the wait for this one
+        self.batch_start_time = time.perf_counter() - data_wait
+        self.stage_times = {"data_wait": data_wait}
+        self.num_residues = 0
+        if loader_stats:
+            self.num_residues = loader_stats.get("residues", 0)
+            for name in LOADER_STAGES:
+                self.stage_times[name] = loader_stats.get(name, 0.0)
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+        if self.profile_batches is not None and not self.profiled and batch_idx == self.profile_batches[0]:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type == "cuda":
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.profiler.start()
+
+    @contextmanager
+    def stage(self, name):
+        self.sync()
+        start_time = time.perf_counter()
+        with torch.profiler.record_function(name) if self.profiler is not None else nullcontext():
+            yield
+            self.sync()
+        self.stage_times[name] = self.stage_times.get(name, 0.0) + time.perf_counter() - start_time
+
+    def end_batch(self, num_samples):
+        seconds = time.perf_counter() - self.batch_start_time
+        record = {"event": "batch", "epoch": self.epoch, "batch": self.batch_idx, "samples": num_samples,
+                  "residues": self.num_residues, "seconds": seconds,
+                  "samples_per_second": num_samples / seconds, "residues_per_second": self.num_residues / seconds,
+                  "stages": self.stage_times, "peak_rss_bytes": get_peak_rss_bytes(),
+                  "peak_device_bytes": torch.cuda.max_memory_allocated(self.device)
+                  if self.device.type == "cuda" else None}
+        self.file.write(json.dumps(record) + "\n")
+        for name, stage_seconds in self.stage_times.items():
+            self.epoch_stage_times[name] += stage_seconds
+        self.epoch_samples += num_samples
+        self.epoch_residues += self.num_residues
+
+        if self.profiler is not None and self.batch_idx >= self.profile_batches[1]:
+            self.stop_profiler()
+
+    def stop_profiler(self):
+        self.profiler.stop()
+        self.profiler.export_chrome_trace(self.profile_path)
+        self.profiler, self.profiled = None, True
+        print(f"Profiler trace saved at {self.profile_path}")
+
+    def end_epoch(self, epoch, stats):
+        if self.profiler is not None:
+            self.stop_profiler()
+        # Samples and residues of this process, the stats of a distributed epoch count those of all ranks
+        seconds = max(stats["seconds"], 1e-9)
+        residues_per_second = self.epoch_residues / seconds
+        record = {"event": "epoch", "epoch": epoch, "batches": stats["batches"], "samples": self.epoch_samples,
+                  "residues": self.epoch_residues, "seconds": stats["seconds"],
+                  "samples_per_second": self.epoch_samples / seconds, "residues_per_second": residues_per_second,
+                  "loss": stats["loss"], "stages": dict(self.epoch_stage_times),
+                  "peak_rss_bytes": get_peak_rss_bytes()}
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        if is_main_process():
+            stages = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.epoch_stage_times.items())
+            print(f"Epoch {epoch + 1} stages: {stages}, {residues_per_second:.1f} residues/sec.")
+        self.epoch_stage_times = defaultdict(float)
+        self.epoch_samples, self.epoch_residues = 0, 0
+
+    def close(self):
+        if self.profiler is not None:
+            self.stop_profiler()
+        self.file.close()
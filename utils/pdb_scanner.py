@@ -0,0 +1,215 @@
+import gzip
+import shlex
+
+import numpy as np
+
+THREE_TO_ONE = {
+    'ALA': 'A', 'CYS': 'C', 'ASP': 'D', 'GLU': 'E', 'PHE': 'F', 'GLY': 'G', 'HIS': 'H', 'ILE': 'I', 'LYS': 'K',
+    'LEU': 'L', 'MET': 'M', 'ASN': 'N', 'PRO': 'P', 'GLN': 'Q', 'ARG': 'R', 'SER': 'S', 'THR': 'T', 'VAL': 'V',
+    'TRP': 'W', 'TYR': 'Y'
+}
+# Sorted residue names and their one-letter codes as bytes, matching the byte columns of the parsed atoms
+RESIDUE_NAMES = np.array(sorted(THREE_TO_ONE), dtype='S3')
+RESIDUE_LETTERS = np.array([THREE_TO_ONE[name] for name in sorted(THREE_TO_ONE)], dtype='S1')
+PDB_LINE_WIDTH = 80
+
+
+def read_text(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        return f.read()
+
+
+def get_column(chars, start, end):
+    # Fixed-width field of every record as one bytes array
+    return np.ascontiguousarray(chars[:, start:end]).view(f'S{end - start}').ravel()
+
+
+def get_line_chars(data):
+    # Files padded to 80 columns, as served by the wwPDB, reshape directly without splitting the lines
+    width = PDB_LINE_WIDTH + 1
+    if len(data) and len(data) % width == 0:
+        chars = np.frombuffer(data, dtype=np.uint8).reshape(-1, width)
+        if (chars[:, -1] == ord('\n')).all():
+            return chars[:, :-1]
+    lines = data.splitlines()
+    return np.array(lines, dtype=f'S{PDB_LINE_WIDTH}').view(np.uint8).reshape(len(lines), PDB_LINE_WIDTH)
+
+
+def parse_pdb_atoms(data):
+    chars = get_line_chars(data)
+    record_types = get_column(chars, 0, 6)
+    # Biopython starts a new model at every MODEL record and at atoms that follow an ENDMDL without one
+    model_ids = np.cumsum((record_types == b'MODEL ') | (record_types == b'ENDMDL'))
+    is_atom = (record_types == b'ATOM  ') | (record_types == b'HETATM')
+    chars, model_ids, record_types = chars[is_atom], model_ids[is_atom], record_types[is_atom]
+
+    occupancy = np.char.strip(get_column(chars, 54, 60))
+    occupancy[occupancy == b''] = b'0'
+    return {
+        "is_het": record_types == b'HETATM',
+        # Text fields stay as bytes and numeric fields as text, only the selected CA atoms are converted
+        "atom_names": np.char.strip(get_column(chars, 12, 16)),
+        "has_altloc": get_column(chars, 16, 17) != b' ',
+        "resnames": np.char.strip(get_column(chars, 17, 20)),
+        "chain_ids": get_column(chars, 21, 22),
+        "residue_keys": get_column(chars, 22, 27),
+        "occupancy": occupancy,
+        "coords": np.stack([get_column(chars, start, start + 8) for start in (30, 38, 46)], axis=1),
+        "model_ids": model_ids
+    }
+
+
+def parse_mmcif_atoms(data):
+    lines = data.decode('utf-8', errors='replace').splitlines()
+    first = next(idx for idx, line in enumerate(lines) if line.startswith('_atom_site.'))
+    end = first
+    while end < len(lines) and lines[end].startswith('_atom_site.'):
+        end += 1
+    headers = [line.split()[0][len('_atom_site.'):] for line in lines[first:end]]
+    rows = []
+    for line in lines[end:]:
+        if not line.strip() or line.startswith(('#', '_', 'loop_', 'data_')):
+            break
+        rows.append(line)
+
+    tokens = [line.split() for line in rows]
+    if any(len(row) != len(headers) for row in tokens):
+        tokens = [shlex.split(line, posix=True) for line in rows]
+    table = np.array(tokens, dtype=str).reshape(len(rows), len(headers))
+
+    def column(name, default=None):
+        if name in headers:
+            return table[:, headers.index(name)]
+        return np.full(len(table), default, dtype=str)
+
+    def text(values):
+        return np.char.encode(values, 'ascii', 'replace')
+
+    def numeric(name):
+        values = column(name, '0').copy()
+        values[np.isin(values, ['?', '.'])] = '0'
+        return values.astype(np.float64)
+
+    insertion_codes = column('pdbx_PDB_ins_code', '?').copy()
+    insertion_codes[np.isin(insertion_codes, ['?', '.'])] = ''
+    residue_numbers = column('auth_seq_id') if 'auth_seq_id' in headers else column('label_seq_id')
+    atom_names = column('label_atom_id') if 'label_atom_id' in headers else column('auth_atom_id')
+    return {
+        "is_het": column('group_PDB') == 'HETATM',
+        "atom_names": text(np.char.strip(atom_names, '"')),
+        "has_altloc": ~np.isin(column('label_alt_id', '.'), ['?', '.']),
+        "resnames": text(column('label_comp_id') if 'label_comp_id' in headers else column('auth_comp_id')),
+        "chain_ids": text(column('auth_asym_id') if 'auth_asym_id' in headers else column('label_asym_id')),
+        "residue_keys": text(np.char.add(residue_numbers, insertion_codes)),
+        "occupancy": numeric('occupancy'),
+        "coords": np.stack([numeric(f'Cartn_{axis}') for axis in 'xyz'], axis=1),
+        "model_ids": numeric('pdbx_PDB_model_num').astype(np.int64)
+    }
+
+
+def get_codes(values):
+    if values.dtype.kind == 'S' and values.dtype.itemsize <= 8:
+        # Short byte strings are zero padded to 8 bytes and compared as integers, much faster than as strings
+        padded = np.zeros((len(values), 8), dtype=np.uint8)
+        padded[:, :values.dtype.itemsize] = values.view(np.uint8).reshape(len(values), values.dtype.itemsize)
+        values = padded.view(np.uint64).ravel()
+    return np.unique(values, return_inverse=True)[1].ravel()
+
+
+def combine_codes(*codes):
+    # Mixed-radix key of several code arrays, so that unique rows reduce to a 1-D unique over integers
+    key = np.zeros(len(codes[0]), dtype=np.int64)
+    for code in codes:
+        key = key * (int(code.max()) + 1 if len(code) else 1) + code
+    return key
+
+
+def count_unique_rows(*codes):
+    return len(np.unique(combine_codes(*codes)))
+
+
+def group_rows(keys):
+    """First and last row of every distinct key, in sorted key order, and the group of every row."""
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    is_start = np.ones(len(keys), dtype=bool)
+    is_start[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    starts = np.flatnonzero(is_start)
+    ends = np.append(starts[1:], len(keys))[:len(starts)] - 1
+    groups = np.empty(len(keys), dtype=np.int64)
+    groups[order] = np.cumsum(is_start) - 1
+    return order[starts], order[ends], groups
+
+
+def scan_ca_chains(path, first_model_only=False):
+    """Single-pass CA extractor for PDB and mmCIF files.
+
+    Parses the coordinate records with fixed-column (PDB) or column-table (mmCIF) numpy operations instead of
+    building a Biopython structure, and returns the same chain ids, sequences, CA coordinates and structure info as
+    extract_amino_acid_chains and get_structure_info. Point mutations keep the residue name read last and disordered
+    CA atoms keep the first location with the highest occupancy, as Biopython does.
+    """
+    data = read_text(path)
+    is_mmcif = path.endswith(('.cif', '.cif.gz', '.mmcif', '.mmcif.gz'))
+    atoms = parse_mmcif_atoms(data) if is_mmcif else parse_pdb_atoms(data)
+
+    model_codes = get_codes(atoms["model_ids"])
+    chain_codes = get_codes(atoms["chain_ids"])
+    residue_codes = get_codes(atoms["residue_keys"])
+    # Residue ids of hetero residues include their name, so they never merge with standard residues
+    hetero_codes = np.where(atoms["is_het"], get_codes(atoms["resnames"]) + 1, 0)
+    atom_name_codes = get_codes(atoms["atom_names"])
+    chain_first_rows, _, chain_groups = group_rows(combine_codes(model_codes, chain_codes))
+    residue_first_rows, residue_last_rows, residue_groups = group_rows(
+        combine_codes(model_codes, chain_codes, hetero_codes, residue_codes))
+    # Point mutations: Biopython selects the residue name read last for a residue id and only counts its atoms.
+    # A residue whose first name has atoms without altloc is not a point mutation, so its first name is kept.
+    first_names = atoms["resnames"][residue_first_rows]
+    is_first_name = atoms["resnames"] == first_names[residue_groups]
+    has_blank_altloc = np.zeros(len(first_names), dtype=bool)
+    has_blank_altloc[residue_groups[is_first_name & ~atoms["has_altloc"]]] = True
+    selected_names = np.where(has_blank_altloc, first_names, atoms["resnames"][residue_last_rows])
+    is_selected_name = atoms["resnames"] == selected_names[residue_groups]
+    structure_info = {
+        "num_chains": len(chain_first_rows),
+        "num_residues": len(residue_first_rows),
+        "num_atoms": count_unique_rows(residue_groups[is_selected_name], atom_name_codes[is_selected_name])
+    }
+
+    keep = np.ones(len(model_codes), dtype=bool)
+    if first_model_only and len(model_codes):
+        keep = model_codes == model_codes[0]
+
+    chain_ids, chain_sequences, chain_coords = [], [], []
+    # Chains never span models, so a chain is either kept whole or dropped. Kept chains are ranked in order of
+    # first appearance.
+    kept_chains = np.flatnonzero(keep[chain_first_rows])
+    kept_chains = kept_chains[np.argsort(chain_first_rows[kept_chains])]
+    if not len(kept_chains):
+        return chain_ids, chain_sequences, chain_coords, structure_info
+    chain_ranks = np.zeros(len(chain_first_rows), dtype=np.int64)
+    chain_ranks[kept_chains] = np.arange(len(kept_chains))
+
+    # One CA per standard residue: the selected residue name, then the CA with the highest occupancy
+    ca_rows = np.flatnonzero(keep & ~atoms["is_het"] & (atoms["atom_names"] == b'CA') & is_selected_name)
+    ca_rows = ca_rows[np.isin(atoms["resnames"][ca_rows], RESIDUE_NAMES)]
+    ca_groups = residue_groups[ca_rows]
+    order = np.lexsort((ca_rows, -atoms["occupancy"][ca_rows].astype(np.float64), ca_groups))
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = ca_groups[order][1:] != ca_groups[order][:-1]
+    selected, selected_groups = ca_rows[order[is_first]], ca_groups[order[is_first]]
+    # Residues in order of first appearance within their chain
+    selected_chains = chain_ranks[chain_groups[selected]]
+    order = np.lexsort((residue_first_rows[selected_groups], selected_chains))
+    selected, selected_chains = selected[order], selected_chains[order]
+    boundaries = np.searchsorted(selected_chains, np.arange(len(kept_chains) + 1))
+    letters = RESIDUE_LETTERS[np.searchsorted(RESIDUE_NAMES, atoms["resnames"][selected])]
+    coords = atoms["coords"][selected].astype(np.float64).astype(np.float32)
+
+    for chain_rank, first_row in enumerate(chain_first_rows[kept_chains]):
+        start, end = boundaries[chain_rank], boundaries[chain_rank + 1]
+        chain_ids.append(atoms["chain_ids"][first_row].decode())
+        chain_sequences.append(letters[start:end].tobytes().decode())
+        chain_coords.append(coords[start:end])
+    return chain_ids, chain_sequences, chain_coords, structure_info
@@ -3,7 +3,7 @@ import pandas as pd
 import umap.umap_ as umap
 from matplotlib import pyplot as plt
 
-from utils.extract_pdb_database import AMINO_ACIDS
+from constants import AMINO_ACIDS
 
 
 def one_hot_encode_sequence(sequences):
@@ -28,21 +28,20 @@ def encode_values(value_list):
     return encoded_values, value_to_numeric
 
 
-protein_df = pd.read_csv("D:\python project\data\protein_df.csv")
-top_5_organisms = protein_df['organism'].value_counts().head(5).index.tolist()
-protein_df = protein_df[protein_df['organism'].isin(top_5_organisms)][:1000]
-encoded_sequences = one_hot_encode_sequence(protein_df.sequence)
-encoded_values, value_to_numeric = encode_values(protein_df.organism.to_list())
-numeric_to_value = {numeric: value for value, numeric in value_to_numeric.items()}
-
-reducer = umap.UMAP()
-embedding = reducer.fit_transform(encoded_sequences)
-fig, ax = plt.subplots()
-
-for numeric, value in numeric_to_value.items():
-    indices = [i for i, v in enumerate(encoded_values) if v == numeric]
-    ax.scatter(embedding[indices, 0], embedding[indices, 1], label=value, cmap='Spectral', s=5)
-ax.legend(title='Organism', loc='upper right', fontsize='small')
-plt.show()
+if __name__ == '__main__':
+    protein_df = pd.read_csv(r"D:\python project\data\protein_df.csv")
+    top_5_organisms = protein_df['organism'].value_counts().head(5).index.tolist()
+    protein_df = protein_df[protein_df['organism'].isin(top_5_organisms)][:1000]
+    encoded_sequences = one_hot_encode_sequence(protein_df.sequence)
+    encoded_values, value_to_numeric = encode_values(protein_df.organism.to_list())
+    numeric_to_value = {numeric: value for value, numeric in value_to_numeric.items()}
 
+    reducer = umap.UMAP()
+    embedding = reducer.fit_transform(encoded_sequences)
+    fig, ax = plt.subplots()
 
+    for numeric, value in numeric_to_value.items():
+        indices = [i for i, v in enumerate(encoded_values) if v == numeric]
+        ax.scatter(embedding[indices, 0], embedding[indices, 1], label=value, cmap='Spectral', s=5)
+    ax.legend(title='Organism', loc='upper right', fontsize='small')
+    plt.show()
@@ -0,0 +1,159 @@
+import os
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from constants import AMINO_ACIDS, MAIN_DIR
+from utils.binary_shards import encode_tokens, list_shards
+from utils.dataset_manifest import DatasetManifest, get_shard_sequences
+
+ALPHABET_SIZE = len(AMINO_ACIDS) + 1
+
+
+def identity_to_jaccard(identity, k):
+    # With mismatches spread along the chain a k-mer survives with probability identity ** k
+    shared = identity ** k
+    return shared / (2 - shared)
+
+
+def get_lsh_bands(num_perm, threshold):
+    # Band layout whose collision threshold (1 / bands) ** (1 / rows) is closest to the target similarity
+    layouts = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    return min(layouts, key=lambda layout: abs((1 / layout[0]) ** (1 / layout[1]) - threshold))
+
+
+def get_kmer_ids(sequences, k):
+    """k-mer ids of every sequence back to back, with the number of ids of each sequence."""
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+    # One separator after every chain so that each one owns at least one position, even when empty
+    tokens = encode_tokens("\0".join(sequences) + "\0" * k).astype(np.int64)
+    powers = ALPHABET_SIZE ** np.arange(k, dtype=np.int64)
+    window_ids = np.lib.stride_tricks.sliding_window_view(tokens, k) @ powers
+    starts = np.zeros(len(sequences), dtype=np.int64)
+    np.cumsum(lengths[:-1] + 1, out=starts[1:])
+    positions = np.arange(len(window_ids)) - np.repeat(starts, lengths + 1)[:len(window_ids)]
+    valid = positions <= np.repeat(lengths, lengths + 1)[:len(window_ids)] - k
+    # Chains shorter than k are represented by the whole sequence, outside the range of k-mer ids
+    for idx in np.flatnonzero(lengths < k):
+        start = starts[idx]
+        window_ids[start] = ALPHABET_SIZE ** k + int(tokens[start:start + lengths[idx]] @ powers[:lengths[idx]])
+        valid[start] = True
+    return window_ids[valid], np.maximum(lengths - k + 1, 1)
+
+
+def get_minhash_signatures(sequences, k=5, num_perm=64, seed=0, chunk_size=1 << 16):
+    # Multiply-shift hashing: the high 32 bits of a * x + b modulo 2 ** 64, with odd multipliers a
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, 1 << 63, size=(num_perm, 1), dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    b = rng.integers(0, 1 << 63, size=(num_perm, 1), dtype=np.uint64)
+    signatures = np.empty((len(sequences), num_perm), dtype=np.uint32)
+    start = 0
+    while start < len(sequences):
+        # Hash chunks of about chunk_size residues at once and take the minimum of every sequence's segment
+        end, num_residues = start, 0
+        while end < len(sequences) and (end == start or num_residues + len(sequences[end]) <= chunk_size):
+            num_residues += len(sequences[end])
+            end += 1
+        kmer_ids, counts = get_kmer_ids(list(sequences[start:end]), k)
+        hashes = (a * kmer_ids.astype(np.uint64) + b) >> np.uint64(32)
+        signatures[start:end] = np.minimum.reduceat(hashes, np.cumsum(counts) - counts, axis=1).T
+        start = end
+    return signatures
+
+
+def get_candidate_pairs(signatures, bands, rows):
+    """Pairs of sequences that share at least one LSH band, each bucket linked as a star around its first member."""
+    pairs = []
+    for band in range(bands):
+        band_signatures = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        keys = band_signatures.view(f"V{band_signatures.itemsize * rows}").ravel()
+        _, buckets = np.unique(keys, return_inverse=True)
+        order = np.argsort(buckets.ravel(), kind="stable")
+        sorted_buckets = buckets.ravel()[order]
+        is_first = np.ones(len(order), dtype=bool)
+        is_first[1:] = sorted_buckets[1:] != sorted_buckets[:-1]
+        bucket_heads = order[is_first][np.cumsum(is_first) - 1]
+        linked = ~is_first
+        pairs.append(np.stack([bucket_heads[linked], order[linked]]))
+    if not pairs:
+        return np.zeros((2, 0), dtype=np.int64)
+    return np.unique(np.concatenate(pairs, axis=1), axis=1)
+
+
+def cluster_sequences(sequences, identity=0.9, k=5, num_perm=128, seed=0):
+    """Single-linkage clusters of sequences at about the given identity, in near-linear time.
+
+    Identical sequences are merged first. The remaining unique sequences get MinHash signatures of their k-mer sets,
+    candidate pairs come from LSH banding and are kept when their estimated k-mer Jaccard similarity reaches the
+    value expected at the identity threshold. Returns a cluster id per sequence, numbered by first appearance.
+    """
+    unique_sequences, first, inverse = np.unique(np.array(sequences, dtype=object), return_index=True,
+                                                 return_inverse=True)
+    # Process the unique sequences in order of first appearance, so that cluster ids follow the input order
+    order = np.argsort(first)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    unique_sequences = unique_sequences[order]
+
+    jaccard = identity_to_jaccard(identity, k)
+    signatures = get_minhash_signatures(unique_sequences, k, num_perm, seed)
+    bands, rows = get_lsh_bands(num_perm, jaccard)
+    pairs = get_candidate_pairs(signatures, bands, rows)
+    similarity = (signatures[pairs[0]] == signatures[pairs[1]]).mean(axis=1)
+    pairs = pairs[:, similarity >= jaccard]
+
+    num_unique = len(unique_sequences)
+    graph = coo_matrix((np.ones(pairs.shape[1]), (pairs[0], pairs[1])), shape=(num_unique, num_unique))
+    _, labels = connected_components(graph, directed=False)
+    # Renumber the components by their first member
+    _, first_members, labels = np.unique(labels, return_index=True, return_inverse=True)
+    renumbered = np.empty(len(first_members), dtype=np.int64)
+    renumbered[np.argsort(first_members)] = np.arange(len(first_members))
+    return renumbered[labels.ravel()][rank[inverse.ravel()]]
+
+
+def cluster_manifest(manifest, identity=0.9, k=5, num_perm=128, seed=0):
+    """Cluster every chain of the manifest and store the ids as its "cluster" column, reusing stored clusters."""
+    params = {"identity": identity, "k": k, "num_perm": num_perm, "seed": seed}
+    if "cluster" in manifest.columns and manifest.attributes.get("cluster") == params:
+        return manifest["cluster"]
+
+    sequences = []
+    for path in manifest.shard_paths:
+        sequences.extend(get_shard_sequences(path))
+    clusters = cluster_sequences(sequences, identity, k, num_perm, seed)
+    manifest.set_column("cluster", clusters, **params)
+    print(f"{len(sequences)} chains in {clusters.max() + 1 if len(clusters) else 0} clusters "
+          f"at {identity:.0%} identity")
+    return clusters
+
+
+def split_clusters(clusters, test_size=0.2, seed=42):
+    """Test mask that puts a random test_size fraction of whole clusters in the test set.
+
+    An int test_size is a number of clusters, as test_size is a number of files for split_files.
+    """
+    num_clusters = int(clusters.max()) + 1 if len(clusters) else 0
+    num_test = test_size if isinstance(test_size, int) else int(round(test_size * num_clusters))
+    is_test_cluster = np.zeros(num_clusters, dtype=bool)
+    is_test_cluster[np.random.default_rng(seed).permutation(num_clusters)[:num_test]] = True
+    return is_test_cluster[clusters]
+
+
+def sample_cluster_representatives(clusters, mask, seed=0):
+    """Mask keeping one random chain of every cluster among the chains selected by mask."""
+    selected = np.flatnonzero(mask)
+    priority = np.random.default_rng(seed).random(len(selected))
+    order = np.lexsort((priority, clusters[selected]))
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = clusters[selected][order][1:] != clusters[selected][order][:-1]
+    representatives = np.zeros(len(mask), dtype=bool)
+    representatives[selected[order[is_first]]] = True
+    return representatives
+
+
+if __name__ == '__main__':
+    data_path = os.path.join(MAIN_DIR, "pdb_data_130000")
+    manifest = DatasetManifest(os.path.join(data_path, "manifest.npz")).build(list_shards(data_path))
+    cluster_manifest(manifest)
@@ -1,10 +1,8 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-
-import pandas as pd
-from matplotlib import pyplot as plt
-from sklearn.manifold import MDS
+from scipy.spatial import cKDTree
 
 from constants import MAIN_DIR, MAX_SIZE
 from utils.utils import normalize
@@ -27,6 +25,24 @@ def get_contact_map(ca_coords, threshold=8.0):
         return np.where(distances < threshold, 1.0, 0.0).astype(int)
 
 
+def get_contact_edge_index(ca_coords, threshold=8.0, start=0, end=None):
+    # Sparse equivalent of the CSR edges of get_contact_map(ca_coords)[start:end, start:end], built from a KD-tree
+    # radius search over the cropped coordinates so memory grows with the number of contacts instead of L^2
+    ca_coords = np.asarray(ca_coords, dtype="float32")[start:end]
+    num_residues = len(ca_coords)
+
+    # Search a slightly larger radius, then keep exactly the pairs the float32 distogram marks as contacts
+    pairs = cKDTree(ca_coords).query_pairs(threshold + 1e-3, output_type='ndarray')
+    distances = np.linalg.norm(ca_coords[pairs[:, 0]] - ca_coords[pairs[:, 1]], axis=-1)
+    pairs = pairs[distances < threshold]
+
+    self_loops = np.arange(num_residues)
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1], self_loops])
+    cols = np.concatenate([pairs[:, 1], pairs[:, 0], self_loops])
+    order = np.argsort(rows * num_residues + cols, kind="stable")
+    return np.stack([rows[order], cols[order]]).astype(np.int64)
+
+
 def get_soft_contact_map(ca_coords, decay_rate=0.5):
     distances = get_distogram(ca_coords)
     if distances is not None:
@@ -34,6 +50,9 @@ def get_soft_contact_map(ca_coords, decay_rate=0.5):
 
 
 def plot_contact_map(predicted_distogram, ground_truth_distogram):
+    # matplotlib is only imported for plotting, it is not needed for training or prediction
+    from matplotlib import pyplot as plt
+
     fig, axes = plt.subplots(1, 2, figsize=(12, 6))
 
     axes[0].imshow(predicted_distogram, cmap='viridis')
@@ -51,38 +70,212 @@ def get_distogram_from_soft_contact_map(contact_map, decay_rate=0.5):
     return distances
 
 
-def optimize_points_from_distogram(distogram, n_init=1000, max_iter=30000, random_state=None):
-    mds = MDS(n_components=3, dissimilarity="precomputed", n_init=n_init, max_iter=max_iter, random_state=random_state)
-    points = mds.fit_transform(distogram)
+def get_window_weights(num_residues):
+    # Tent weights, highest at the centre of a crop where the model sees the most context on both sides
+    positions = np.arange(num_residues)
+    weights = np.minimum(positions + 1, num_residues - positions).astype("float32")
+    return np.outer(weights, weights)
+
+
+def stitch_distogram_crops(seq_len, crops, predictions):
+    """Merges per-crop pair predictions into one seq_len x seq_len distogram.
+
+    crops are arrays of residue indices and predictions the matching square maps. Crop predictions are normalized
+    by their own maximum, so every crop is first rescaled by least squares against the pairs already covered:
+    contiguous windows in order along the chain, then the remaining crops against the contiguous reference.
+    """
+    merged = np.zeros((seq_len, seq_len), dtype="float64")
+    weight_sum = np.zeros((seq_len, seq_len), dtype="float64")
+    is_contiguous = [bool(np.all(np.diff(crop) == 1)) for crop in crops]
+    contiguous = [idx for idx in range(len(crops)) if is_contiguous[idx]]
+    others = [idx for idx in range(len(crops)) if not is_contiguous[idx]]
+
+    def get_scale(crop, prediction, reference, covered):
+        block = np.ix_(crop, crop)
+        overlap = covered[block]
+        denominator = np.sum(prediction[overlap] ** 2)
+        if not overlap.any() or denominator <= 0:
+            return 1.0
+        return np.sum(reference[block][overlap] * prediction[overlap]) / denominator
+
+    for idx in contiguous:
+        crop, prediction = crops[idx], predictions[idx]
+        covered = weight_sum > 0
+        reference = np.divide(merged, weight_sum, out=np.zeros_like(merged), where=covered)
+        scale = get_scale(crop, prediction, reference, covered)
+        weights = get_window_weights(len(crop))
+        merged[np.ix_(crop, crop)] += weights * scale * prediction
+        weight_sum[np.ix_(crop, crop)] += weights
+
+    covered = weight_sum > 0
+    reference = np.divide(merged, weight_sum, out=np.zeros_like(merged), where=covered)
+    for idx in others:
+        crop, prediction = crops[idx], predictions[idx]
+        scale = get_scale(crop, prediction, reference, covered)
+        weights = get_window_weights(len(crop))
+        merged[np.ix_(crop, crop)] += weights * scale * prediction
+        weight_sum[np.ix_(crop, crop)] += weights
+
+    distogram = np.divide(merged, weight_sum, out=np.zeros_like(merged), where=weight_sum > 0)
+    return ((distogram + distogram.T) / 2).astype("float32")
+
+
+def classical_mds(distograms, n_components=3):
+    # Torgerson MDS of a (batch_size, L, L) stack: top eigenvectors of the double-centered squared distances
+    squared = np.asarray(distograms, dtype="float64") ** 2
+    gram = -0.5 * (squared - squared.mean(axis=-1, keepdims=True) - squared.mean(axis=-2, keepdims=True)
+                   + squared.mean(axis=(-2, -1), keepdims=True))
+    eigenvalues, eigenvectors = np.linalg.eigh(gram)
+    eigenvalues = eigenvalues[..., ::-1][..., :n_components]
+    eigenvectors = eigenvectors[..., ::-1][..., :n_components]
+    return eigenvectors * np.sqrt(np.clip(eigenvalues, 0, None))[..., np.newaxis, :]
+
+
+def pairwise_distances(points):
+    # |x|^2 + |y|^2 - 2 x.y, with one matrix product instead of an (L, L, 3) difference tensor
+    squared_norms = np.sum(points ** 2, axis=-1)
+    squared = (squared_norms[..., :, np.newaxis] + squared_norms[..., np.newaxis, :]
+               - 2 * points @ np.swapaxes(points, -1, -2))
+    return np.sqrt(np.clip(squared, 0, None))
+
+
+def smacof(distograms, points, max_iter=3000, tol=1e-6, eps=1e-12, best_stress=None):
+    """Stress majorization (SMACOF with unit weights) of a batch of starting points against their distograms.
+
+    Iterates the Guttman transform X <- B(X) X / L on the whole batch. A sample stops, as in sklearn, once its stress
+    decrease falls below tol times half the sum of its squared distances, or when best_stress is given and its
+    stress is not expected to get below it any more. Returns the points and the final stress per sample.
+    """
+    distograms = np.asarray(distograms, dtype="float64")
+    points = np.array(points, dtype="float64")
+    num_points = distograms.shape[-1]
+    previous_stress = np.full(len(points), np.inf)
+    active = np.ones(len(points), dtype=bool)
+
+    for iteration in range(max_iter):
+        active_points, active_distograms = points[active], distograms[active]
+        distances = pairwise_distances(active_points)
+        stress = np.sum((distances - active_distograms) ** 2, axis=(-2, -1)) / 2
+        # Half the sum of squared distances, from the centroid instead of the (L, L) distances
+        scale = num_points * np.sum(active_points ** 2, axis=(-2, -1)) - np.sum(active_points.sum(axis=-2) ** 2, -1)
+        decrease = previous_stress[active] - stress
+        converged = decrease < tol * np.maximum(scale, eps)
+        if best_stress is not None:
+            # Estimate of the remaining decrease for a decrease per iteration falling as 1 / iteration^2
+            remaining = decrease * min(iteration + 1, max_iter - iteration)
+            converged |= stress - remaining > best_stress[active]
+
+        # B(X) X without building B: its diagonal holds the row sums of the ratios, which are 0 on the diagonal
+        ratio = np.divide(active_distograms, distances, out=np.zeros_like(distances), where=distances > eps)
+        points[active] = (ratio.sum(axis=-1, keepdims=True) * active_points - ratio @ active_points) / num_points
+
+        previous_stress[active] = stress
+        active[np.flatnonzero(active)[converged]] = False
+        if not active.any():
+            break
+
+    distances = pairwise_distances(points)
+    return points, np.sum((distances - distograms) ** 2, axis=(-2, -1)) / 2
+
+
+def _smacof_start(args):
+    distograms, init, random_state, max_iter, tol, best_stress = args
+    if init is None:
+        rng = np.random.default_rng(random_state)
+        scale = distograms.mean(axis=(-2, -1), keepdims=True)
+        init = rng.normal(size=distograms.shape[:-1] + (3,)) * scale
+    return smacof(distograms, init, max_iter=max_iter, tol=tol, best_stress=best_stress)
+
+
+def optimize_points_from_distograms(distograms, n_init=4, max_iter=3000, tol=1e-6, random_state=None, n_jobs=1):
+    """Reconstructs 3D points from a list of distograms, batching the ones of equal size.
+
+    The first start is classical MDS and the other n_init - 1 are random; with n_jobs > 1 the random starts run in a
+    process pool. Random starts stop early once they cannot beat the best stress found before them, and the points
+    with the lowest stress are kept for every distogram.
+    """
+    points = [None] * len(distograms)
+    sizes = {}
+    for idx, distogram in enumerate(distograms):
+        sizes.setdefault(np.shape(distogram)[0], []).append(idx)
+
+    for indices in sizes.values():
+        batch = np.stack([np.asarray(distograms[idx], dtype="float64") for idx in indices])
+        batch = (batch + np.swapaxes(batch, -1, -2)) / 2
+        results = [smacof(batch, classical_mds(batch), max_iter=max_iter, tol=tol)]
+        seeds = np.random.SeedSequence(random_state).spawn(max(n_init - 1, 0))
+        if n_jobs > 1 and len(seeds) > 1:
+            starts = [(batch, None, seed, max_iter, tol, results[0][1]) for seed in seeds]
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                results += list(executor.map(_smacof_start, starts))
+        else:
+            for seed in seeds:
+                best_stress = np.min([result[1] for result in results], axis=0)
+                results.append(_smacof_start((batch, None, seed, max_iter, tol, best_stress)))
+
+        start_points = np.stack([result[0] for result in results])  # Shape: (n_init, batch_size, L, 3)
+        best_start = np.argmin(np.stack([result[1] for result in results]), axis=0)
+        for position, idx in enumerate(indices):
+            points[idx] = start_points[best_start[position], position]
     return points
 
 
-def align_points(predicted_points, ground_truth_points):
-    centroid_pred = np.mean(predicted_points, axis=0)
-    centroid_gt = np.mean(ground_truth_points, axis=0)
+def optimize_points_from_distogram(distogram, n_init=4, max_iter=3000, tol=1e-6, random_state=None, n_jobs=1):
+    return optimize_points_from_distograms([distogram], n_init=n_init, max_iter=max_iter, tol=tol,
+                                           random_state=random_state, n_jobs=n_jobs)[0]
+
+
+def align_points_batch(predicted_points, ground_truth_points, allow_reflection=False):
+    """Kabsch superposition of (batch_size, L, 3) predicted points onto their ground truth.
+
+    Points recovered from distograms are only defined up to a reflection, which a rotation cannot undo. With
+    allow_reflection, the mirror image of every sample is aligned as well and kept when its RMSD is lower.
+    """
+    predicted_points = np.asarray(predicted_points, dtype="float64")
+    ground_truth_points = np.asarray(ground_truth_points, dtype="float64")
+    if allow_reflection:
+        aligned = align_points_batch(predicted_points, ground_truth_points)
+        mirrored = align_points_batch(predicted_points * np.array([-1.0, 1.0, 1.0]), ground_truth_points)
+        is_mirrored = compute_rmsd(mirrored, ground_truth_points) < compute_rmsd(aligned, ground_truth_points)
+        return np.where(is_mirrored[..., np.newaxis, np.newaxis], mirrored, aligned)
+
+    centroid_pred = predicted_points.mean(axis=-2, keepdims=True)
+    centroid_gt = ground_truth_points.mean(axis=-2, keepdims=True)
     pred_centered = predicted_points - centroid_pred
     gt_centered = ground_truth_points - centroid_gt
 
-    # Compute the optimal rotation matrix
-    H = np.dot(pred_centered.T, gt_centered)
+    # The rotation U D Vt maximizes trace(R^T H), with D flipping the last axis when it would be a reflection
+    H = np.swapaxes(pred_centered, -1, -2) @ gt_centered
     U, S, Vt = np.linalg.svd(H)
-    R = np.dot(Vt.T, U.T)
+    reflection = np.linalg.det(U @ Vt) < 0
+    U[reflection, :, -1] *= -1
+    R = U @ Vt
+
+    return pred_centered @ R + centroid_gt
+
 
-    # Check for reflection (det(R) should be 1 for a proper rotation)
-    if np.linalg.det(R) < 0:
-        Vt[-1, :] *= -1
-        R = np.dot(Vt.T, U.T)
+def align_points(predicted_points, ground_truth_points, allow_reflection=False):
+    return align_points_batch(predicted_points[np.newaxis], ground_truth_points[np.newaxis], allow_reflection)[0]
 
-    # Apply the rotation matrix to the predicted points
-    transformed_predicted_points = np.dot(pred_centered, R)
 
-    # Translate the transformed points
-    transformed_predicted_points += centroid_gt
+def compute_rmsd(predicted_points, ground_truth_points):
+    squared_errors = np.sum((np.asarray(predicted_points) - np.asarray(ground_truth_points)) ** 2, axis=-1)
+    return np.sqrt(squared_errors.mean(axis=-1))
 
-    return transformed_predicted_points
+
+def recover_structures(distograms, ground_truth_points, **kwargs):
+    # Reconstructs, aligns and scores a batch of structures, returning the aligned points and their RMSDs. Distograms
+    # do not tell a structure from its mirror image, so both are aligned and the closer one is scored.
+    predicted_points = optimize_points_from_distograms(distograms, **kwargs)
+    aligned_points = [align_points(predicted, np.asarray(ground_truth), allow_reflection=True)
+                      for predicted, ground_truth in zip(predicted_points, ground_truth_points)]
+    return aligned_points, [float(compute_rmsd(aligned, ground_truth))
+                            for aligned, ground_truth in zip(aligned_points, ground_truth_points)]
 
 
 def plot_protein_atoms(predicted_points, ground_truth_points, title="Protein 3D Points"):
+    from matplotlib import pyplot as plt
+
     fig = plt.figure(figsize=(10, 7))
     ax = fig.add_subplot(111, projection='3d')
 
@@ -113,6 +306,8 @@ def plot_protein_atoms(predicted_points, ground_truth_points, title="Protein 3D
 
 
 if __name__ == '__main__':
+    import pandas as pd
+
     input_dir = os.path.join(MAIN_DIR, "PDB", "pdb_data")
     for filename in os.listdir(input_dir):
         if filename.endswith('.json'):
@@ -0,0 +1,128 @@
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import requests
+from lxml import etree
+from requests.adapters import HTTPAdapter
+
+UNIPROT_NAMESPACE = '{http://uniprot.org/uniprot}'
+UNIPROT_BASE_URL = "https://www.uniprot.org/uniprot"
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def get_pdb_references(entry):
+    return [db_reference.get('id') for db_reference in
+            entry.iterfind(f".//{UNIPROT_NAMESPACE}dbReference[@type='PDB']")]
+
+
+def iter_uniprot_pdb_references(xml_file):
+    """Yield (accession, PDB ids) for every entry of a UniProt XML file, from its PDB dbReference elements."""
+    context = etree.iterparse(xml_file, events=('end',), tag=f'{UNIPROT_NAMESPACE}entry')
+    for event, elem in context:
+        yield elem.findtext(f'{UNIPROT_NAMESPACE}accession'), get_pdb_references(elem)
+        # Free the parsed entry, otherwise the whole file accumulates in memory
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def load_pdb_id_cache(cache_path):
+    data = {}
+    if not os.path.exists(cache_path):
+        return data
+    with open(cache_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by an interrupted run
+                continue
+            data[record["accession"]] = record["pdb_ids"]
+    return data
+
+
+def end_partial_line(cache_path):
+    # Terminate a line cut short by an interrupted run so that appended records start on their own line
+    if os.path.exists(cache_path) and os.path.getsize(cache_path):
+        with open(cache_path, 'rb+') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+
+
+def append_pdb_ids(f, accession, pdb_ids):
+    f.write(json.dumps({"accession": accession, "pdb_ids": pdb_ids}) + "\n")
+    f.flush()
+
+
+def make_session(pool_size=16):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def fetch_pdb_ids(uniprot_id, session=None, base_url=UNIPROT_BASE_URL, max_retries=3, backoff=1.0, timeout=30):
+    url = f"{base_url}/{uniprot_id}.xml"
+    get = session.get if session is not None else requests.get
+    for attempt in range(max_retries + 1):
+        delay = backoff * 2 ** attempt
+        try:
+            response = get(url, timeout=timeout)
+        except requests.RequestException as e:
+            error = str(e)
+        else:
+            if response.status_code == 200:
+                return get_pdb_references(etree.fromstring(response.content))
+            error = f"status {response.status_code}"
+            if response.status_code not in RETRY_STATUS_CODES:
+                break
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+        if attempt < max_retries:
+            time.sleep(delay)
+
+    print(f"Failed to retrieve data for {uniprot_id}: {error}")
+    return None
+
+
+def fetch_pdb_ids_concurrent(accessions, cache_path, num_workers=16, base_url=UNIPROT_BASE_URL, max_retries=3,
+                             backoff=1.0, timeout=30, log_interval=1000):
+    """Resolve UniProt accessions to PDB ids over a pooled session with at most num_workers requests in flight.
+
+    Accessions already in the JSONL cache at cache_path are skipped. Every resolved accession is appended to the
+    cache as soon as it completes, so an interrupted run resumes where it stopped. Failed lookups are not cached and
+    are retried on the next run. Returns the cached and newly resolved ids as a dict.
+    """
+    data = load_pdb_id_cache(cache_path)
+    pending = iter([accession for accession in dict.fromkeys(accessions) if accession not in data])
+    session = make_session(num_workers)
+    end_partial_line(cache_path)
+
+    def resolve(accession):
+        return accession, fetch_pdb_ids(accession, session, base_url, max_retries, backoff, timeout)
+
+    counter = 0
+    with open(cache_path, 'a') as f, ThreadPoolExecutor(max_workers=num_workers) as executor:
+        # Keep a bounded window of submitted lookups instead of queueing every accession up front
+        futures = {executor.submit(resolve, accession) for accession in itertools.islice(pending, 2 * num_workers)}
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                accession, pdb_ids = future.result()
+                if pdb_ids is not None:
+                    data[accession] = pdb_ids
+                    append_pdb_ids(f, accession, pdb_ids)
+                counter += 1
+                if counter % log_interval == 0:
+                    print(f"Resolved {counter} accessions")
+                next_accession = next(pending, None)
+                if next_accession is not None:
+                    futures.add(executor.submit(resolve, next_accession))
+    session.close()
+    return data